@@ -67,5 +67,6 @@ setup(
       license="Apache v2.0",
       keywords="Digital Volume Correlation",
       url="http://www.ccpi.ac.uk",   # project home page, if any
-      entry_points= {'console_scripts': ['idvc = idvc.idvc:main']}
+      entry_points= {'console_scripts': ['idvc = idvc.idvc:main',
+                                      'idvc-run = idvc.idvc_run:main']}
 )
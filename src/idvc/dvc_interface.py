@@ -64,7 +64,7 @@ import glob
 working_directory = os.getcwd()
 os.chdir(working_directory) 
 
-from ccpi.viewer.utils import (cilMaskPolyData, cilPlaneClipper, Converter)
+from ccpi.viewer.utils import (cilPlaneClipper, Converter)
 import tempfile
 import json
 import shutil
@@ -74,11 +74,17 @@ from functools import reduce
 
 import copy
 
-from idvc.io import ImageDataCreator, getProgress, displayErrorDialogFromWorker, warningDialog
+from idvc.io import ImageDataCreator, getProgress, displayErrorDialogFromWorker, warningDialog, open_raw_volume
 
-from idvc.pointcloud_conversion import cilRegularPointCloudToPolyData, cilNumpyPointCloudToPolyData, PointCloudConverter
+from idvc.masks import mask_bounds, mask_occupancy, image_to_array, array_to_image, \
+    lasso_slice, extend_mask_slab, mask_from_intensity, BackgroundMaskWriter, MaskCache, read_mask_image, write_mask, mha_to_mask, \
+    MASK_EXTENSION, LATEST_MASK
+from idvc.pointcloud_conversion import cilRegularPointCloudToPolyData, cilNumpyPointCloudToPolyData, PointCloudConverter, is_sidecar_file, \
+    points_to_array, sample_mask, write_numeric_table, transformed_bounds, block_texture, lattice_levels, \
+    select_adaptive_points, parse_region_settings, subvolume_fractions, read_numeric_table
 
 from idvc.dvc_runner import DVC_runner
+from idvc.registration import phase_correlation
 
 from eqt.ui import FormDialog
 
@@ -227,6 +233,9 @@ class MainWindow(QMainWindow):
         self.pointCloudLoaded = False
         self.orientation = 2 #z orientation is default
         self.mask_reader = None
+        self.mask_array = None
+        self.mask_writer = BackgroundMaskWriter()
+        self.mask_cache = MaskCache(self.mask_writer)
         self.current_slice = None
         self.mask_details = {}
         self.pointCloud_details = {}
@@ -750,8 +759,9 @@ class MainWindow(QMainWindow):
                 self.dvc_input_image[0] = image_file
                 if os.path.splitext(self.image[0][0])[1] in ['.mhd', '.mha']: #need to call create image data so we read header and save image to file w/o header
                     self.temp_image_data = vtk.vtkImageData()
+                    # the dvc code requires the same header length for both images
                     ImageDataCreator.createImageData(self, self.image[1], self.temp_image_data, info_var=self.image_info, convert_raw=True,  finish_fn=partial(
-                        self.save_image_info, "corr"), output_dir='.')
+                        self.save_image_info, "corr"), output_dir='.', raw_header_length=self.image_info['header_length'])
             elif image_type == "corr":
                 self.dvc_input_image[1] = image_file
                 if hasattr(self, 'temp_image_data'):
@@ -845,6 +855,7 @@ class MainWindow(QMainWindow):
                     rp['translate_Z_entry'].setText(str(self.config['reg_translation'][2]*-1))
                     self.translate = vtk.vtkImageTranslateExtent()
                     self.translate.SetTranslation(self.config['reg_translation'])
+                    self.translate_subvoxel = self.config.get('reg_subvoxel_translation', None)
                     self.registration_parameters['registration_box_size_entry'].setValue(self.config['reg_sel_size'])
                     self.registration_parameters['registration_box_size_entry'].setEnabled(True)
 
@@ -880,6 +891,8 @@ class MainWindow(QMainWindow):
         self.pointmapper = mapper
 
         mapper.SetInputConnection(self.vis_widget_2D.PlaneClipper.GetClippedData('pc_actor').GetOutputPort())         
+        # the point scalars are the subvolume sizes, if any
+        mapper.ScalarVisibilityOff()
 
         # create an actor for the points as point
         actor = vtk.vtkLODActor()
@@ -947,6 +960,7 @@ class MainWindow(QMainWindow):
         # # sphere_mapper.SetInputConnection( subv_glyph.GetOutputPort() )
 
         subv_glyph.SetInputConnection( self.polydata_masker.GetOutputPort() )
+        self.setSubvolumeGlyphScaling()
 
 
         if self.pointCloud_shape == cilRegularPointCloudToPolyData.CUBE:
@@ -962,6 +976,7 @@ class MainWindow(QMainWindow):
         self.cubesphere.Update()
         self.vis_widget_2D.PlaneClipper.AddDataToClip('subvol_actor', self.cubesphere.GetOutputPort())
         sphere_mapper.SetInputConnection( self.vis_widget_2D.PlaneClipper.GetClippedData('subvol_actor').GetOutputPort())
+        sphere_mapper.ScalarVisibilityOff()
         self.cubesphere.Update()
         self.cubesphere.SetVectorModeToUseNormal()
 
@@ -984,6 +999,17 @@ class MainWindow(QMainWindow):
         self.cubesphere.Update()
         
 
+    def setSubvolumeGlyphScaling(self):
+        '''Scales the subvolume glyphs by the subvolume size of each point, if the point cloud has them
+
+        The glyph sources have the size self.pointCloud_subvol_size'''
+        if self.polydata_masker.HasSubVolumeSizes():
+            self.cubesphere.SetScaleModeToScaleByScalar()
+            self.cubesphere.SetScaleFactor(1. / self.pointCloud_subvol_size)
+        else:
+            self.cubesphere.SetScaleModeToDataScalingOff()
+            self.cubesphere.SetScaleFactor(1.)
+
     def setup3DPointCloudPipeline(self):
         #polydata_masker = self.polydata_masker
 
@@ -991,6 +1017,7 @@ class MainWindow(QMainWindow):
         # save reference
         self.pointmapper = mapper
         mapper.SetInputConnection(self.polydata_masker.GetOutputPort())
+        mapper.ScalarVisibilityOff()
 
         # create an actor for the points as point
         actor = vtk.vtkLODActor()
@@ -1014,6 +1041,7 @@ class MainWindow(QMainWindow):
         # # save reference
         self.cubesphere_mapper3D = sphere_mapper
         sphere_mapper.SetInputConnection( subv_glyph.GetOutputPort() )
+        sphere_mapper.ScalarVisibilityOff()
 
         # # actor for the glyphs
         sphere_actor = vtk.vtkActor()
@@ -1163,6 +1191,23 @@ It is used as a global starting point and a translation reference."
         formLayout.setWidget(widgetno, QFormLayout.FieldRole, rp['start_registration_button'])
         widgetno += 1
 
+        auto_registration_text = "Estimates the translation of the correlate image in the registration box by phase correlation,\n\
+up to the registration box size on each axis. The sub-voxel part of the translation is added to the rigid body offset."
+        rp['auto_registration_button'] = QPushButton(groupBox)
+        rp['auto_registration_button'].setText("Auto-register")
+        rp['auto_registration_button'].setEnabled(False)
+        rp['auto_registration_button'].setToolTip(auto_registration_text)
+        rp['auto_registration_button'].clicked.connect(self.OnAutoRegistrationPushed)
+        formLayout.setWidget(widgetno, QFormLayout.FieldRole, rp['auto_registration_button'])
+        widgetno += 1
+
+        rp['auto_registration_label'] = QLabel(groupBox)
+        rp['auto_registration_label'].setText("")
+        rp['auto_registration_label'].setWordWrap(True)
+        rp['auto_registration_label'].setToolTip(auto_registration_text)
+        formLayout.setWidget(widgetno, QFormLayout.FieldRole, rp['auto_registration_label'])
+        widgetno += 1
+
         # Add elements to layout
         self.addDockWidget(QtCore.Qt.LeftDockWidgetArea, dockWidget)
         # save to instance
@@ -1532,6 +1577,7 @@ It is used as a global starting point and a translation reference."
                 # print ("Start Registration Checked")
                 rp['start_registration_button'].setText("Confirm Registration")
                 rp['registration_box_size_entry'].setEnabled(False)
+                rp['auto_registration_button'].setEnabled(True)
                 
                 rp['select_point_zero'].setChecked(False)
                 rp['select_point_zero'].setCheckable(False)
@@ -1553,6 +1599,7 @@ It is used as a global starting point and a translation reference."
                 # print ("Start Registration Unchecked")
                 rp['start_registration_button'].setText("Start Registration")
                 rp['registration_box_size_entry'].setEnabled(True)
+                rp['auto_registration_button'].setEnabled(False)
                 rp['select_point_zero'].setCheckable(True)
 
                 rp['select_point_zero'].setChecked(False)
@@ -1831,6 +1878,57 @@ It is used as a global starting point and a translation reference."
             self.progress_window.close()
         
 
+    def OnAutoRegistrationPushed(self):
+        self.create_progress_window("Registration", "Estimating the translation")
+        self.progress_window.setValue(10)
+        self.registration_worker = Worker(self.estimateTranslation)
+        self.registration_worker.signals.result.connect(self.applyEstimatedTranslation)
+        self.registration_worker.signals.error.connect(partial(displayErrorDialogFromWorker, self))
+        self.threadpool.start(self.registration_worker)
+
+    def estimateTranslation(self, **kwargs):
+        '''Estimates the translation of the correlate image in the registration box by phase correlation
+
+        The translation is searched up to the registration box size on each axis, see phase_correlation.
+        Returns the (x, y, z) translation and the height of the peak of the correlation.'''
+        progress_callback = kwargs.get('progress_callback', PrintCallback())
+        data = self.getRegistrationVOIs()
+        progress_callback.emit(30)
+        max_shift = int(self.registration_parameters['registration_box_size_entry'].value())
+        return phase_correlation(image_to_array(data[0]), image_to_array(data[1]), max_shift=max_shift)
+
+    def applyEstimatedTranslation(self, result):
+        '''Translates the correlate image by the translation estimated by estimateTranslation
+
+        The translation of the images is the nearest integer one, the sub-voxel part is
+        kept in self.translate_subvoxel and added to the rigid body offset of the runs.'''
+        translation, peak = result
+        rp = self.registration_parameters
+        limit = int(rp['registration_box_size_entry'].value())
+        integer_translation = [int(max(-limit, min(limit, round(t)))) for t in translation]
+        self.translate.SetTranslation(*[-t for t in integer_translation])
+        self.translate.Update()
+        self.subtract.Update()
+        self.translate_subvoxel = [list(self.translate.GetTranslation()),
+            [t - i for t, i in zip(translation, integer_translation)]]
+        rp['auto_registration_label'].setText("Estimated translation: {:.2f}, {:.2f}, {:.2f}\nCorrelation peak: {:.2f}".format(
+            *translation, peak))
+        self.reg_viewer_update()
+
+    def getRigidTranslation(self):
+        '''The (x, y, z) rigid body offset of the correlate image
+
+        It is the translation set on the registration panel, plus the sub-voxel part of the
+        translation estimated by Auto-register if the translation has not changed since.'''
+        if getattr(self, 'translate', None) is None:
+            return [0.0, 0.0, 0.0]
+        translation = list(self.translate.GetTranslation())
+        rigid_translation = [t * -1 for t in translation]
+        subvoxel = getattr(self, 'translate_subvoxel', None)
+        if subvoxel is not None and list(subvoxel[0]) == translation:
+            rigid_translation = [t + r for t, r in zip(rigid_translation, subvoxel[1])]
+        return rigid_translation
+
     def OnKeyPressEventForRegistration(self, interactor, event):
         key_code = interactor.GetKeyCode()
         # print('OnKeyPressEventForRegistration', key_code)
@@ -1996,6 +2094,88 @@ It is used as a global starting point and a translation reference."
         formLayout.setWidget(widgetno, QFormLayout.FieldRole, mp_widgets['clear_button'])
         widgetno += 1
 
+        # Add horizonal seperator
+        separators = []
+        separators.append(QFrame(groupBox))
+        separators[-1].setFrameShape(QFrame.HLine)
+        separators[-1].setFrameShadow(QFrame.Raised)
+        formLayout.setWidget(widgetno, QFormLayout.SpanningRole, separators[-1])
+        widgetno += 1
+
+        # Mask from the gray levels of the reference image
+        intensity_text = "Creates a mask of the voxels of the reference image, at full resolution, within the gray range."
+        mp_widgets['intensity_label'] = QLabel(groupBox)
+        mp_widgets['intensity_label'].setText("Mask from intensity")
+        mp_widgets['intensity_label'].setToolTip(intensity_text)
+        formLayout.setWidget(widgetno, QFormLayout.FieldRole, mp_widgets['intensity_label'])
+        widgetno += 1
+
+        mp_widgets['intensity_range_label'] = QLabel(groupBox)
+        mp_widgets['intensity_range_label'].setText("Gray range")
+        mp_widgets['intensity_range_label'].setToolTip("Minimum and maximum gray level, included, of the voxels in the mask.")
+        formLayout.setWidget(widgetno, QFormLayout.LabelRole, mp_widgets['intensity_range_label'])
+        intensity_layout = QHBoxLayout()
+        intensity_layout.setContentsMargins(0,0,0,0)
+        mp_widgets['intensity_min_entry'] = QSpinBox(groupBox)
+        mp_widgets['intensity_max_entry'] = QSpinBox(groupBox)
+        for entry, value in [(mp_widgets['intensity_min_entry'], 1), (mp_widgets['intensity_max_entry'], 255)]:
+            entry.setMaximum(65535)
+            entry.setValue(value)
+            entry.setToolTip("Minimum and maximum gray level, included, of the voxels in the mask.")
+            intensity_layout.addWidget(entry)
+        intensity_widget = QWidget()
+        intensity_widget.setLayout(intensity_layout)
+        formLayout.setWidget(widgetno, QFormLayout.FieldRole, intensity_widget)
+        widgetno += 1
+
+        mp_widgets['intensity_holes_check'] = QCheckBox(groupBox)
+        mp_widgets['intensity_holes_check'].setText("Fill holes")
+        mp_widgets['intensity_holes_check'].setToolTip("Adds to the mask the regions it encloses.")
+        mp_widgets['intensity_holes_check'].setChecked(True)
+        formLayout.setWidget(widgetno, QFormLayout.FieldRole, mp_widgets['intensity_holes_check'])
+        widgetno += 1
+
+        mp_widgets['intensity_largest_check'] = QCheckBox(groupBox)
+        mp_widgets['intensity_largest_check'].setText("Largest region only")
+        mp_widgets['intensity_largest_check'].setToolTip("Keeps only the largest connected region of the mask.")
+        mp_widgets['intensity_largest_check'].setChecked(True)
+        formLayout.setWidget(widgetno, QFormLayout.FieldRole, mp_widgets['intensity_largest_check'])
+        widgetno += 1
+
+        smoothing_text = "Opening removes the small parts of the mask, closing fills its small gaps. " + \
+            "They use a cube of side 2 * radius + 1 voxels of the reference image."
+        mp_widgets['intensity_smoothing_label'] = QLabel(groupBox)
+        mp_widgets['intensity_smoothing_label'].setText("Smoothing")
+        mp_widgets['intensity_smoothing_label'].setToolTip(smoothing_text)
+        formLayout.setWidget(widgetno, QFormLayout.LabelRole, mp_widgets['intensity_smoothing_label'])
+        mp_widgets['intensity_smoothing_entry'] = QComboBox(groupBox)
+        mp_widgets['intensity_smoothing_entry'].addItems(["None", "Open", "Close", "Open and close"])
+        mp_widgets['intensity_smoothing_entry'].setToolTip(smoothing_text)
+        formLayout.setWidget(widgetno, QFormLayout.FieldRole, mp_widgets['intensity_smoothing_entry'])
+        widgetno += 1
+
+        mp_widgets['intensity_radius_label'] = QLabel(groupBox)
+        mp_widgets['intensity_radius_label'].setText("Smoothing radius")
+        mp_widgets['intensity_radius_label'].setToolTip(smoothing_text)
+        formLayout.setWidget(widgetno, QFormLayout.LabelRole, mp_widgets['intensity_radius_label'])
+        mp_widgets['intensity_radius_entry'] = QSpinBox(groupBox)
+        mp_widgets['intensity_radius_entry'].setMinimum(1)
+        mp_widgets['intensity_radius_entry'].setMaximum(20)
+        mp_widgets['intensity_radius_entry'].setValue(1)
+        mp_widgets['intensity_radius_entry'].setEnabled(False)
+        mp_widgets['intensity_radius_entry'].setToolTip(smoothing_text)
+        formLayout.setWidget(widgetno, QFormLayout.FieldRole, mp_widgets['intensity_radius_entry'])
+        widgetno += 1
+        mp_widgets['intensity_smoothing_entry'].currentIndexChanged.connect(
+            lambda: mp_widgets['intensity_radius_entry'].setEnabled(mp_widgets['intensity_smoothing_entry'].currentIndex() != 0))
+
+        mp_widgets['intensity_button'] = QPushButton(groupBox)
+        mp_widgets['intensity_button'].setText("Create Mask from Intensity")
+        mp_widgets['intensity_button'].clicked.connect(lambda: self.MaskWorker("intensity"))
+        mp_widgets['intensity_button'].setToolTip(intensity_text + " It replaces the current mask.")
+        formLayout.setWidget(widgetno, QFormLayout.FieldRole, mp_widgets['intensity_button'])
+        widgetno += 1
+
         mp_widgets['extendMaskCheck'].stateChanged.connect(lambda: mp_widgets['submitButton'].setText("Extend Mask") \
                                                     if mp_widgets['extendMaskCheck'].isChecked() \
                                                     else mp_widgets['submitButton'].setText("Create Mask"))
@@ -2046,6 +2226,13 @@ It is used as a global starting point and a translation reference."
         elif type == "load mask":
             self.mask_worker = Worker(self.loadMask, load_session=False)
             self.mask_worker.signals.finished.connect(self.DisplayMask)
+        elif type == "intensity":
+            if self.getReferenceVolume() is None:
+                self.warningDialog(window_title="Error",
+                               message="The mask from intensity needs the reference image as a single raw, npy or metaimage file, not a TIFF stack.")
+                return
+            self.mask_worker = Worker(self.createMaskFromIntensity)
+            self.mask_worker.signals.finished.connect(self.DisplayMask)
         elif type == "load session":
             self.mask_worker = Worker(self.loadMask, load_session=True)
             self.mask_worker.signals.finished.connect(lambda:self.DisplayMask(type = "load session"))
@@ -2075,67 +2262,39 @@ It is used as a global starting point and a translation reference."
 
         # print("Extend mask")
         progress_callback = kwargs.get('progress_callback', lambda x: logging.info("extendMask Progress: {}".format(x)))
-        # setup the progress bar
-        ui_update = partial(self.ui_progress_update, progress_callback)
         v = self.vis_widget_2D.frame.viewer
 
         poly = vtk.vtkPolyData()
         v.imageTracer.GetPath(poly) 
         #print(v.imageTracer.GetPath(poly))
         pathpoints = poly.GetPoints()
-        #print(pathpoints)
-        # for i in range(poly.GetPoints().GetNumberOfPoints()):
-        #    print (poly.GetPoints().GetPoint(i))
-        lasso = vtk.vtkLassoStencilSource()
-        self.lasso = lasso
-
         image_data = self.vis_widget_2D.image_data
 
-        lasso.SetShapeToPolygon()
         # pass the slice at which the lasso has to process
         sliceno = v.style.GetActiveSlice()
-        lasso.SetSlicePoints(sliceno , pathpoints)
         orientation = v.getSliceOrientation()
-        lasso.SetSliceOrientation(orientation)
-        lasso.SetInformationInput(image_data)
 
         self.mask_details['current'] = [orientation, sliceno]
 
         #Appropriate modification to Point Cloud Panel
         #self.updatePointCloudPanel()
-        
-        # create a blank image
-        dims = image_data.GetDimensions()
-        # print("Dims:" + str(dims))
-
-        #print(image_data.GetSpacing())
-        
-        # progress_callback.emit(40)
-
-
-        mask0 = Converter.numpy2vtkImage(np.zeros((dims[0],dims[1],dims[2]),order='F', 
-                                            dtype=np.uint8),origin = image_data.GetOrigin(), spacing = image_data.GetSpacing())
 
-        mask1 = Converter.numpy2vtkImage(np.ones((dims[0],dims[1],dims[2]),order='F', dtype=np.uint8),
-                                            origin = image_data.GetOrigin(), spacing = image_data.GetSpacing())
+        # only the traced slice is rasterized
+        traced = lasso_slice(pathpoints, sliceno, orientation, image_data)
+        progress_callback.emit(40)
 
-        # print("Mask spacing:", mask0.GetSpacing())
-
-        # Create a Mask from the lasso.
-        stencil = vtk.vtkImageStencil()
-        self.mask_reader = stencil
-        stencil.SetInputData(mask1)
-        stencil.SetBackgroundInputData(mask0)
-
-        stencil.SetStencilConnection(lasso.GetOutputPort())
-
-        stencil.AddObserver(vtk.vtkCommand.ProgressEvent, ui_update)
-        stencil.Update()
-        dims = stencil.GetOutput().GetDimensions()
-
-        # progress_callback.emit(80)
+        dims = image_data.GetDimensions()
+        shape = (dims[2], dims[1], dims[0])
 
-        #print("Stencil dims: " + str(dims))
+        # the mask is kept in memory and edited in place
+        if self.mask_parameters['extendMaskCheck'].isChecked():
+            if self.mask_array is None and hasattr(self, 'mask_data') and self.mask_data.GetDimensions() == dims:
+                self.mask_array = image_to_array(self.mask_data)
+        else:
+            self.mask_array = None
+        if self.mask_array is None or self.mask_array.shape != shape:
+            self.mask_array = np.zeros(shape, dtype=np.uint8)
+            self.mask_data = array_to_image(self.mask_array, image_data)
 
         down = self.mask_parameters['mask_extend_below_entry'].value()
         up = self.mask_parameters['mask_extend_above_entry'].value()
@@ -2144,97 +2303,75 @@ It is used as a global starting point and a translation reference."
         zmin = sliceno -down if sliceno-down>=0 else 0
         zmax = sliceno + up if sliceno+up < dims[orientation] else dims[orientation]
 
-        #vtkutils.copyslices(stencil.GetOutput(), sliceno , zmin, zmax, orientation, None)
-        stencil_output = self.copySlices(stencil.GetOutput(), sliceno , zmin, zmax, orientation, None)
+        with self.mask_writer.lock:
+            extend_mask_slab(self.mask_array, traced, orientation, zmin, max(zmax, sliceno + 1))
+        self.mask_data.GetPointData().GetScalars().Modified()
+        self.mask_data.Modified()
+        self.mask_cache.bump(self.mask_data)
+        progress_callback.emit(80)
 
-        # progress_callback.emit(85)
+        # the mask in memory is the output of the mask reader
+        self.mask_reader = vtk.vtkTrivialProducer()
+        self.mask_reader.SetOutput(self.mask_data)
 
-        # save the mask to a file in temp folder
-        writer = vtk.vtkMetaImageWriter()
-        writer.SetCompression(True)
+        # save the mask to a file in temp folder, in the background
         tmpdir = tempfile.gettempdir()
-        writer.SetFileName(os.path.join(tmpdir, "Masks", "latest_selection.mha"))
-        self.mask_file = "Masks/latest_selection.mha"
-
-        # progress_callback.emit(90)
-
-        # if extend mask -> load temp saved mask
-        if self.mask_parameters['extendMaskCheck'].isChecked():
-            # self.setStatusTip('Extending mask')
-            if os.path.exists(os.path.join(tmpdir, "Masks", "latest_selection.mha")):
-                # print  ("extending mask ", os.path.join(tmpdir, "Masks/latest_selection.mha"))
-                reader = vtk.vtkMetaImageReader()
-                reader.SetFileName(os.path.join(tmpdir, "Masks", "latest_selection.mha"))
-                reader.Update()
-
-                math = vtk.vtkImageMathematics()
-                math.SetOperationToAdd()
-                #math.SetInput1Data(stencil.GetOutput())
-                math.SetInput1Data(stencil_output)
-                math.SetInput2Data(reader.GetOutput())
-                math.Update()
-
-                progress_callback.emit(1)
-                threshold = vtk.vtkImageThreshold()
-                threshold.ThresholdBetween(1, 255)
-                threshold.ReplaceInOn()
-                threshold.SetInValue(1)
-                threshold.SetInputConnection(math.GetOutputPort())
-                threshold.AddObserver(vtk.vtkCommand.ProgressEvent, ui_update)
-                threshold.Update()
-
-                writer.SetInputData(threshold.GetOutput())
-                self.mask_data = threshold.GetOutput()
-            # else:
-            #     print  ("extending mask failed ", tmpdir)
-        else:
-            writer.SetInputData(stencil_output)
-            self.mask_data = stencil_output
-
-        # the writer only updates two values 0 and 1
-        # also it blocks the interface (why???)
-        # adding a pause allows the progress to update correctly
-        writer.AddObserver(vtk.vtkCommand.ProgressEvent, ui_update)
+        self.mask_writer.save(os.path.join(tmpdir, "Masks", LATEST_MASK), self.mask_array,
+            self.mask_data.GetOrigin(), self.mask_data.GetSpacing())
+        self.mask_file = "Masks/" + LATEST_MASK
 
         progress_callback.emit(99)
-        import time
-        time.sleep(1)
-        writer.Write() # writes to file.
         self.mask_parameters['extendMaskCheck'].setEnabled(True)
         # self.setStatusTip('Done')
 
         # progress_callback.emit(100)
         self._disableTracingAndResetUI()
 
-    def _disableTracingAndResetUI(self):
-        # disable tracing on the viewer
-        v = self.vis_widget_2D.frame.viewer
-        v.imageTracer.Off()
-        # set the button to unchecked and text to start tracing
-        self.mask_parameters['start_tracing'].setChecked(False)
-        self.mask_parameters['start_tracing'].setText("Start Tracing")
+    def getReferenceVolume(self):
+        '''Maps in memory the reference image at full resolution, as a (z, y, x) array
 
-    def copySlices(self, indata, fromslice, min, max, orientation, progress_callback):
+        Returns None if the reference image is a TIFF stack, which can't be mapped.'''
+        reference = self.dvc_input_image[0]
+        if len(reference) != 1 or os.path.splitext(reference[0])[1].lower() in ['.tif', '.tiff']:
+            return None
+        return open_raw_volume(reference[0], self.unsampled_image_dimensions, self.vol_bit_depth,
+            self.vol_hdr_lngth, "big" if self.image_info['isBigEndian'] else "little")
 
-        dims = indata.GetDimensions() #dimensions in fortran order
+    def createMaskFromIntensity(self, **kwargs):
+        '''Creates the mask of the voxels of the reference image in the gray range, see mask_from_intensity
 
-        i_range = range(min, max)
+        The mask is computed on the full resolution reference image mapped in memory,
+        on the grid of the image on the viewer. It replaces the current mask.'''
+        progress_callback = kwargs.get('progress_callback', PrintCallback())
+        mp_widgets = self.mask_parameters
+        v = self.vis_widget_2D.frame.viewer
+        image_data = self.vis_widget_2D.image_data
 
-        indata_np = Converter.vtk2numpy(indata)
+        smoothing = [None, 'open', 'close', 'open and close'][mp_widgets['intensity_smoothing_entry'].currentIndex()]
+        self.mask_array = mask_from_intensity(self.getReferenceVolume(),
+            (mp_widgets['intensity_min_entry'].value(), mp_widgets['intensity_max_entry'].value()), image_data,
+            holes=mp_widgets['intensity_holes_check'].isChecked(), largest=mp_widgets['intensity_largest_check'].isChecked(),
+            smoothing=smoothing, radius=mp_widgets['intensity_radius_entry'].value(), progress_callback=progress_callback)
+        self.mask_data = array_to_image(self.mask_array, image_data)
+        self.mask_cache.bump(self.mask_data)
+        self.mask_details['current'] = [v.getSliceOrientation(), v.style.GetActiveSlice()]
 
-        #print("The new shape: ", np.shape(indata_np))
+        self.mask_reader = vtk.vtkTrivialProducer()
+        self.mask_reader.SetOutput(self.mask_data)
 
-        for i in i_range: #note x and z are swapped due to vtkdata being F order and numpy being C order
-            if orientation == 0:
-                    #indata_np[i,:,:] = indata_np[fromslice,:,:]
-                    indata_np[:,:,i] = indata_np[:,:,fromslice]
-            elif orientation == 1:
-                    indata_np[:,i,:] = indata_np[:,fromslice,:]
-            elif orientation == 2:
-                    #indata_np[:,:,i] = indata_np[:,:,fromslice]
-                    indata_np[i,:,:] = indata_np[fromslice,:,:]
+        tmpdir = tempfile.gettempdir()
+        self.mask_writer.save(os.path.join(tmpdir, "Masks", LATEST_MASK), self.mask_array,
+            self.mask_data.GetOrigin(), self.mask_data.GetSpacing())
+        self.mask_file = "Masks/" + LATEST_MASK
+        progress_callback.emit(99)
 
-        return (indata)
+    def _disableTracingAndResetUI(self):
+        # disable tracing on the viewer
+        v = self.vis_widget_2D.frame.viewer
+        v.imageTracer.Off()
+        # set the button to unchecked and text to start tracing
+        self.mask_parameters['start_tracing'].setChecked(False)
+        self.mask_parameters['start_tracing'].setText("Start Tracing")
 
     def loadMask(self, **kwargs): #loading mask from a file
         #print("Load mask")
@@ -2249,16 +2386,17 @@ It is used as a global starting point and a translation reference."
             return 
             
         #print("loadMask")
+        # the mask being saved in the background would overwrite the one loaded
+        self.mask_writer.wait()
+        self.mask_array = None
 
-        self.mask_reader = vtk.vtkMetaImageReader()
-        self.mask_reader.AddObserver("ErrorEvent", self.e)
         tmpdir = tempfile.gettempdir()
+        latest = os.path.join(tmpdir, "Masks", LATEST_MASK)
         if (load_session):
-            self.mask_reader.SetFileName(os.path.join(tmpdir, "Masks", "latest_selection.mha"))
+            filename = LATEST_MASK
             # progress_callback.emit(40)
         else:
             filename = self.mask_parameters["masksList"].currentText()
-            self.mask_reader.SetFileName(os.path.join(tmpdir, "Masks", filename))
             #print("MASK DETAILS")
             #print(self.mask_details)
             if filename in self.mask_details:
@@ -2273,21 +2411,28 @@ It is used as a global starting point and a translation reference."
 
                 self.sliceno = self.mask_details[filename][1]
             # progress_callback.emit(60)
-        
-        ui_update = partial(self.ui_progress_update, progress_callback)
-        self.mask_reader.AddObserver(vtk.vtkCommand.ProgressEvent, ui_update)
-        
-        self.mask_reader.Update()
+
+        if filename == LATEST_MASK and not os.path.exists(latest) \
+                and os.path.exists(os.path.join(tmpdir, "Masks", "latest_selection.mha")):
+            # sessions saved by older versions
+            mha_to_mask(os.path.join(tmpdir, "Masks", "latest_selection.mha"), latest)
+        if filename == LATEST_MASK and not load_session:
+            # the current mask, which may be in memory already
+            mask_image = self.mask_cache.image(latest)
+        else:
+            mask_image = read_mask_image(os.path.join(tmpdir, "Masks", filename))
+            self.mask_cache.bump(mask_image)
+        self.mask_reader = vtk.vtkTrivialProducer()
+        self.mask_reader.SetOutput(mask_image)
         progress_callback.emit(50)
 
-        writer = vtk.vtkMetaImageWriter()
-       
-        writer.SetFileName(os.path.join(tmpdir, "Masks", "latest_selection.mha"))
-        writer.SetInputConnection(self.mask_reader.GetOutputPort())
-        # progress_callback.emit(80)
-        writer.AddObserver(vtk.vtkCommand.ProgressEvent, ui_update)
-        writer.Write()
-        self.mask_file = "Masks/latest_selection.mha"
+        if filename != LATEST_MASK:
+            if os.path.splitext(filename)[1] == MASK_EXTENSION:
+                shutil.copyfile(os.path.join(tmpdir, "Masks", filename), latest)
+            else:
+                write_mask(latest, image_to_array(mask_image), mask_image.GetOrigin(), mask_image.GetSpacing())
+        self.mask_file = "Masks/" + LATEST_MASK
+        progress_callback.emit(80)
         
         
         dims = v.img3D.GetDimensions()
@@ -2311,15 +2456,20 @@ It is used as a global starting point and a translation reference."
         dialogue = QFileDialog()
         mask = dialogue.getOpenFileName(self,"Select a mask")[0]
         if mask:
-            if ".mha" in mask:
-                filename = os.path.basename(mask)
-                shutil.copyfile(mask, os.path.join(tempfile.tempdir, "Masks", filename))
+            name, extension = os.path.splitext(os.path.basename(mask))
+            if extension in [".mha", MASK_EXTENSION]:
+                # the masks are saved in the session in the compact mask format
+                filename = name + MASK_EXTENSION
+                if extension == MASK_EXTENSION:
+                    shutil.copyfile(mask, os.path.join(tempfile.tempdir, "Masks", filename))
+                else:
+                    mha_to_mask(mask, os.path.join(tempfile.tempdir, "Masks", filename))
                 self.mask_parameters["masksList"].addItem(filename)
                 self.mask_parameters["masksList"].setCurrentText(filename)
                 self.clearMask()
                 self.MaskWorker("load mask")
             else:
-                self.warningDialog("Please select a .mha file", "Error")
+                self.warningDialog("Please select a .mha or {} file".format(MASK_EXTENSION), "Error")
 
 
     def clearMask(self):
@@ -2328,6 +2478,8 @@ It is used as a global starting point and a translation reference."
         self.mask_parameters['submitButton'].setText("Create Mask")
         self.vis_widget_2D.frame.viewer.setInputData2(vtk.vtkImageData()) #deletes mask
         self.mask_reader = None
+        self.mask_array = None
+        self.mask_cache.bump()
 
         #how to clear the tracer? ...
         #self.vis_widget_2D.frame.viewer.imageTracer =  vtk.vtkImageTracerWidget() #this line causes problems
@@ -2340,6 +2492,7 @@ It is used as a global starting point and a translation reference."
     def DisplayMask(self, type = None):
         #Appropriate modification to Point Cloud Panel
         self.updatePointCloudPanel()
+        self.updatePointCloudEstimate()
 
         self.mask_parameters['extendMaskCheck'].setEnabled(True)
         v = self.vis_widget_2D.frame.viewer
@@ -2493,6 +2646,25 @@ A 3D pointcloud is created within the full extent of the mask.")
         widgetno += 1
         pc['pointcloud_dimensionality_entry'] = self.dimensionalityValue
 
+        lattice_tooltip_text = "Arrangement of the points of a 3D point cloud of spherical subvolumes.\n\
+The body centred cubic, face centred cubic and hexagonal close packed lattices cover the mask as well as the cubic one, \n\
+at the same overlap, with about 46%, 23% and 23% fewer points.\n\
+For them the overlap sets how far any location is from a point, neighbouring subvolumes overlap less than set."
+        pc['pointcloud_lattice_label'] = QLabel("Lattice", self.graphParamsGroupBox)
+        pc['pointcloud_lattice_label'].setToolTip(lattice_tooltip_text)
+        self.graphWidgetFL.setWidget(widgetno, QFormLayout.LabelRole, pc['pointcloud_lattice_label'])
+        pc['pointcloud_lattice_entry'] = QComboBox(self.graphParamsGroupBox)
+        pc['pointcloud_lattice_entry'].addItems(["Cubic", "Body centred cubic", "Face centred cubic", "Hexagonal close packed"])
+        pc['pointcloud_lattice_entry'].setToolTip(lattice_tooltip_text)
+        self.graphWidgetFL.setWidget(widgetno, QFormLayout.FieldRole, pc['pointcloud_lattice_entry'])
+        widgetno += 1
+        # the lattices are available for 3D point clouds of spheres
+        update_lattice_entry = lambda: pc['pointcloud_lattice_entry'].setEnabled(
+            self.subvolumeShapeValue.currentIndex() == 1 and self.dimensionalityValue.currentIndex() == 0)
+        self.subvolumeShapeValue.currentIndexChanged.connect(update_lattice_entry)
+        self.dimensionalityValue.currentIndexChanged.connect(update_lattice_entry)
+        update_lattice_entry()
+
         v = self.vis_widget_2D.frame.viewer
         orientation = v.getSliceOrientation()
 
@@ -2570,6 +2742,30 @@ A 3D pointcloud is created within the full extent of the mask.")
         self.graphWidgetFL.setWidget(widgetno, QFormLayout.FieldRole, overlap_widget)
         widgetno+=1
 
+        regions_tooltip_text = "Create the point cloud in the regions of a labelled mask, each with its own subvolume size and overlap.\n\
+The settings of each region are its label, a colon, the subvolume size and the overlap, for all axes or for each of x, y and z, \n\
+separated by semicolons, e.g. 1: 30 0.5; 2: 60 0.2 0.2 0.1\n\
+The regions not listed get no points. The subvolume size of each point is saved in the point cloud file, \n\
+the subvolume size above is used for the results."
+        pc['pointcloud_regions_check'] = QCheckBox(self.graphParamsGroupBox)
+        pc['pointcloud_regions_check'].setText("Labelled mask regions")
+        pc['pointcloud_regions_check'].setToolTip(regions_tooltip_text)
+        pc['pointcloud_regions_check'].setChecked(False)
+        self.graphWidgetFL.setWidget(widgetno, QFormLayout.FieldRole, pc['pointcloud_regions_check'])
+        widgetno += 1
+
+        pc['pointcloud_regions_label'] = QLabel("Region settings", self.graphParamsGroupBox)
+        pc['pointcloud_regions_label'].setToolTip(regions_tooltip_text)
+        self.graphWidgetFL.setWidget(widgetno, QFormLayout.LabelRole, pc['pointcloud_regions_label'])
+        pc['pointcloud_regions_entry'] = QLineEdit(self.graphParamsGroupBox)
+        pc['pointcloud_regions_entry'].setPlaceholderText("1: 30 0.5; 2: 60 0.2")
+        pc['pointcloud_regions_entry'].setToolTip(regions_tooltip_text)
+        pc['pointcloud_regions_entry'].setEnabled(False)
+        self.graphWidgetFL.setWidget(widgetno, QFormLayout.FieldRole, pc['pointcloud_regions_entry'])
+        widgetno += 1
+        pc['pointcloud_regions_check'].stateChanged.connect(
+            lambda: pc['pointcloud_regions_entry'].setEnabled(pc['pointcloud_regions_check'].isChecked()))
+
         rotation_tooltip_text = "Rotation of the pointcloud in degrees."
 
         rotation_layout = QHBoxLayout()
@@ -2657,6 +2853,59 @@ A 3D pointcloud is created within the full extent of the mask.")
         self.erodeCheck.stateChanged.connect(lambda: self.erodeRatioSpinBox.setEnabled(True) if self.erodeCheck.isChecked() else  self.erodeRatioSpinBox.setEnabled(False))
         self.graphWidgetFL.setWidget(widgetno, QFormLayout.FieldRole, self.erodeRatioSpinBox)
         widgetno += 1
+
+        adaptive_tooltip_text = "Place the points more densely where the reference image has more texture, and not at all where it is flat, \
+keeping at most the point budget.\nThe lattice defined by the overlap is the densest arrangement of points."
+        pc['pointcloud_adaptive_check'] = QCheckBox(self.graphParamsGroupBox)
+        pc['pointcloud_adaptive_check'].setText("Adaptive point density")
+        pc['pointcloud_adaptive_check'].setToolTip(adaptive_tooltip_text)
+        pc['pointcloud_adaptive_check'].setChecked(False)
+        self.graphWidgetFL.setWidget(widgetno, QFormLayout.FieldRole, pc['pointcloud_adaptive_check'])
+        widgetno += 1
+
+        pc['pointcloud_texture_measure_label'] = QLabel("Texture measure", self.graphParamsGroupBox)
+        pc['pointcloud_texture_measure_label'].setToolTip("Measure of the texture in a region the size of the subvolume around each point.")
+        self.graphWidgetFL.setWidget(widgetno, QFormLayout.LabelRole, pc['pointcloud_texture_measure_label'])
+        pc['pointcloud_texture_measure_entry'] = QComboBox(self.graphParamsGroupBox)
+        pc['pointcloud_texture_measure_entry'].addItems(["Gray level variance", "Gradient energy"])
+        pc['pointcloud_texture_measure_entry'].setToolTip("Measure of the texture in a region the size of the subvolume around each point.")
+        pc['pointcloud_texture_measure_entry'].setEnabled(False)
+        self.graphWidgetFL.setWidget(widgetno, QFormLayout.FieldRole, pc['pointcloud_texture_measure_entry'])
+        widgetno += 1
+
+        pc['pointcloud_budget_label'] = QLabel("Point budget", self.graphParamsGroupBox)
+        pc['pointcloud_budget_label'].setToolTip("Maximum number of points in the adaptive point cloud.")
+        self.graphWidgetFL.setWidget(widgetno, QFormLayout.LabelRole, pc['pointcloud_budget_label'])
+        pc['pointcloud_budget_entry'] = QSpinBox(self.graphParamsGroupBox)
+        pc['pointcloud_budget_entry'].setMinimum(1)
+        pc['pointcloud_budget_entry'].setMaximum(100000000)
+        pc['pointcloud_budget_entry'].setValue(10000)
+        pc['pointcloud_budget_entry'].setToolTip("Maximum number of points in the adaptive point cloud.")
+        pc['pointcloud_budget_entry'].setEnabled(False)
+        self.graphWidgetFL.setWidget(widgetno, QFormLayout.FieldRole, pc['pointcloud_budget_entry'])
+        widgetno += 1
+        pc['pointcloud_adaptive_check'].stateChanged.connect(
+            lambda: [pc[key].setEnabled(pc['pointcloud_adaptive_check'].isChecked()) 
+                     for key in ['pointcloud_texture_measure_entry', 'pointcloud_budget_entry']])
+
+        estimate_tooltip_text = "Estimate of the number of points which will be created in the mask, before the erosion."
+        pc['pc_estimate_label'] = QLabel("Estimated number of points", self.graphParamsGroupBox)
+        pc['pc_estimate_label'].setToolTip(estimate_tooltip_text)
+        self.graphWidgetFL.setWidget(widgetno, QFormLayout.LabelRole, pc['pc_estimate_label'])
+        pc['pc_estimate_value'] = QLabel("-", self.graphParamsGroupBox)
+        pc['pc_estimate_value'].setToolTip(estimate_tooltip_text)
+        self.graphWidgetFL.setWidget(widgetno, QFormLayout.FieldRole, pc['pc_estimate_value'])
+        widgetno += 1
+        self.isoValueEntry.textChanged.connect(self.updatePointCloudEstimate)
+        self.subvolumeShapeValue.currentTextChanged.connect(self.updatePointCloudEstimate)
+        self.dimensionalityValue.currentIndexChanged.connect(self.updatePointCloudEstimate)
+        for entry in [self.overlapXValueEntry, self.overlapYValueEntry, self.overlapZValueEntry]:
+            entry.valueChanged.connect(self.updatePointCloudEstimate)
+        pc['pointcloud_adaptive_check'].stateChanged.connect(self.updatePointCloudEstimate)
+        pc['pointcloud_lattice_entry'].currentIndexChanged.connect(self.updatePointCloudEstimate)
+        pc['pointcloud_regions_check'].stateChanged.connect(self.updatePointCloudEstimate)
+        pc['pointcloud_regions_entry'].textChanged.connect(self.updatePointCloudEstimate)
+        pc['pointcloud_budget_entry'].valueChanged.connect(self.updatePointCloudEstimate)
         
 
         # Add submit button
@@ -2749,6 +2998,121 @@ The first point is significant, as it is used as a global starting point and ref
 
         self.graphWidgetFL.setWidget(widgetno, QFormLayout.FieldRole, pc['pc_points_value'])
 
+    def updatePointCloudEstimate(self):
+        '''Shows an estimate of the number of points in the mask for the current point cloud settings'''
+        pc = self.pointcloud_parameters
+        if 'pc_estimate_value' not in pc:
+            return
+        if not hasattr(self, 'mask_data') or self.isoValueEntry.text() == '':
+            pc['pc_estimate_value'].setText("-")
+            return
+        try:
+            regions = self.getPointCloudRegions(int(self.isoValueEntry.text()))
+        except ValueError:
+            pc['pc_estimate_value'].setText("-")
+            return
+
+        shapes = [cilRegularPointCloudToPolyData.CUBE, cilRegularPointCloudToPolyData.SPHERE]
+        pointCloud = cilRegularPointCloudToPolyData()
+        pointCloud.SetMode(shapes[self.subvolumeShapeValue.currentIndex()])
+        pointCloud.SetDimensionality([3,2][self.dimensionalityValue.currentIndex()])
+        pointCloud.SetLattice(self.getPointCloudLattice())
+        v = self.vis_widget_2D.frame.viewer
+        orientation = v.getSliceOrientation()
+        pointCloud.SetOrientation(orientation)
+        estimate = 0
+        for label, subvol_size, overlap in regions:
+            try:
+                if pointCloud.GetMode() == cilRegularPointCloudToPolyData.CUBE:
+                    pointCloud.SetSubVolumeRadiusInVoxel(subvol_size)
+                else:
+                    pointCloud.SetSubVolumeRadiusInVoxel(subvol_size/2)
+            except ValueError:
+                pc['pc_estimate_value'].setText("-")
+                return
+            for i in range(3):
+                pointCloud.SetOverlap(i, overlap[i])
+
+            occupancy = self.getMaskOccupancy(label if pc['pointcloud_regions_check'].isChecked() else None)
+            if pointCloud.GetDimensionality() == 3:
+                number_of_voxels = occupancy[2].sum()
+            else:
+                sliceno = v.getActiveSlice()
+                slices = occupancy[orientation]
+                number_of_voxels = slices[sliceno] if 0 <= sliceno < len(slices) else 0
+            estimate += pointCloud.EstimateNumberOfPoints(number_of_voxels, self.mask_data.GetSpacing())
+        if pc['pointcloud_adaptive_check'].isChecked():
+            estimate = min(estimate, pc['pointcloud_budget_entry'].value())
+        pc['pc_estimate_value'].setText(str(estimate))
+
+    def getMaskOccupancy(self, label=None):
+        '''Returns the number of voxels of the mask in the viewer on each slice along x, y and z
+
+        If label is passed, only the voxels with that value are counted. The
+        counts are computed again only when the mask changes'''
+        mask_mtime = (id(self.mask_data), self.mask_data.GetMTime())
+        if getattr(self, 'mask_occupancy', (None, None))[0] != mask_mtime:
+            self.mask_occupancy = (mask_mtime, {})
+        if label not in self.mask_occupancy[1]:
+            mask = image_to_array(self.mask_data)
+            self.mask_occupancy[1][label] = mask_occupancy(mask if label is None else mask == label)
+        return self.mask_occupancy[1][label]
+
+    def getPointCloudRegions(self, subvol_size):
+        '''Returns the label, subvolume size and overlap of the regions of the mask in which the point cloud is created
+
+        Unless labelled mask regions are selected, this is the voxels with value 1,
+        with subvol_size and the overlap in the point cloud panel'''
+        pc = self.pointcloud_parameters
+        if pc['pointcloud_regions_check'].isChecked():
+            return parse_region_settings(pc['pointcloud_regions_entry'].text())
+        return [(1, subvol_size, [entry.value() for entry in [self.overlapXValueEntry, self.overlapYValueEntry, self.overlapZValueEntry]])]
+
+    def getPointCloudLattice(self):
+        '''Returns the lattice selected in the point cloud panel'''
+        lattices = [cilRegularPointCloudToPolyData.CUBIC, cilRegularPointCloudToPolyData.BCC,
+            cilRegularPointCloudToPolyData.FCC, cilRegularPointCloudToPolyData.HCP]
+        return lattices[self.pointcloud_parameters['pointcloud_lattice_entry'].currentIndex()]
+
+    def selectPointsByTexture(self, points, lattice_indices, subvol_size, dimensionality, budget=None):
+        '''Returns the indices of the points kept by the adaptive point density, within the point budget
+
+        The texture is measured on the reference image at full resolution, mapped in memory,
+        in blocks the size of the subvolume. TIFF stacks can't be mapped, for them it is
+        measured on the reference image in the viewer.
+        The budget defaults to the one in the point cloud panel'''
+        pc = self.pointcloud_parameters
+        if budget is None:
+            budget = pc['pointcloud_budget_entry'].value()
+        measure = ['variance', 'gradient'][pc['pointcloud_texture_measure_entry'].currentIndex()]
+        volume = self.getReferenceVolume()
+        if volume is not None:
+            # the points are in voxels of the full resolution image
+            origin, spacing, start = np.zeros(3), np.ones(3), np.zeros(3)
+            block_size = [max(1, int(round(subvol_size)))] * 3
+            image_key = (volume.filename, os.stat(volume.filename).st_mtime_ns)
+        else:
+            image = self.vis_widget_2D.frame.viewer.img3D
+            origin, spacing = np.asarray(image.GetOrigin()), np.asarray(image.GetSpacing())
+            start = np.asarray(image.GetExtent()[::2])
+            block_size = [max(1, int(round(subvol_size / sp))) for sp in spacing]
+            image_key = (id(image), image.GetMTime())
+        # the texture is computed again only if the image, subvolume size or measure change
+        key = image_key + (tuple(block_size), measure)
+        if getattr(self, 'texture_cache', (None, None))[0] != key:
+            if volume is None:
+                volume = image_to_array(image)
+            self.texture_cache = (key, block_texture(volume, block_size, measure))
+        texture = self.texture_cache[1]
+
+        voxels = np.trunc((points - origin) / spacing) - start
+        blocks = (voxels // np.asarray(block_size)).astype(np.intp)
+        # texture is indexed by block z, y, x
+        blocks = np.clip(blocks, 0, np.asarray(texture.shape[::-1]) - 1)
+        point_texture = texture[blocks[:,2], blocks[:,1], blocks[:,0]]
+
+        return select_adaptive_points(point_texture, lattice_levels(lattice_indices), budget, dimensionality=dimensionality)
+
     def _generatePointCloudClicked(self):
         self.pointcloud_is = 'generated'
         self.createSavePointCloudWindow(save_only=False)
@@ -2978,12 +3342,11 @@ The first point is significant, as it is used as a global starting point and ref
         message_callback = kwargs.get('message_callback', PrintCallback())
 
         subvol_size = kwargs.get('subvol_size',None)
-        # Mask is read from temp file
+        # Mask is read from temp file, if it is not in memory
         tmpdir = tempfile.gettempdir() 
-        reader = vtk.vtkMetaImageReader()
-        reader.AddObserver("ErrorEvent", self.e)
-        reader.SetFileName(os.path.join(tmpdir,"Masks","latest_selection.mha"))
-        reader.Update()
+        latest = os.path.join(tmpdir, "Masks", LATEST_MASK)
+        reader = vtk.vtkTrivialProducer()
+        reader.SetOutput(self.mask_cache.image(latest))
 
         origin = reader.GetOutput().GetOrigin()
         spacing = reader.GetOutput().GetSpacing()
@@ -2998,9 +3361,7 @@ The first point is significant, as it is used as a global starting point and ref
         else:
             pointCloud = self.pointCloud
         # instead of translating the point cloud so that point0 is in the point cloud
-        # we add point0 to the point cloud.
-        if hasattr(self, 'point0'):
-            pointCloud.SetPoint0(self.point0_world_coords)
+        # we add point0 to the point cloud, once the regions are combined.
         v = self.vis_widget_2D.frame.viewer
         orientation = v.getSliceOrientation()
         pointCloud.SetOrientation(orientation)
@@ -3013,6 +3374,7 @@ The first point is significant, as it is used as a global starting point and ref
         pointCloud.SetDimensionality(
                 dimensionality[self.dimensionalityValue.currentIndex()]
                 )
+        pointCloud.SetLattice(self.getPointCloudLattice())
 
         self.pointCloud_shape =  shapes[self.subvolumeShapeValue.currentIndex()]
         
@@ -3024,113 +3386,12 @@ The first point is significant, as it is used as a global starting point and ref
         if subvol_size is None:
             subvol_size = int(self.isoValueEntry.text())
 
-        if self.pointCloud_shape == cilRegularPointCloudToPolyData.CUBE:
-            pointCloud.SetSubVolumeRadiusInVoxel(subvol_size) #in cube case, radius is side length
-        else:
-            pointCloud.SetSubVolumeRadiusInVoxel(subvol_size/2)
-
-        pointCloud.SetOverlap(0,float(self.overlapXValueEntry.text()))
-        pointCloud.SetOverlap(1,float(self.overlapYValueEntry.text()))
-        pointCloud.SetOverlap(2,float(self.overlapZValueEntry.text()))
-        
-        message_callback.emit('Creating point cloud')
-        pointCloud.Update()
-        self.pointCloud_subvol_size = subvol_size
-        self.pointCloud_overlap = [float(self.overlapXValueEntry.text()), float(self.overlapYValueEntry.text()), float(self.overlapZValueEntry.text())]
-        
-        #print ("pointCloud number of points", pointCloud.GetNumberOfPoints())
-
-        if pointCloud.GetNumberOfPoints() == 0:
-            self.pointCloudCreated = False
-            raise ValueError("No points in pointcloud. Please check your settings and try again.")
-
-        # Erode the transformed mask because we don't want to have subvolumes outside the mask
-        if not self.pointCloudCreated:
-            erode = vtk.vtkImageDilateErode3D()
-            erode.SetErodeValue(1)
-            erode.SetDilateValue(0) 
-            # save reference
-            self.erode = erode
-            self.erode_pars = {'selection_mtime':os.path.getmtime(
-                    os.path.join(tmpdir, "Masks","latest_selection.mha"))}
-        else:
-            erode = self.erode
-
-        #Set up erosion if user has selected it:
-
-        if( self.erodeCheck.isChecked()):
-            #print ("Erode checked" ,self.erodeCheck.isChecked())
-            
-            if orientation == SLICE_ORIENTATION_XY:
-                ks = [pointCloud.GetSubVolumeRadiusInVoxel(), pointCloud.GetSubVolumeRadiusInVoxel(), 1]
-                if pointCloud.GetDimensionality() == 3:
-                    ks[2]= pointCloud.GetSubVolumeRadiusInVoxel()
-            elif orientation == SLICE_ORIENTATION_XZ:
-                ks = [pointCloud.GetSubVolumeRadiusInVoxel(), 1, pointCloud.GetSubVolumeRadiusInVoxel()]
-                if pointCloud.GetDimensionality() == 3:
-                    ks[1]= pointCloud.GetSubVolumeRadiusInVoxel()
-            elif orientation == SLICE_ORIENTATION_YZ:
-                ks = [1, pointCloud.GetSubVolumeRadiusInVoxel(), pointCloud.GetSubVolumeRadiusInVoxel()]
-                if pointCloud.GetDimensionality() == 3:
-                    ks[0]= pointCloud.GetSubVolumeRadiusInVoxel()
-
-            # kernel size defines size of the structuring element in the erosion.
-            # This needs to be the size of the subvolume diameter but we must add on 0.5 to account for the furthest distance a point may be offset from the centre of a pixel.
-            # have to round up to an integer otherwise some of subvolume may be outside of mask if we round down
-
-            erosion_multiplier = self.erodeRatioSpinBox.value()
-            if self.pointCloud_shape == 'cube':
-                ks = [math.ceil(l*erosion_multiplier + 0.5 ) for l in ks] # "radius" is side length of cube
-                
-            else:
-                ks = [math.ceil(2*l*erosion_multiplier+ 0.5) for l in ks] 
+        # each region of the mask has its own subvolume size and overlap
+        labelled = self.pointcloud_parameters['pointcloud_regions_check'].isChecked()
+        regions = self.getPointCloudRegions(subvol_size)
+        if labelled:
+            labels = image_to_array(reader.GetOutput())
 
-            #print("KS", ks)
-            
-            # the mask erosion takes a looong time. Try not do it all the 
-            # time if neither mask nor other values have changed
-            if not self.eroded_mask:
-                self.erode_pars['ks'] =  ks[:]        
-                run_erode = True
-            else:
-                run_erode = False
-                # test if mask is different from last one by checking the modification
-                # time
-                mtime = os.path.getmtime(os.path.join(tmpdir, "Masks","latest_selection.mha"))
-                if mtime != self.erode_pars['selection_mtime']:
-                    #print("mask has changed")
-                    run_erode = True
-                if ks != self.erode_pars['ks']:
-                    run_erode = True
-                    #print("subvolume size has changed")
-                    self.erode_pars['ks'] = ks[:]
-                                
-            if run_erode:
-                erode.SetInputConnection(0,reader.GetOutputPort())
-                erode.SetKernelSize(ks[0],ks[1],ks[2])
-                erode.Update()
-
-            self.eroded_mask = True
-        else:
-            self.eroded_mask = False
-        
-        
-        # Mask the point cloud with the eroded mask
-        if not self.pointCloudCreated:
-            polydata_masker = cilMaskPolyData()
-            polydata_masker.AddObserver(vtk.vtkCommand.ProgressEvent, partial(getProgress, progress_callback=progress_callback))
-            # save reference
-            self.polydata_masker = polydata_masker
-        else:
-            polydata_masker = self.polydata_masker
-        polydata_masker.SetMaskValue(1)
-        if self.erodeCheck.isChecked():
-            polydata_masker.SetInputConnection(1, erode.GetOutputPort())
-            mask_data = erode.GetOutput()
-        else:
-            polydata_masker.SetInputConnection(1, reader.GetOutputPort())
-            mask_data = reader.GetOutput()
-        
         ## Create a Transform to modify the PointCloud
         # Translation and Rotation
         rotate = [
@@ -3165,65 +3426,178 @@ The first point is significant, as it is used as a global starting point and ref
         elif orientation == SLICE_ORIENTATION_YZ:
             transform.Translate(0, -dimensions[1]/2*spacing[1],-dimensions[2]/2*spacing[2])
 
-        mm = mask_data.GetScalarComponentAsDouble(int(self.point0_sampled_image_coords[0]),int(self.point0_sampled_image_coords[1]), int(self.point0_sampled_image_coords[2]), 0)
+        matrix = transform.GetMatrix()
+        matrix = np.asarray([[matrix.GetElement(i, j) for j in range(4)] for i in range(4)])
 
-        if int(mm) == 1: 
-            #if point0 is in the mask and it has been added as first point to the point cloud
-            remove_point0 = False
-        else:
-            # should remove point0 from the mask
-            remove_point0 = True
+        if self.erodeCheck.isChecked():
+            # the points are masked with the eroded regions, each with its label
+            if labelled:
+                eroded_labels = np.zeros(labels.shape, dtype=labels.dtype)
+
+        region_points = []
+        region_lattice_indices = []
+        region_labels = []
+        region_sizes = []
+        for label, region_subvol_size, overlap in regions:
+            if self.pointCloud_shape == cilRegularPointCloudToPolyData.CUBE:
+                pointCloud.SetSubVolumeRadiusInVoxel(region_subvol_size) #in cube case, radius is side length
+            else:
+                pointCloud.SetSubVolumeRadiusInVoxel(region_subvol_size/2)
 
-        if self.pointCloudCreated:
-            t_filter = self.t_filter
-        else:
-            # Actual Transformation is done here
-            t_filter = vtk.vtkTransformFilter()
-            # save reference
-            self.t_filter = t_filter
-        
-        t_filter.SetTransform(transform)
-        t_filter.SetInputConnection(pointCloud.GetOutputPort())
+            for i in range(3):
+                pointCloud.SetOverlap(i, overlap[i])
+
+            if labelled and not self.erodeCheck.isChecked():
+                region_data = array_to_image((labels == label).astype(np.uint8), reader.GetOutput())
+            else:
+                # the eroded region is made from the whole mask
+                region_data = reader.GetOutput()
+
+            # Erode the transformed mask because we don't want to have subvolumes outside the mask
+            #Set up erosion if user has selected it:
+
+            if( self.erodeCheck.isChecked()):
+                #print ("Erode checked" ,self.erodeCheck.isChecked())
+            
+                if orientation == SLICE_ORIENTATION_XY:
+                    ks = [pointCloud.GetSubVolumeRadiusInVoxel(), pointCloud.GetSubVolumeRadiusInVoxel(), 1]
+                    if pointCloud.GetDimensionality() == 3:
+                        ks[2]= pointCloud.GetSubVolumeRadiusInVoxel()
+                elif orientation == SLICE_ORIENTATION_XZ:
+                    ks = [pointCloud.GetSubVolumeRadiusInVoxel(), 1, pointCloud.GetSubVolumeRadiusInVoxel()]
+                    if pointCloud.GetDimensionality() == 3:
+                        ks[1]= pointCloud.GetSubVolumeRadiusInVoxel()
+                elif orientation == SLICE_ORIENTATION_YZ:
+                    ks = [1, pointCloud.GetSubVolumeRadiusInVoxel(), pointCloud.GetSubVolumeRadiusInVoxel()]
+                    if pointCloud.GetDimensionality() == 3:
+                        ks[0]= pointCloud.GetSubVolumeRadiusInVoxel()
+
+                # kernel size defines size of the structuring element in the erosion.
+                # This needs to be the size of the subvolume diameter but we must add on 0.5 to account for the furthest distance a point may be offset from the centre of a pixel.
+                # have to round up to an integer otherwise some of subvolume may be outside of mask if we round down
+
+                erosion_multiplier = self.erodeRatioSpinBox.value()
+                if self.pointCloud_shape == 'cube':
+                    ks = [math.ceil(l*erosion_multiplier + 0.5 ) for l in ks] # "radius" is side length of cube
+                
+                else:
+                    ks = [math.ceil(2*l*erosion_multiplier+ 0.5) for l in ks] 
 
-        #print("Number of points after transform", t_filter.GetOutputPort().GetNumberOfPoints() )
+                #print("KS", ks)
+            
+                # the eroded masks are kept in memory while the mask is not changed, and are
+                # saved in Masks/Eroded, by hash of the mask and kernel size.
+                message_callback.emit('Eroding mask')
+                region_data = self.mask_cache.eroded(latest, ks,
+                    'cube' if self.pointCloud_shape == cilRegularPointCloudToPolyData.CUBE else 'sphere',
+                    os.path.join(tmpdir, "Masks", "Eroded"), label=label if labelled else None,
+                    progress_callback=progress_callback)
+                if labelled:
+                    eroded_labels[image_to_array(region_data) != 0] = label
+                else:
+                    mask_data = region_data
+
+            # only the points of the lattice which after the transformation may fall 
+            # in the bounding box of the region are created
+            bounds = mask_bounds(region_data)
+            if bounds is None:
+                continue
+            # leave a margin for the rounding errors, the points outside the mask are removed later
+            bounds = [b + (-0.5 if i % 2 == 0 else 0.5) * spacing[i // 2] for i, b in enumerate(bounds)]
+            pointCloud.SetBounds(transformed_bounds(bounds, np.linalg.inv(matrix)))
+
+            message_callback.emit('Creating point cloud')
+            pointCloud.Update()
+            region_points.append(points_to_array(pointCloud.GetOutput()).copy())
+            region_lattice_indices.append(pointCloud.GetLatticeIndices())
+            region_labels.append(np.full(pointCloud.GetNumberOfPoints(), label))
+            region_sizes.append(np.full(pointCloud.GetNumberOfPoints(), region_subvol_size))
+
+        self.eroded_mask = self.erodeCheck.isChecked()
+        # Mask the point cloud with the eroded mask
+        if self.erodeCheck.isChecked() and labelled:
+            mask_data = array_to_image(eroded_labels, reader.GetOutput())
+        elif not self.erodeCheck.isChecked():
+            mask_data = reader.GetOutput()
+
+        self.pointCloud_subvol_size = subvol_size
+        self.pointCloud_overlap = [float(self.overlapXValueEntry.text()), float(self.overlapYValueEntry.text()), float(self.overlapZValueEntry.text())]
         
-        polydata_masker.SetInputConnection(0, t_filter.GetOutputPort())
-        # polydata_masker.Modified()
+        #print ("pointCloud number of points", pointCloud.GetNumberOfPoints())
+
+        if sum([len(points) for points in region_points]) == 0:
+            self.pointCloudCreated = False
+            raise ValueError("No points in pointcloud. Please check your settings and try again.")
+
+        mm = mask_data.GetScalarComponentAsDouble(int(self.point0_sampled_image_coords[0]),int(self.point0_sampled_image_coords[1]), int(self.point0_sampled_image_coords[2]), 0)
+
+        # point0 is added to the point cloud only if it is in the mask
+        point0_regions = [region for region in regions if region[0] == int(mm)]
+        remove_point0 = not hasattr(self, 'point0') or len(point0_regions) == 0
+
+        # Actual Transformation is done here
+        points = np.concatenate(region_points)
+        point_labels = np.concatenate(region_labels)
+        points = points @ matrix[:3,:3].T + matrix[:3,3]
+
+        # all the regions are masked at once, each point is kept if it is in the region it was created for
         message_callback.emit('Applying mask to pointcloud')
-        polydata_masker.Update()
+        sampled, inside = sample_mask(points, mask_data)
+        in_mask = np.flatnonzero(inside & (sampled == point_labels))
+        if self.pointcloud_parameters['pointcloud_adaptive_check'].isChecked() and len(in_mask) > 0:
+            message_callback.emit('Selecting points by texture')
+            lattice_indices = np.concatenate(region_lattice_indices)[in_mask]
+            # the point budget is shared by the regions in proportion to their number of points
+            # and includes point0, which is added afterwards
+            budget = max(0, self.pointcloud_parameters['pointcloud_budget_entry'].value() - (0 if remove_point0 else 1))
+            selected = []
+            for label, region_subvol_size, overlap in regions:
+                region = np.flatnonzero(point_labels[in_mask] == label)
+                if len(region) == 0:
+                    continue
+                selected.append(region[self.selectPointsByTexture(points[in_mask[region]], lattice_indices[region],
+                    region_subvol_size, pointCloud.GetDimensionality(),
+                    budget=int(round(budget * len(region) / len(in_mask))))])
+            in_mask = in_mask[np.sort(np.concatenate(selected))]
+        points = points[in_mask]
+        sizes = np.concatenate(region_sizes)[in_mask]
+        if not remove_point0:
+            # a point of the lattice may fall on point0 already
+            point0 = np.asarray(self.point0_world_coords[:3])
+            is_point0 = np.sum((points - point0)**2, axis=1) < 0.001
+            points = np.concatenate(([point0], points[~is_point0]))
+            sizes = np.concatenate(([point0_regions[0][1]], sizes[~is_point0]))
+        progress_callback.emit(90)
         message_callback.emit('Applying mask to pointcloud. Done')
-        #print("Points in mask now: ", polydata_masker)
         
         self.reader = reader
         
-        pointcloud = self.polydata_masker.GetOutputDataObject(0)
-        array = []
-        self.pc_no_points = pointcloud.GetNumberOfPoints()
-        if(pointcloud.GetNumberOfPoints() == 0):
+        self.pc_no_points = len(points)
+        if(len(points) == 0):
             raise ValueError('No points in pointcloud')
             
         
-        if int(mm) == 1: #if point0 is in the mask
-            count = 2
-        else:
-            count = 1
-
-        for i in range(pointcloud.GetNumberOfPoints()):
-            pp = pointcloud.GetPoint(i)
-            distance = (pp[0]-self.point0_world_coords[0])**2 + (pp[1]-self.point0_world_coords[1])**2 + (pp[2]-self.point0_world_coords[2])**2
-            if distance < 0.001:
-                #print("Distance is 0 for:", pp)
-                #print("Add to front of list")
-                array.insert(0,(1,*pp))
-            else:
-                array.append((count, *pp))
-                count += 1
+        # point0, if in the mask, is the first point with id 1
+        # the subvolume size of each point is saved if it depends on the region
+        array = np.empty((len(points), 5 if labelled else 4))
+        array[:,0] = np.arange(1, len(points) + 1)
+        array[:,1:4] = points
+        fmt = '%d\t%.3f\t%.3f\t%.3f'
+        if labelled:
+            array[:,4] = sizes
+            fmt += '\t%d'
 
         message_callback.emit('Saving pointcloud')
-        start = 0 if remove_point0 is False else 1
-        np.savetxt(tempfile.tempdir + "/" + filename, array[start:], '%d\t%.3f\t%.3f\t%.3f', delimiter=';')
+        write_numeric_table(tempfile.tempdir + "/" + filename, array, fmt)
         self.roi = filename
 
+        # the points are displayed as they are saved
+        if not self.pointCloudCreated:
+            # save reference
+            self.polydata_masker = cilNumpyPointCloudToPolyData()
+        self.polydata_masker.SetData(array)
+        self.polydata_masker.Update()
+
         return True
             
 
@@ -3237,7 +3611,13 @@ The first point is significant, as it is used as a global starting point and ref
         self.roi = pointcloud_file
         #print(self.roi)
 
-        points = np.loadtxt(self.roi)
+        # the sidecar is saved only for the point clouds in the session folder
+        session_folder = os.path.abspath(tempfile.tempdir)
+        try:
+            in_session = os.path.commonpath([self.roi, session_folder]) == session_folder
+        except ValueError:
+            in_session = False
+        points = PointCloudConverter.loadPointCloudFromCSV(self.roi, '\t', sidecar=in_session)
         # except ValueError as ve:
         #     print(ve)
         #     return
@@ -3333,14 +3713,7 @@ Try modifying the subvolume size before creating a new pointcloud, and make sure
         if not self.pointCloudCreated:
             # visualise polydata
             self.setup2DPointCloudPipeline()
-            if not hasattr(self, 'reader'):
-                #TODO: fix this line - we don't have a reader
-                tmpdir = tempfile.gettempdir()
-                reader = vtk.vtkMetaImageReader()
-                reader.AddObserver("ErrorEvent", self.e)
-                reader.SetFileName(os.path.join(tmpdir,"Masks","latest_selection.mha"))
-                reader.Update()
-            v.setInputData2(self.reader.GetOutput()) 
+            v.setInputData2(self.mask_cache.image(os.path.join(tempfile.gettempdir(), "Masks", LATEST_MASK)))
             self.setup3DPointCloudPipeline()
             self.pointCloudCreated = True
             self.pointCloudLoaded = True
@@ -3367,6 +3740,7 @@ Try modifying the subvolume size before creating a new pointcloud, and make sure
                 self.sphere_source.SetRadius(subvol_size/2)
                 self.cubesphere.SetSourceConnection(self.sphere_source.GetOutputPort())
             
+            self.setSubvolumeGlyphScaling()
             self.cubesphere.Update()
         
 
@@ -3500,8 +3874,9 @@ Try modifying the subvolume size before creating a new pointcloud, and make sure
         
     def loadDisplacementFile(self, displ_file, disp_wrt_point0 = False, multiplier = 1):
         
+        # memory-mapped from the sidecar after the first load
         raw_displ = np.asarray(
-            PointCloudConverter.loadPointCloudFromCSV(displ_file,'\t')[:]
+            PointCloudConverter.loadPointCloudFromCSV(displ_file,'\t')
         )
 
         if self.result_widgets['range_vectors_min_entry'].isEnabled():
@@ -3517,9 +3892,7 @@ Try modifying the subvolume size before creating a new pointcloud, and make sure
         displ = np.asarray(displ)
 
         if multiplier != 1:
-            for count in range(len(displ)):
-                for i in range(3):
-                    displ[count][i+6] *= multiplier
+            displ[:,6:9] *= multiplier
 
         return displ
 
@@ -3860,6 +4233,16 @@ Try modifying the subvolume size before creating a new pointcloud, and make sure
         formLayout.setWidget(widgetno, QFormLayout.FieldRole, rdvc_widgets['name_entry'])
         widgetno += 1
 
+        resume_text = "If the run with this name was interrupted, e.g. cancelled or stopped by closing the app,\n\
+runs again only its dvc_result folders whose outputs are missing, incomplete or failed.\n\
+The settings of the interrupted run are used, the ones below are ignored."
+        rdvc_widgets['resume_check'] = QCheckBox(groupBox)
+        rdvc_widgets['resume_check'].setText("Resume an interrupted run")
+        rdvc_widgets['resume_check'].setToolTip(resume_text)
+        rdvc_widgets['resume_check'].setChecked(False)
+        formLayout.setWidget(widgetno, QFormLayout.FieldRole, rdvc_widgets['resume_check'])
+        widgetno += 1
+
         separators = []
         separators.append(QFrame(groupBox))
         separators[-1].setFrameShape(QFrame.HLine)
@@ -3976,6 +4359,80 @@ Tricubic is computationally expensive, but is the choice if strain is of interst
         formLayout.setWidget(widgetno, QFormLayout.FieldRole, rdvc_widgets['run_iterp_type_entry'])
         widgetno += 1
 
+        rdvc_widgets['run_shards_label'] = QLabel(groupBox)
+        rdvc_widgets['run_shards_label'].setText("Point cloud shards per run")
+        shards_text = "Splits the pointcloud of each run in this number of spatially coherent parts,\n\
+which are run in parallel by separate dvc processes and merged at the end.\n\
+Each part starts the search from its point closest to point 0.\n\
+Only used when all the points in the pointcloud are run."
+        rdvc_widgets['run_shards_label'].setToolTip(shards_text)
+        formLayout.setWidget(widgetno, QFormLayout.LabelRole, rdvc_widgets['run_shards_label'])
+        rdvc_widgets['run_shards_entry'] = QSpinBox(groupBox)
+        rdvc_widgets['run_shards_entry'].setMinimum(1)
+        rdvc_widgets['run_shards_entry'].setMaximum(64)
+        rdvc_widgets['run_shards_entry'].setValue(1)
+        rdvc_widgets['run_shards_entry'].setToolTip(shards_text)
+        formLayout.setWidget(widgetno, QFormLayout.FieldRole, rdvc_widgets['run_shards_entry'])
+        widgetno += 1
+
+        prescreen_text = "Checks the fraction of the subvolume of each point whose gray level in the reference image is within the gray range,\n\
+e.g. to leave out the points whose subvolume is mostly pores or air.\n\
+The points below the minimum volume fraction can be removed from the point cloud before the run,\n\
+or skipped by dvc, which is done if the reference image is not a raw file.\n\
+The first point of the point cloud, where the search starts, is always kept."
+        rdvc_widgets['prescreen_check'] = QCheckBox(groupBox)
+        rdvc_widgets['prescreen_check'].setText("Pre-screen subvolumes by gray level")
+        rdvc_widgets['prescreen_check'].setToolTip(prescreen_text)
+        rdvc_widgets['prescreen_check'].setChecked(False)
+        formLayout.setWidget(widgetno, QFormLayout.FieldRole, rdvc_widgets['prescreen_check'])
+        widgetno += 1
+
+        rdvc_widgets['prescreen_mode_label'] = QLabel(groupBox)
+        rdvc_widgets['prescreen_mode_label'].setText("Points below the volume fraction")
+        rdvc_widgets['prescreen_mode_label'].setToolTip(prescreen_text)
+        formLayout.setWidget(widgetno, QFormLayout.LabelRole, rdvc_widgets['prescreen_mode_label'])
+        rdvc_widgets['prescreen_mode_entry'] = QComboBox(groupBox)
+        rdvc_widgets['prescreen_mode_entry'].addItems(["Remove before the run", "Skip in dvc"])
+        rdvc_widgets['prescreen_mode_entry'].setToolTip(prescreen_text)
+        formLayout.setWidget(widgetno, QFormLayout.FieldRole, rdvc_widgets['prescreen_mode_entry'])
+        widgetno += 1
+
+        rdvc_widgets['gray_thresh_label'] = QLabel(groupBox)
+        rdvc_widgets['gray_thresh_label'].setText("Gray range")
+        rdvc_widgets['gray_thresh_label'].setToolTip("Minimum and maximum gray level, included, of the voxels counted in the volume fraction.")
+        formLayout.setWidget(widgetno, QFormLayout.LabelRole, rdvc_widgets['gray_thresh_label'])
+        gray_layout = QHBoxLayout()
+        gray_layout.setContentsMargins(0,0,0,0)
+        rdvc_widgets['gray_thresh_min_entry'] = QSpinBox(groupBox)
+        rdvc_widgets['gray_thresh_max_entry'] = QSpinBox(groupBox)
+        for entry, value in [(rdvc_widgets['gray_thresh_min_entry'], 27), (rdvc_widgets['gray_thresh_max_entry'], 127)]:
+            entry.setMaximum(65535)
+            entry.setValue(value)
+            entry.setToolTip("Minimum and maximum gray level, included, of the voxels counted in the volume fraction.")
+            gray_layout.addWidget(entry)
+        gray_widget = QWidget()
+        gray_widget.setLayout(gray_layout)
+        formLayout.setWidget(widgetno, QFormLayout.FieldRole, gray_widget)
+        widgetno += 1
+
+        rdvc_widgets['min_vol_fract_label'] = QLabel(groupBox)
+        rdvc_widgets['min_vol_fract_label'].setText("Minimum volume fraction")
+        rdvc_widgets['min_vol_fract_label'].setToolTip("The points are searched only if the fraction of their subvolume within the gray range is greater than this.")
+        formLayout.setWidget(widgetno, QFormLayout.LabelRole, rdvc_widgets['min_vol_fract_label'])
+        rdvc_widgets['min_vol_fract_entry'] = QDoubleSpinBox(groupBox)
+        rdvc_widgets['min_vol_fract_entry'].setMinimum(0.0)
+        rdvc_widgets['min_vol_fract_entry'].setMaximum(1.0)
+        rdvc_widgets['min_vol_fract_entry'].setSingleStep(0.05)
+        rdvc_widgets['min_vol_fract_entry'].setValue(0.2)
+        rdvc_widgets['min_vol_fract_entry'].setToolTip("The points are searched only if the fraction of their subvolume within the gray range is greater than this.")
+        formLayout.setWidget(widgetno, QFormLayout.FieldRole, rdvc_widgets['min_vol_fract_entry'])
+        widgetno += 1
+        prescreen_widgets = ['prescreen_mode_entry', 'gray_thresh_min_entry', 'gray_thresh_max_entry', 'min_vol_fract_entry']
+        for key in prescreen_widgets:
+            rdvc_widgets[key].setEnabled(False)
+        rdvc_widgets['prescreen_check'].stateChanged.connect(
+            lambda: [rdvc_widgets[key].setEnabled(rdvc_widgets['prescreen_check'].isChecked()) for key in prescreen_widgets])
+
         # Add horizonal seperator
         separators.append(QFrame(groupBox))
         separators[-1].setFrameShape(QFrame.HLine)
@@ -4215,8 +4672,16 @@ This parameter has a strong effect on computation time, so be careful."
         new_folder = os.path.join(results_folder, folder_name)
 
         if os.path.exists(new_folder):
+            run_config_file = os.path.join(new_folder, "_run_config.json")
+            if self.rdvc_widgets['resume_check'].isChecked() and os.path.exists(run_config_file):
+                os.chdir(tempfile.tempdir)
+                self.run_config_file = run_config_file
+                self.create_progress_window("Loading", "Resuming the run")
+                self.run_external_code(resume=True)
+                return
             self.warningDialog(window_title="Error", 
-                                message="This directory already exists. Please choose a different name." )
+                                message="This directory already exists. Please choose a different name, \
+or check Resume an interrupted run to complete the run with this name." )
             return
 
         self.config_worker = Worker(self.create_run_config)
@@ -4253,6 +4718,9 @@ This parameter has a strong effect on computation time, so be careful."
                 self.roi_files = [self.roi]
                 pointcloud_new_file = os.path.join(results_folder, folder_name, "_" + self.pointcloud_parameters['pointcloud_size_entry'].text() + ".roi")
                 shutil.copyfile(self.roi, pointcloud_new_file)
+                if self.rdvc_widgets['prescreen_check'].isChecked():
+                    # the points are removed from the copy in the run folder
+                    self.roi_files = [pointcloud_new_file]
                 
             else:
                 xmin = int(self.rdvc_widgets['points_in_subvol_range_min_value'].text())
@@ -4317,6 +4785,15 @@ This parameter has a strong effect on computation time, so be careful."
             if len(self.dvc_input_image[1]) > 1:
                 self.correlate_file = self.dvc_input_image[1]
 
+            subvol_thresh = 'off'
+            if self.rdvc_widgets['prescreen_check'].isChecked():
+                subvol_thresh = 'on'
+                if self.rdvc_widgets['prescreen_mode_entry'].currentIndex() == 0:
+                    if self.prescreenPointClouds(self.roi_files, self.subvol_sizes, message_callback):
+                        subvol_thresh = 'off'
+                    else:
+                        message_callback.emit("The reference image is not a raw file, dvc will skip the points instead")
+
             #print("REF: ", self.reference_file)
 
 
@@ -4340,11 +4817,13 @@ This parameter has a strong effect on computation time, so be careful."
             run_config['dof'] = self.rdvc_widgets['run_ndof_entry'].currentText()
             run_config['obj'] = self.rdvc_widgets['run_objf_entry'].currentText()
             run_config['interp_type'] = self.rdvc_widgets['run_iterp_type_entry'].currentText().lower()
+            run_config['shards'] = self.rdvc_widgets['run_shards_entry'].value()
+            run_config['subvol_thresh'] = subvol_thresh
+            run_config['gray_thresh_min'] = self.rdvc_widgets['gray_thresh_min_entry'].value()
+            run_config['gray_thresh_max'] = self.rdvc_widgets['gray_thresh_max_entry'].value()
+            run_config['min_vol_fract'] = self.rdvc_widgets['min_vol_fract_entry'].value()
 
-            if (hasattr(self, 'translate')):
-                run_config['rigid_trans'] = str(self.translate.GetTranslation()[0]*-1) + " " + str(self.translate.GetTranslation()[1]*-1) + " " + str(self.translate.GetTranslation()[2]*-1)
-            else:
-                run_config['rigid_trans']= "0.0 0.0 0.0"
+            run_config['rigid_trans'] = " ".join(str(t) for t in self.getRigidTranslation())
 
             self.run_folder = "Results/" + folder_name
             run_config['run_folder'] = self.run_folder
@@ -4371,7 +4850,34 @@ This parameter has a strong effect on computation time, so be careful."
             self.progress_window.close()
             #TODO: test this and see if we need to stop the worker, or if not returning anything is enough
 
-    def run_external_code(self, error = None):
+    def prescreenPointClouds(self, roi_files, subvol_sizes, message_callback):
+        '''Removes from the roi files the points whose subvolume has too small a fraction within the gray range
+
+        The fraction is computed on the reference image, which is mapped in memory.
+        The subvolume size is the one in the roi file if the points have one, 
+        otherwise the one of the run. The first point is always kept.
+        Returns False if the reference image is not a raw file, which can't be mapped.'''
+        if isinstance(self.reference_file, (list, tuple)):
+            return False
+        volume = open_raw_volume(self.reference_file, self.unsampled_image_dimensions, self.vol_bit_depth,
+            self.vol_hdr_lngth, "big" if self.image_info['isBigEndian'] else "little")
+        gray_range = (self.rdvc_widgets['gray_thresh_min_entry'].value(), self.rdvc_widgets['gray_thresh_max_entry'].value())
+        min_vol_fract = self.rdvc_widgets['min_vol_fract_entry'].value()
+        geometry = self.pointcloud_parameters['pointcloud_volume_shape_entry'].currentText().lower()
+        for roi_file, subvol_size in zip(roi_files, subvol_sizes):
+            points = read_numeric_table(roi_file, sidecar=False)
+            if len(points) == 0:
+                continue
+            sizes = points[:,4] if points.shape[1] > 4 else int(subvol_size)
+            message_callback.emit("Pre-screening the subvolumes of {}".format(os.path.basename(roi_file)))
+            keep = subvolume_fractions(volume, points[:,1:4], sizes, geometry, gray_range) > min_vol_fract
+            keep[0] = True
+            message_callback.emit("Removing {} of {} points of {}".format(np.count_nonzero(~keep), len(points), os.path.basename(roi_file)))
+            fmt = '%d\t%.3f\t%.3f\t%.3f' + '\t%d' * (points.shape[1] - 4)
+            write_numeric_table(roi_file, points[keep], fmt)
+        return True
+
+    def run_external_code(self, error = None, resume = False):
         if error == "subvolume error":
             self.progress_window.setValue(100)
             self.warningDialog("Minimum number of sampling points in subvolume value higher than maximum", window_title="Value Error")
@@ -4398,7 +4904,7 @@ The dimensionality of the pointcloud can also be changed in the Point Cloud pane
     
         # this command will call DVC_runner to create the directories
         self.dvc_runner = DVC_runner(self, os.path.abspath(self.run_config_file), 
-                                     self.finished_run, self.run_succeeded, tempfile.tempdir)
+                                     self.finished_run, self.run_succeeded, tempfile.tempdir, resume=resume)
 
         setup = Worker(self.dvc_runner.set_up)
         setup.signals.message.connect(self.updateProgressDialogMessage)
@@ -4760,6 +5266,8 @@ The dimensionality of the pointcloud can also be changed in the Point Cloud pane
 
 
     def SaveSession(self, text_value, compress, event):
+        # the mask is saved in the background
+        self.mask_writer.wait()
         # Save window geometry and state of dockwindows
         # https://doc.qt.io/qt-5/qwidget.html#saveGeometry
         g = self.saveGeometry()
@@ -4844,6 +5352,7 @@ The dimensionality of the pointcloud can also be changed in the Point Cloud pane
         if hasattr(self, 'translate'):
             if self.translate is not None:
                 self.config['reg_translation'] = (self.translate.GetTranslation()[0],self.translate.GetTranslation()[1],self.translate.GetTranslation()[2])
+                self.config['reg_subvoxel_translation'] = getattr(self, 'translate_subvoxel', None)
             else:
                 self.config['reg_translation'] = None
 
@@ -4870,6 +5379,12 @@ The dimensionality of the pointcloud can also be changed in the Point Cloud pane
         self.config['pc_rotx'] = pc['pointcloud_rotation_x_entry'].text()
         self.config['pc_roty'] = pc['pointcloud_rotation_y_entry'].text()
         self.config['pc_rotz'] = pc['pointcloud_rotation_z_entry'].text()
+        self.config['pc_lattice'] = pc['pointcloud_lattice_entry'].currentIndex()
+        self.config['pc_regions'] = pc['pointcloud_regions_check'].isChecked()
+        self.config['pc_region_settings'] = pc['pointcloud_regions_entry'].text()
+        self.config['pc_adaptive'] = pc['pointcloud_adaptive_check'].isChecked()
+        self.config['pc_texture_measure'] = pc['pointcloud_texture_measure_entry'].currentIndex()
+        self.config['pc_budget'] = pc['pointcloud_budget_entry'].value()
 
         #Downsampling level
         if self.settings.value("gpu_size") is not None: 
@@ -4972,8 +5487,17 @@ The dimensionality of the pointcloud can also be changed in the Point Cloud pane
         zip = zipfile.ZipFile(directory + '.zip', 'a')
 
         for r, d, f in os.walk(directory):
+            if r == directory and "Converted" in d:
+                # TIFF stacks converted to raw for the DVC runs can be converted again
+                d.remove("Converted")
+            # the eroded masks are kept, so that a reopened session doesn't erode the mask again,
+            # but not compressed, as the masks, to save the session quickly
+            eroded = r == os.path.join(directory, "Masks", "Eroded")
             for _file in f:
-                if compress:
+                if is_sidecar_file(_file):
+                    # binary copies of the result files are recreated when needed
+                    continue
+                if compress and os.path.splitext(_file)[1] != MASK_EXTENSION and not eroded:
                     compress_type = zipfile.ZIP_DEFLATED
                 else:
                     compress_type = zipfile.ZIP_STORED
@@ -5007,7 +5531,12 @@ The dimensionality of the pointcloud can also be changed in the Point Cloud pane
 
         temp_size = 0
         for dirpath, dirnames, filenames in os.walk(folder):
+            if dirpath == folder and "Converted" in dirnames:
+                # not saved, see ZipDirectory
+                dirnames.remove("Converted")
             for f in filenames:
+                if is_sidecar_file(f):
+                    continue
                 fp = os.path.join(dirpath, f)
                 #print(fp)
                 temp_size += os.path.getsize(fp)
@@ -5436,11 +5965,16 @@ Please select the new location of the file, or move it back to where it was orig
             #print(mask_folder)
             for r, d, f in os.walk(mask_folder):
                 for _file in f:
-                    if '.mha' in _file:
+                    if os.path.splitext(_file)[1] in ['.mha', MASK_EXTENSION]:
                         mask_files.append(_file)
+                # not the eroded masks cache
+                d.clear()
+            if "latest_selection.mha" in mask_files and LATEST_MASK not in mask_files:
+                # sessions saved by older versions, loadMask converts it
+                mask_files[mask_files.index("latest_selection.mha")] = LATEST_MASK
             self.mask_parameters['masksList'].addItems(mask_files)
             self.mask_parameters['masksList'].setEnabled(True)
-            self.mask_parameters['masksList'].setCurrentText("latest_selection.mha")
+            self.mask_parameters['masksList'].setCurrentText(LATEST_MASK)
             
         else:
             self.mask_parameters['masksList'].setEnabled(False)
@@ -5476,6 +6010,15 @@ Please select the new location of the file, or move it back to where it was orig
             pc['pointcloud_rotation_x_entry'].setText(str(self.config['pc_rotx']))
             pc['pointcloud_rotation_y_entry'].setText(str(self.config['pc_roty']))
             pc['pointcloud_rotation_z_entry'].setText(str(self.config['pc_rotz']))
+        if 'pc_lattice' in self.config:
+            pc['pointcloud_lattice_entry'].setCurrentIndex(self.config['pc_lattice'])
+        if 'pc_regions' in self.config:
+            pc['pointcloud_regions_check'].setChecked(self.config['pc_regions'])
+            pc['pointcloud_regions_entry'].setText(self.config['pc_region_settings'])
+        if 'pc_adaptive' in self.config:
+            pc['pointcloud_adaptive_check'].setChecked(self.config['pc_adaptive'])
+            pc['pointcloud_texture_measure_entry'].setCurrentIndex(self.config['pc_texture_measure'])
+            pc['pointcloud_budget_entry'].setValue(self.config['pc_budget'])
 
         #bring image loading panel to front if it isnt already:        
         self.select_image_dock.raise_()
@@ -19,19 +19,19 @@ from PySide2 import QtCore
 from datetime import datetime
 from PySide2.QtWidgets import QMessageBox
 import json
+import hashlib
 import time
 import shutil
 import platform
-from .io import save_tiff_stack_as_raw
+import re
+from functools import partial
+from .io import save_tiff_stack_as_raw, crop_raw_volume
 
 class PrintCallback(object):
     '''Class to handle the emit call when no callback is provided'''
     def emit(self, *args, **kwargs):
         print (args, kwargs)
 
-count = 0
-runs_completed = 0
-
 blank_config = '''###############################################################################
 #																	
 #
@@ -88,124 +88,366 @@ num_points_to_process   {num_points_to_process}  ### Number of points in the poi
 starting_point  {starting_point}    ### x,y,z location of starting point for DVC analysis
 '''
 
-def update_progress(main_window, process, total_points, required_runs, run_succeeded, start_time, num_points_to_process):
-    # print("Required runs", required_runs)
-    while(process.canReadLine()):
-        #print("READ")
-        string = process.readLine()  
-        line = str(string, "utf-8")
-        
-        global count
-        count+=1
-        #print("{:.0f} \n".format(count/(total_points+3*required_runs)*100))
-        if hasattr(main_window, 'progress_window'):
-            #print(count/(total_points+3*required_runs)*100)
-            # main_window.progress_window.setValue(count/(total_points+3*required_runs)*100)
+def count_lines(filename):
+    '''Returns the number of lines in a text file, e.g. the points in a roi file'''
+    with open(filename) as f:
+        return sum(1 for line in f)
+
+def split_roi_line(line):
+    '''Splits a line of a roi or disp file into the point number and the rest of the line'''
+    match = re.match(r'\s*(\S+)(.*)', line, re.S)
+    if match is None:
+        return None, line
+    return match.group(1), match.group(2)
+
+def read_roi_coordinates(filename):
+    '''Returns the (N, 3) coordinates of the points in a roi file and their subvolume sizes, 
+    or None if they don't have one'''
+    with open(filename) as f:
+        columns = [line.split() for line in f if line.strip() != '']
+    coords = np.asarray([c[1:4] for c in columns], dtype=np.float64).reshape(-1, 3)
+    if len(columns) > 0 and len(columns[0]) > 4:
+        return coords, np.asarray([c[4] for c in columns], dtype=np.float64)
+    return coords, None
+
+def crop_extent(low, high, dims, margin):
+    '''Extent (xmin, xmax, ymin, ymax, zmin, zmax), max excluded, of the voxels within
+    margin of the box from low to high, clipped to the volume'''
+    extent = []
+    for axis in range(3):
+        extent += [int(max(0, np.floor(low[axis] - margin[axis]))),
+                   int(min(dims[axis], np.ceil(high[axis] + margin[axis]) + 1))]
+    return extent
+
+def shift_roi_file(roi_file, output_filename, offset):
+    '''Writes the points of a roi file with their coordinates shifted by offset'''
+    with open(roi_file) as f:
+        columns = [line.split() for line in f if line.strip() != '']
+    with open(output_filename, "w") as f:
+        for c in columns:
+            coords = ["{:.3f}".format(float(v) + o) for v, o in zip(c[1:4], offset)]
+            f.write("\t".join([c[0]] + coords + c[4:]) + "\n")
+
+def shift_outputs(output_filename, offset, starting_point):
+    '''Shifts by offset the coordinates of the points in the disp file of a run
+    and sets its starting point in the stat file'''
+    disp_file = output_filename + ".disp"
+    with open(disp_file) as f:
+        lines = f.readlines()
+    with open(disp_file + ".part", "w") as f:
+        f.write(lines[0])
+        for line in lines[1:]:
+            c = line.split()
+            if len(c) < 4:
+                f.write(line)
+                continue
+            coords = [str(float(v) + o) for v, o in zip(c[1:4], offset)]
+            f.write("\t".join([c[0]] + coords + c[4:]) + "\n")
+    os.replace(disp_file + ".part", disp_file)
+
+    stat_file = output_filename + ".stat"
+    with open(stat_file) as f:
+        lines = f.readlines()
+    with open(stat_file, "w") as f:
+        for line in lines:
+            if line.split('\t')[0].strip() == 'starting_point':
+                line = "starting_point\t{} {} {}\n".format(*starting_point)
+            f.write(line)
+
+def split_point_cloud(coords, n_shards):
+    '''Splits the points in n_shards spatially coherent groups of similar size, 
+    by recursive bisection along the longest side of the bounding box.
+
+    Returns a list of sorted arrays of indices into coords.'''
+    def bisect(indices, n):
+        if n == 1:
+            return [np.sort(indices)]
+        pts = coords[indices]
+        axis = np.argmax(pts.max(axis=0) - pts.min(axis=0))
+        n_left = n // 2
+        split = int(round(len(indices) * n_left / n))
+        order = np.argsort(pts[:, axis], kind='stable')
+        return bisect(indices[order[:split]], n_left) + bisect(indices[order[split:]], n - n_left)
+    n_shards = max(1, min(n_shards, len(coords)))
+    return bisect(np.arange(len(coords)), n_shards)
+
+class ShardedResult(object):
+    '''Merges the outputs of the dvc processes run on the shards of a point cloud 
+    into the output of a single run, which RunResults can read'''
+    def __init__(self, run_folder, config_values):
+        self.run_folder = run_folder
+        self.output_filename = config_values['output_filename']
+        self.config_values = config_values
+        self.jobs = []
+        self.cache_key = None
+        # for each shard, the output filename, the line number in the original roi 
+        # file and the original point number of its points
+        self.shard_outputs = []
+        self.positions = []
+        self.point_numbers = []
+
+    def add_shard(self, job, output_filename, positions, point_numbers):
+        job.result = self
+        self.jobs.append(job)
+        self.shard_outputs.append(output_filename)
+        self.positions.append(positions)
+        self.point_numbers.append(point_numbers)
+
+    def is_done(self):
+        return all([job.is_done() for job in self.jobs])
+
+    def succeeded(self):
+        return all([job.status == 'succeeded' for job in self.jobs])
+
+    def merge(self):
+        '''Writes the disp and stat files of the whole point cloud.
+
+        The points are renumbered as in the original roi file and sorted in the
+        same order, so that point 0 is the first row.'''
+        header = None
+        rows = []
+        for output, positions, point_numbers in zip(self.shard_outputs, self.positions, self.point_numbers):
+            with open(output + ".disp") as f:
+                lines = f.readlines()
+            if header is None:
+                header = lines[0]
+            for line in lines[1:]:
+                number, rest = split_roi_line(line)
+                if number is None:
+                    continue
+                # the points in the shard roi files are numbered from 1
+                local = int(float(number)) - 1
+                if not rest.endswith('\n'):
+                    rest += '\n'
+                rows.append((positions[local], point_numbers[local] + rest))
+        rows.sort(key=lambda row: row[0])
+        with open(self.output_filename + ".disp", "w") as f:
+            f.write(header)
+            f.writelines([row[1] for row in rows])
+
+        # the stat file of the shard containing point 0 has the parameters of the run,
+        # the other shards are appended for reference
+        first = int(np.argmin([np.min(positions) for positions in self.positions]))
+        replace = ['point_cloud_filename', 'output_filename', 'num_points_to_process', 'starting_point', 'subvol_size']
+        with open(self.output_filename + ".stat", "w") as stat_file:
+            with open(self.shard_outputs[first] + ".stat") as f:
+                for line in f:
+                    key = line.split('\t')[0].strip()
+                    if key in replace:
+                        line = "{}\t{}\n".format(key, self.config_values[key])
+                    stat_file.write(line)
+            for i, output in enumerate(self.shard_outputs):
+                if i == first:
+                    continue
+                stat_file.write("\n### {}\n".format(os.path.basename(output)))
+                with open(output + ".stat") as f:
+                    stat_file.write(f.read())
+
+        for output in self.shard_outputs:
+            shutil.rmtree(os.path.dirname(output), ignore_errors=True)
+
+def file_fingerprint(filename, base_folder):
+    '''Returns a string identifying the content of a file from its path, size and modification time.
 
+    Paths in base_folder are relative, so that they still match when a session is reloaded.'''
+    if isinstance(filename, (list, tuple)):
+        return "\n".join([file_fingerprint(f, base_folder) for f in filename])
+    path = os.path.abspath(filename)
+    try:
+        if os.path.commonpath([path, base_folder]) == base_folder:
+            path = os.path.relpath(path, base_folder)
+    except ValueError:
+        # on different drives
+        pass
+    stat = os.stat(filename)
+    return "{}|{}|{}".format(path, stat.st_size, stat.st_mtime_ns)
+
+class ResultCache(object):
+    '''Session level cache of the outputs of dvc runs, indexed by the hash of their inputs.
+
+    The outputs are not copied in the cache, the index stores the output filename of
+    the run which computed them, relative to the session folder.'''
+    def __init__(self, session_folder):
+        self.session_folder = os.path.abspath(session_folder)
+        self.index_file = os.path.join(self.session_folder, "Results", "dvc_result_cache.json")
+        self.index = {}
+        if os.path.exists(self.index_file):
             try:
-                # try to infer the number of points processed from the output of the dvc executable
-                num_processed_points = int(string.split('/')[0])
-                etcs = 0
-                prog = 0
-                if num_processed_points > 0:
-                    prog = int(num_processed_points/num_points_to_process*100)-1
-                    etcs = ((time.time()-start_time) * num_points_to_process / num_processed_points) - (time.time()-start_time)
-                try:
-                    etc = time.strftime("%H:%M:%S s", time.gmtime(etcs))
-                except:
-                    etc = 'Error estimating time to completion'
+                with open(self.index_file) as f:
+                    self.index = json.load(f)
+            except Exception as err:
+                print ("Could not read the result cache", err)
 
-                ETC_line = "\nEstimated time to completion of this step {} ".format(etc)
-            except ValueError:
-                num_processed_points = 0
-                prog = 0
-                ETC_line = ''
-                
-            main_window.progress_window.setValue(prog)
-            label_text = main_window.progress_window.labelText().split("\n")[0]
-            main_window.progress_window.setLabelText(
-                    "{}\n{}{}".format(label_text, line, ETC_line))
-                
-        if line[:11] == "Input Error":
-            run_succeeded = False
-            if hasattr(main_window, 'progress_window'):
-                main_window.progress_window.setValue(100)
-            if hasattr(main_window, 'alert'):
-                main_window.alert.close() #finish fn triggers before update_progress so has already made an alert saying it succeeded
-            displayFileErrorDialog(main_window, line, "Error")
-            process.kill()
-            return
-    #sys.stdout.flush()
-
-def create_progress_window(main_window, title, text, max = 100, cancel = None):
-        main_window.progress_window = QProgressDialog(text, "Cancel", 0,max, main_window, QtCore.Qt.Window) 
-        main_window.progress_window.setWindowTitle(title)
-        main_window.progress_window.setWindowModality(QtCore.Qt.ApplicationModal) #This means the other windows can't be used while this is open
-        main_window.progress_window.setMinimumDuration(0.1)
-        main_window.progress_window.setWindowFlag(QtCore.Qt.WindowCloseButtonHint, False)
-        main_window.progress_window.setWindowFlag(QtCore.Qt.WindowMaximizeButtonHint, False)
-        if cancel is None:
-            main_window.progress_window.setCancelButton(None)
-        else:
-            main_window.progress_window.canceled.connect(cancel)
-
-def displayFileErrorDialog(main_window, message, title):
-    msg = QMessageBox(main_window)
-    msg.setIcon(QMessageBox.Critical)
-    msg.setWindowTitle(title)
-    msg.setText(message)
-    #msg.setDetailedText(main_window.e.ErrorMessage())
-    msg.exec_()
-
-def cancel_run(main_window, process, run_succeeded):
-    
-    if not run_succeeded:
-        # print ("run cancelled?")
-        process.kill()
-        main_window.alert = QMessageBox(QMessageBox.NoIcon,"Cancelled","The run was cancelled.", QMessageBox.Ok)  
-        main_window.alert.show()
-        run_succeeded = False
-    # else:
-    #     print ("all OK, all processes ended")
-
-
-def finished_run(main_window, exitCode, exitStatus, process = None, required_runs = 1, run_succeeded = False, finish_fn = None):
-    global runs_completed
-    runs_completed+=1
-    # print ("DVC command ended.", exitCode, exitStatus)
-    # print("Completed, ", runs_completed)
-
-    if run_succeeded:
-        if runs_completed == required_runs:
-            if hasattr(main_window, 'progress_window'):
-                main_window.progress_window.close()
-            main_window.alert = QMessageBox(QMessageBox.NoIcon,"Success","The DVC code ran successfully.", QMessageBox.Ok) 
-            main_window.alert.show()
-            if finish_fn is not None:
-                finish_fn()
-            runs_completed = 0
-            global count
-            count = 0
-    #print ("DVC command ended.", exitCode, exitStatus)
-    
-
-    # if( runs_completed >=  required_runs): #and  cancelled == False):
-    #     runs_completed = 0
-    # print("did")
+    def key(self, config_values, reference_file, correlate_file, n_shards=1):
+        '''Hashes the config of a run, with the input files replaced by their fingerprints'''
+        with open(config_values['point_cloud_filename'], 'rb') as f:
+            roi_hash = hashlib.sha256(f.read()).hexdigest()
+        values = dict(config_values,
+            reference_filename=file_fingerprint(reference_file, self.session_folder),
+            correlate_filename=file_fingerprint(correlate_file, self.session_folder),
+            point_cloud_filename=roi_hash,
+            output_filename='')
+        text = blank_config.format(**values) + "shards {}".format(n_shards)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def lookup(self, key):
+        '''Returns the output filename of a run with this key, if its outputs still exist'''
+        if key not in self.index:
+            return None
+        output = os.path.join(self.session_folder, self.index[key])
+        if os.path.exists(output + ".disp") and os.path.exists(output + ".stat"):
+            return output
+        return None
+
+    def store(self, key, output_filename):
+        output = os.path.relpath(os.path.abspath(output_filename), self.session_folder)
+        self.index[key] = output
+        with open(self.index_file, "w") as f:
+            json.dump(self.index, f)
+
+    def retrieve(self, cached_output, output_filename, config_values):
+        '''Links, or copies if links are not supported, the cached disp file to output_filename
+
+        The stat file is copied with the files of the run of config_values in place of
+        those of the run which computed it, so that it describes this run. Only the first
+        line of each is replaced, the stat files of the shards of a run follow its own.'''
+        try:
+            os.link(cached_output + ".disp", output_filename + ".disp")
+        except Exception:
+            shutil.copyfile(cached_output + ".disp", output_filename + ".disp")
+        replace = ['reference_filename', 'correlate_filename', 'point_cloud_filename', 'output_filename']
+        with open(cached_output + ".stat") as f:
+            lines = f.readlines()
+        with open(output_filename + ".stat", "w") as stat_file:
+            for line in lines:
+                key = line.split('\t')[0].strip()
+                if key in replace:
+                    replace.remove(key)
+                    line = "{}\t{}\n".format(key, config_values[key])
+                stat_file.write(line)
+
+def is_complete_result(output_filename, expected_points):
+    '''Checks whether the disp and stat files of a run exist and the disp has a row for each point'''
+    disp_file = output_filename + ".disp"
+    stat_file = output_filename + ".stat"
+    if not (os.path.exists(disp_file) and os.path.exists(stat_file)):
+        return False
+    if os.path.getsize(stat_file) == 0:
+        return False
+    try:
+        # the first line is the header
+        return count_lines(disp_file) - 1 >= expected_points
+    except Exception:
+        return False
+
+class RunManifest(object):
+    '''Status of each dvc_result_N folder of a run, saved in the run folder so 
+    that an interrupted run can be resumed'''
+    def __init__(self, run_folder):
+        self.filename = os.path.join(run_folder, "_run_manifest.json")
+        self.runs = {}
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename) as f:
+                    self.runs = json.load(f)
+            except Exception as err:
+                print ("Could not read the run manifest", err)
+
+    def get_status(self, name):
+        if name in self.runs:
+            return self.runs[name]['status']
+        return None
+
+    def set_status(self, name, status, error=None, cached=False, save=True):
+        self.runs[name] = {'status': status, 'error': error, 'cached': cached,
+            'time': datetime.now().isoformat(timespec='seconds')}
+        if save:
+            self.save()
+
+    def save(self):
+        try:
+            with open(self.filename, "w") as f:
+                json.dump(self.runs, f, indent=1)
+        except Exception as err:
+            print ("Could not save the run manifest", err)
+
+class DVCJob(object):
+    '''Holds the state of a single dvc process in a run'''
+    def __init__(self, exe_file, param_file, num_points_to_process, run_folder, label=None):
+        self.exe_file = exe_file
+        self.param_file = param_file
+        self.num_points_to_process = num_points_to_process
+        self.run_folder = run_folder
+        self.label = label
+        # set if the job runs on a shard of the point cloud
+        self.result = None
+        # hash of the inputs of the run, to store the outputs in the result cache
+        self.cache_key = None
+        self.cached = False
+        # completed in a previous, interrupted, execution of the run
+        self.resumed = False
+        self.process = None
+        # one of 'queued', 'running', 'succeeded', 'failed', 'cancelled'
+        self.status = 'queued'
+        self.start_time = None
+        self.num_processed_points = 0
+        self.last_line = ''
+        self.error = None
+
+    def progress(self):
+        '''Returns the percentage of completion of this job'''
+        if self.status in ['succeeded', 'failed', 'cancelled']:
+            return 100
+        if self.status == 'queued' or self.num_points_to_process <= 0:
+            return 0
+        return min(100, self.num_processed_points / self.num_points_to_process * 100)
+
+    def is_done(self):
+        return self.status in ['succeeded', 'failed', 'cancelled']
+
+    def run_name(self):
+        '''Name of the dvc_result folder, also for the jobs of a shard'''
+        if self.result is not None:
+            return os.path.basename(os.path.normpath(self.result.run_folder))
+        return os.path.basename(os.path.normpath(self.run_folder))
+
+    def name(self):
+        if self.label is not None:
+            return self.label
+        return os.path.basename(os.path.normpath(self.run_folder))
 
 class DVC_runner(object):
-    def __init__(self, main_window, input_file, finish_fn, run_succeeded, session_folder):
+    def __init__(self, main_window, input_file, finish_fn, run_succeeded, session_folder,
+                 omp_threads=None, max_concurrent_runs=None, shards=None, use_cache=True,
+                 resume=False, crop=True):
+        '''Creates and runs the dvc processes described in the run config input_file.
+
+        main_window can be None, in which case the progress is printed to the
+        console and omp_threads and max_concurrent_runs should be passed.
+        shards overrides the number of shards each point cloud is split into
+        set in the run config. If use_cache is True the outputs of runs with the
+        same inputs as a previous run in the session are reused. If resume is True
+        the dvc_result folders of the run which already have complete outputs are 
+        not run again. If crop is True dvc is given only the part of the volumes
+        which the search can reach from the points, see crop_bounds.'''
         # print("The session folder is", session_folder)
         self.main_window = main_window
         self.input_file = input_file
         self.finish_fn = finish_fn
         self.run_succeeded = run_succeeded
         self.session_folder = session_folder
+        self.omp_threads = omp_threads
+        self.max_concurrent_runs = max_concurrent_runs
+        self.shards = shards
+        self.use_cache = use_cache
+        self.resume = resume
+        self.crop = crop
 
     def set_up(self, *args, **kwargs):
 
         self.processes = []
         self.process_num = 0
+        self.cache = ResultCache(self.session_folder) if self.use_cache else None
         message_callback = kwargs.get('message_callback', PrintCallback())
         progress_callback = kwargs.get('progress_callback', PrintCallback())  
         
@@ -221,23 +463,20 @@ class DVC_runner(object):
         roi_files = config['roi_files']
         reference_file = config['reference_file']
         correlate_file = config['correlate_file']
+        # the original files, which identify the input in the result cache
+        reference_input = reference_file
+        correlate_input = correlate_file
         
         progress_callback.emit(10)
         # Convert to raw if files are a list of tiffs
         if isinstance(reference_file, (list, tuple)):
             message_callback.emit("Converting reference file to raw format")
-            base = os.path.abspath(self.session_folder)
-            raw_reference_file_fname = os.path.join(base, config['run_folder'], 'reference.raw')
-            save_tiff_stack_as_raw(reference_file, raw_reference_file_fname, progress_callback, 10, 50)
-            reference_file = raw_reference_file_fname
+            reference_file = self.convert_tiff_stack(reference_file, message_callback, progress_callback, 10, 50)
         progress_callback.emit(50)
 
         if isinstance(correlate_file, (list, tuple)):
             message_callback.emit("Converting correlate file to raw format")
-            base = os.path.abspath(self.session_folder)
-            raw_correlate_file_fname = os.path.join(base, config['run_folder'], 'correlate.raw')
-            save_tiff_stack_as_raw(correlate_file, raw_correlate_file_fname, progress_callback, 50, 90)
-            correlate_file = raw_correlate_file_fname
+            correlate_file = self.convert_tiff_stack(correlate_file, message_callback, progress_callback, 50, 90)
         progress_callback.emit(90)
 
         message_callback.emit("Creating run configurations")
@@ -261,8 +500,19 @@ class DVC_runner(object):
         interp_type = config['interp_type']
 
         rigid_trans = config['rigid_trans']
+        # dvc skips the points whose subvolume is mostly outside the gray range if subvol_thresh is on
+        subvol_thresh = config.get('subvol_thresh', 'off')
+        gray_thresh_min = config.get('gray_thresh_min', '27')
+        gray_thresh_max = config.get('gray_thresh_max', '127')
+        min_vol_fract = config.get('min_vol_fract', '0.2')
         starting_point = config['point0_world_coordinate']
 
+        # number of shards each point cloud is split into, to run in parallel
+        if self.shards is not None:
+            n_shards = int(self.shards)
+        else:
+            n_shards = int(config.get('shards', 1))
+
         # Change directory into the folder where the run will be saved:
         os.chdir(self.session_folder)
         # this is the one directory we created where we will run the dvc command in
@@ -270,11 +520,22 @@ class DVC_runner(object):
         # all the directory created https://github.com/TomographicImaging/iDVC/issues/37
         # see also https://github.com/TomographicImaging/iDVC/pull/69
         self.run_folder = config['run_folder']
+        self.manifest = RunManifest(self.run_folder)
 
-        #running the code:
+        # the coordinates of the points in the cropped volumes are shifted by -crop_offset
+        self.crop_offset = None
+        self.starting_point = starting_point
+        if self.crop:
+            extent = self.crop_bounds(roi_files, dims, subvolume_sizes, disp_max, rigid_trans)
+            if extent is not None:
+                self.crop_offset = extent[::2]
+                crop_dims = [extent[1] - extent[0], extent[3] - extent[2], extent[5] - extent[4]]
+                crop_values = dict(vol_hdr_lngth=0, vol_wide=crop_dims[0], vol_high=crop_dims[1], vol_tall=crop_dims[2],
+                    starting_point='{} {} {}'.format(*[p - o for p, o in zip(starting_point, self.crop_offset)]))
+        # the volumes are cropped for the first run which is not found in the cache
+        cropped_files = None
 
-        # this should be renamed to num_optimisations
-        required_runs = len(subvolume_points)*len(subvolume_sizes)   
+        #running the code:
 
         # check for the extension
         if platform.system() in ['Linux', 'Darwin']:    
@@ -284,27 +545,6 @@ class DVC_runner(object):
         else:
             raise ValueError('Not supported platform, ', platform.system())
         
-        total_points = 0
-        for cloud in roi_files:
-            i=0
-            with open(cloud) as f:
-                for i, l in enumerate(f):
-                    pass
-            i+=1
-            #print(i)
-            if i < points:
-                total_points += i
-            else:
-                total_points += points
-
-        total_points = total_points * len(subvolume_points)
-
-        #print("Total points", total_points)
-
-        #process.readyRead.connect(lambda: update_progress(main_window, process, total_points, 
-        #    required_runs, run_succeeded))
-        
-
         start_progress = 90
         end_progress = 99
         file_count = -1
@@ -322,8 +562,24 @@ class DVC_runner(object):
                 counter = subv_num + roi_num * len(subvolume_points)
                 
                 this_run_folder = os.path.join(self.run_folder, "dvc_result_{}".format(counter))
-                os.mkdir(this_run_folder)
                 output_filename = os.path.join(this_run_folder, "dvc_result_{}".format(counter))
+                if self.resume and os.path.isdir(this_run_folder):
+                    expected_points = min(num_points_to_process, count_lines(roi_file))
+                    # the outputs of a cancelled or running run may have all their rows,
+                    # and those of a cropped run are complete only once they are shifted back
+                    done = self.manifest.get_status(os.path.basename(this_run_folder)) == 'succeeded'
+                    if done and is_complete_result(output_filename, expected_points):
+                        message_callback.emit("Resuming: dvc_result_{} is already complete".format(counter))
+                        job = DVCJob(exe_file, [ os.path.join(this_run_folder, "dvc_config.txt") ], 
+                            num_points_to_process, this_run_folder)
+                        job.status = 'succeeded'
+                        job.resumed = True
+                        self.processes.append(job)
+                        self.manifest.set_status(job.run_name(), 'succeeded', save=False)
+                        continue
+                    # incomplete or failed, run it again from scratch
+                    shutil.rmtree(this_run_folder)
+                os.mkdir(this_run_folder)
                 config_filename = os.path.join(this_run_folder,"dvc_config.txt")
                 
                 grid_roi_fname = os.path.join(this_run_folder, "grid_input.roi")
@@ -332,11 +588,15 @@ class DVC_runner(object):
                     shutil.copyfile(roi_file, grid_roi_fname)
                 except Exception as err:
                     # this is not really a nice way to open an error message!
-                    self.main_window.displayFileErrorDialog(message=str(err), title="Error creating config files")
+                    if self.main_window is not None:
+                        self.main_window.displayFileErrorDialog(message=str(err), title="Error creating config files")
+                    else:
+                        print ("Error creating config files", err)
+                    self.run_succeeded = False
                     return
                 
                 
-                config =  blank_config.format(
+                config_values = dict(
                     reference_filename=  reference_file, # reference tomography image volume
                     correlate_filename=  correlate_file, # correlation tomography image volume
                     point_cloud_filename = grid_roi_fname,
@@ -350,10 +610,10 @@ class DVC_runner(object):
                     subvol_geom=  subvol_geom,
                     subvol_size=  subvolume_size, 
                     subvol_npts= subvolume_point,
-                    subvol_thresh='off',
-                    gray_thresh_min='27',
-                    gray_thresh_max='127',
-                    min_vol_fract='0.2',
+                    subvol_thresh=subvol_thresh,
+                    gray_thresh_min=gray_thresh_min,
+                    gray_thresh_max=gray_thresh_max,
+                    min_vol_fract=min_vol_fract,
                     disp_max=  disp_max, #38 for test image
                     num_srch_dof=  dof, #6 for test image
                     obj_function=  obj, 
@@ -362,7 +622,8 @@ class DVC_runner(object):
                     basin_radius='0.0',
                     subvol_aspect='1.0 1.0 1.0',# image spacing
                     num_points_to_process=num_points_to_process, 
-                    starting_point='{} {} {}'.format(*starting_point)) 
+                    starting_point='{} {} {}'.format(*starting_point))
+                config =  blank_config.format(**config_values)
                 time.sleep(1)
                 with open(config_filename,"w") as config_file:
                     config_file.write(config)
@@ -377,108 +638,501 @@ class DVC_runner(object):
                 # wait for process to finish before doing next run
                 
                 # process.waitForFinished(msecs=2147483647)
-                self.processes.append( 
-                    (exe_file, [ config_filename ], required_runs, total_points, num_points_to_process)
-                )
+                run_name = os.path.basename(this_run_folder)
+                sharded = n_shards > 1 and num_points_to_process >= count_lines(grid_roi_fname)
+                if n_shards > 1 and not sharded:
+                    message_callback.emit("Not splitting {}: only part of the point cloud is processed".format(run_name))
+                # the points with different subvolume sizes are run separately, as shards
+                num_points = None
+                point_sizes = read_roi_coordinates(grid_roi_fname)[1]
+                if point_sizes is not None:
+                    point_sizes = np.unique(point_sizes[:num_points_to_process])
+                if point_sizes is not None and (sharded or len(point_sizes) > 1):
+                    if not sharded and num_points_to_process < count_lines(grid_roi_fname):
+                        message_callback.emit("Processing the first {} points of {}".format(num_points_to_process, run_name))
+                        num_points = num_points_to_process
+                    sharded = True
+                elif point_sizes is not None and len(point_sizes) == 1 and int(point_sizes[0]) != config_values['subvol_size']:
+                    # a single process runs the points, which all have the same subvolume size
+                    config_values['subvol_size'] = int(point_sizes[0])
+                    with open(config_filename,"w") as config_file:
+                        config_file.write(blank_config.format(**config_values))
+
+                cache_key = None
+                if self.cache is not None:
+                    cache_key = self.cache.key(config_values, reference_input, correlate_input,
+                        n_shards if sharded else 1)
+                    cached_output = self.cache.lookup(cache_key)
+                    if cached_output is not None:
+                        message_callback.emit("Cache hit for {}: using the results of {}".format(
+                            run_name, os.path.relpath(cached_output, self.cache.session_folder)))
+                        self.cache.retrieve(cached_output, output_filename, config_values)
+                        job = DVCJob(exe_file, [ config_filename ], num_points_to_process, this_run_folder)
+                        job.status = 'succeeded'
+                        job.cached = True
+                        self.processes.append(job)
+                        self.manifest.set_status(run_name, 'succeeded', cached=True, save=False)
+                        continue
+                    message_callback.emit("Cache miss for {}".format(run_name))
+
+                # dvc runs on the cropped volumes, the config of a run found in the 
+                # cache stays that of the full volumes, as its outputs
+                if self.crop_offset is not None:
+                    if cropped_files is None:
+                        cropped_files = self.crop_volumes(reference_file, correlate_file, dims, vol_bit_depth,
+                            vol_hdr_lngth, endian, extent, message_callback)
+                    shift_roi_file(roi_file, grid_roi_fname, [-o for o in self.crop_offset])
+                    config_values.update(crop_values, reference_filename=cropped_files[0], 
+                        correlate_filename=cropped_files[1])
+                    with open(config_filename,"w") as config_file:
+                        config_file.write(blank_config.format(**config_values))
+
+                if sharded:
+                    # the config of the whole run is kept for reference, the dvc
+                    # processes run on the shards and their outputs are merged
+                    jobs = self.create_shards(exe_file, this_run_folder, config_values, n_shards, num_points)
+                    jobs[0].result.cache_key = cache_key
+                    self.processes += jobs
+                else:
+                    job = DVCJob(exe_file, [ config_filename ], num_points_to_process, this_run_folder)
+                    job.cache_key = cache_key
+                    self.processes.append(job)
+                self.manifest.set_status(run_name, 'queued', save=False)
                 progress_callback.emit(int(start_progress + (end_progress - start_progress) * (subv_num / len(roi_files))))
             progress_callback.emit(100)
-                
+        self.manifest.save()
         
+    def convert_tiff_stack(self, tiff_files, message_callback, progress_callback, start_progress, end_progress):
+        '''Converts a TIFF stack to a raw file, only once per session.
+
+        The raw files are saved in the Converted folder of the session, named after 
+        the hash of the paths, sizes and modification times of the TIFF files, and 
+        are reused by all the runs with the same stack.'''
+        base = os.path.abspath(self.session_folder)
+        key = hashlib.sha256(file_fingerprint(tiff_files, base).encode('utf-8')).hexdigest()
+        folder = os.path.join(base, "Converted")
+        raw_file = os.path.join(folder, key + ".raw")
+        if os.path.exists(raw_file):
+            message_callback.emit("Using the raw file converted in a previous run")
+            return raw_file
+        os.makedirs(folder, exist_ok=True)
+        # write to a temporary file, so an interrupted conversion is not reused
+        part_file = raw_file + ".part"
+        save_tiff_stack_as_raw(tiff_files, part_file, progress_callback, start_progress, end_progress)
+        os.replace(part_file, raw_file)
+        return raw_file
+
+    def crop_bounds(self, roi_files, dims, subvolume_sizes, disp_max, rigid_trans, max_ratio=0.5):
+        '''Extent of the part of the reference and correlate volumes which dvc can read
+
+        This is the bounding box of the points of all the roi files, padded by the
+        largest subvolume, rotated in any direction, the maximum displacement and
+        the rigid translation. The volumes are not cropped if the box is more than
+        max_ratio of their volume.
+        Returns the extent, see crop_extent, or None if they are not cropped.'''
+        low, high = np.full(3, np.inf), np.full(3, -np.inf)
+        max_size = max([float(size) for size in subvolume_sizes])
+        for roi_file in roi_files:
+            coords, sizes = read_roi_coordinates(roi_file)
+            if len(coords) == 0:
+                continue
+            low = np.minimum(low, coords.min(axis=0))
+            high = np.maximum(high, coords.max(axis=0))
+            if sizes is not None:
+                max_size = max(max_size, sizes.max())
+        if not np.all(np.isfinite(low)):
+            return None
+        # 2 voxels for the interpolation
+        margin = [np.ceil(max_size / 2 * np.sqrt(3)) + disp_max + np.ceil(abs(float(t))) + 2 
+            for t in rigid_trans.split()]
+        extent = crop_extent(low, high, dims, margin)
+        crop_dims = [extent[1] - extent[0], extent[3] - extent[2], extent[5] - extent[4]]
+        if np.prod(crop_dims, dtype=np.float64) > max_ratio * np.prod(dims, dtype=np.float64):
+            return None
+        return extent
+
+    def crop_volumes(self, reference_file, correlate_file, dims, vol_bit_depth, vol_hdr_lngth, endian,
+                     extent, message_callback):
+        '''Writes the voxels of the reference and correlate volumes within extent to raw files in the run folder
+
+        Returns the cropped reference and correlate files.'''
+        crop_dims = [extent[1] - extent[0], extent[3] - extent[2], extent[5] - extent[4]]
+        cropped = []
+        for name, filename in [("reference", reference_file), ("correlate", correlate_file)]:
+            crop_file = os.path.join(self.run_folder, "{}_crop.raw".format(name))
+            expected_size = int(np.prod(crop_dims, dtype=np.int64)) * (vol_bit_depth // 8)
+            # the crop is reused when resuming a run
+            if not (os.path.exists(crop_file) and os.path.getsize(crop_file) == expected_size):
+                message_callback.emit("Cropping the {} volume to {} x {} x {}".format(name, *crop_dims))
+                crop_raw_volume(filename, crop_file, dims, vol_bit_depth, vol_hdr_lngth, endian, extent)
+            cropped.append(os.path.abspath(crop_file))
+        return cropped
+
+    def restore_crop(self, output_filename):
+        '''Shifts the outputs of a run on cropped volumes back to the coordinates of the full volumes'''
+        if self.crop_offset is not None:
+            shift_outputs(output_filename, self.crop_offset, self.starting_point)
+
+    def create_shards(self, exe_file, run_folder, config_values, n_shards, num_points=None):
+        '''Splits the point cloud of a run in n_shards and writes the config of each shard
+
+        If the points have their own subvolume size, the points of each size are
+        split in n_shards, which are run with that subvolume size. Only the first
+        num_points points are used, if it is passed.
+        Each shard is run in a subfolder of the run folder, with the point closest
+        to point 0 as starting point. Returns the jobs of the shards.'''
+        with open(config_values['point_cloud_filename']) as f:
+            lines = [line for line in f if line.strip() != '']
+        if num_points is not None:
+            lines = lines[:num_points]
+        split = [split_roi_line(line) for line in lines]
+        point_numbers = [number for number, rest in split]
+        columns = [rest.split() for number, rest in split]
+        coords = np.asarray([c[:3] for c in columns], dtype=np.float64)
+
+        # the points of each subvolume size are run separately
+        groups = {}
+        for index, c in enumerate(columns):
+            size = int(float(c[3])) if len(c) > 3 else config_values['subvol_size']
+            groups.setdefault(size, []).append(index)
+        shards = []
+        for size, group in groups.items():
+            group = np.asarray(group)
+            shards += [(size, group[indices]) for indices in split_point_cloud(coords[group], n_shards)]
+
+        result = ShardedResult(run_folder, config_values)
+        run_name = os.path.basename(os.path.normpath(run_folder))
+        jobs = []
+        for k, (size, indices) in enumerate(shards):
+            # start from the point closest to point 0, which is the first point of the cloud
+            distance = np.sum((coords[indices] - coords[0])**2, axis=1)
+            first = int(np.argmin(distance))
+            indices = np.concatenate(([indices[first]], np.delete(indices, first)))
+            if indices[0] == 0:
+                starting_point = config_values['starting_point']
+            else:
+                starting_point = '{} {} {}'.format(*coords[indices[0]])
+
+            shard_folder = os.path.join(run_folder, "shard_{}".format(k))
+            os.mkdir(shard_folder)
+            shard_roi = os.path.join(shard_folder, "grid_input.roi")
+            # dvc reads the point number and coordinates only
+            with open(shard_roi, "w") as f:
+                f.writelines(["{}\t{}\n".format(i + 1, "\t".join(columns[index][:3])) 
+                    for i, index in enumerate(indices)])
+
+            shard_output = os.path.join(shard_folder, "{}_shard_{}".format(run_name, k))
+            shard_config = os.path.join(shard_folder, "dvc_config.txt")
+            with open(shard_config, "w") as config_file:
+                config_file.write(blank_config.format(**dict(config_values,
+                    point_cloud_filename=shard_roi,
+                    output_filename=shard_output,
+                    num_points_to_process=len(indices),
+                    subvol_size=size,
+                    starting_point=starting_point)))
+
+            job = DVCJob(exe_file, [ shard_config ], len(indices), shard_folder,
+                label="{}/shard_{}".format(run_name, k))
+            result.add_shard(job, shard_output, indices, [point_numbers[i] for i in indices])
+            jobs.append(job)
+        return jobs
+
     def run_dvc(self, **kwargs):
-        main_window = self.main_window
-        input_file = self.input_file
-        finish_fn = self.finish_fn
-        run_succeeded = self.run_succeeded
-        
-        process = QtCore.QProcess()
-        
-        env = QtCore.QProcessEnvironment.systemEnvironment()
+        '''Starts the dvc processes created in set_up.
+
+        At most max_concurrent_runs processes run at the same time, the
+        OMP threads set in the settings are shared between them. When a
+        process finishes the next queued one is started.'''
+        max_concurrent_runs = self.get_max_concurrent_runs()
+        total_threads = self.get_omp_threads()
+        # jobs whose results were found in the cache are already completed
+        self.queue = [job for job in self.processes if job.status == 'queued']
+        n_concurrent = max(1, min(max_concurrent_runs, len(self.queue)))
+        self.threads_per_run = max(1, total_threads // n_concurrent)
+        self.cancelled = False
+        self.finished = False
+        self.last_printed_progress = -1
+        self.start_time = time.time()
+
+        self.create_progress_window("Running",
+            "Running DVC code 0/{}".format(len(self.processes)), 100,
+            self.onCancel)
+
+        if len(self.queue) == 0:
+            self.finish_run()
+            return
+
+        for i in range(n_concurrent):
+            self.start_next_job()
+
+    def get_max_concurrent_runs(self):
+        '''Number of dvc processes allowed to run at the same time'''
+        if self.max_concurrent_runs is not None:
+            return max(1, int(self.max_concurrent_runs))
         try:
-            nthreads = main_window.settings.value('omp_threads')
+            max_runs = int(self.main_window.settings.value('dvc_concurrent_runs'))
         except Exception as err:
-            nthreads = '4'
+            max_runs = 1
             print (err)
-        env.insert("OMP_NUM_THREADS", nthreads)
-        process.setProcessEnvironment(env)
+        return max(1, max_runs)
 
-        # print("Processes: ", self.processes)
-        # print("num: ", self.process_num)        
+    def get_omp_threads(self):
+        '''Total number of OMP threads to share between the running dvc processes'''
+        if self.omp_threads is not None:
+            return max(1, int(self.omp_threads))
+        try:
+            nthreads = int(self.main_window.settings.value('omp_threads'))
+        except Exception as err:
+            nthreads = 4
+            print (err)
+        return max(1, nthreads)
+
+    def running_jobs(self):
+        return [job for job in self.processes if job.status == 'running']
 
-        # start time
-        start_time = time.time()
+    def killed_jobs(self):
+        '''The cancelled jobs whose process has not exited yet'''
+        return [job for job in self.processes if job.status == 'cancelled' and job.process is not None
+            and job.process.state() != QtCore.QProcess.NotRunning]
 
-        exe_file, param_file, required_runs,\
-            total_points, num_points_to_process = self.processes[self.process_num]
+    def start_next_job(self):
+        '''Starts the first queued job, if any'''
+        if len(self.queue) == 0 or self.cancelled:
+            return
+        job = self.queue.pop(0)
 
+        process = QtCore.QProcess()
+        env = QtCore.QProcessEnvironment.systemEnvironment()
+        env.insert("OMP_NUM_THREADS", str(self.threads_per_run))
+        process.setProcessEnvironment(env)
         process.setWorkingDirectory(os.getcwd())
-        # process.finished.connect(partial(finished_run, main_window, 
-        #             process = process, required_runs = required_runs, 
-        #             run_succeeded = run_succeeded, finish_fn = finish_fn))
-        process.finished.connect(self.finished_run)
+
+        job.process = process
+        job.status = 'running'
+        job.start_time = time.time()
+
+        process.finished.connect(partial(self.finished_run, job))
+        process.errorOccurred.connect(partial(self.onProcessError, job))
         process.started.connect(self.onStarted)
-        if self.process_num == 0:
-            main_window.create_progress_window("Running", 
-                "Running DVC code {}/{}".format(self.process_num +1, len(self.processes)), 100,
-                #lambda: cancel_run(main_window, process, run_succeeded)
-                lambda: self.onCancel(process)
-                )
+        process.readyRead.connect(partial(self.update_progress, job))
+        process.start(job.exe_file, job.param_file)
+        self.update_manifest(job)
+        self.update_progress_window()
+
+    def update_progress(self, job):
+        '''Reads the output of the dvc process of a job and updates the progress'''
+        process = job.process
+        while(process.canReadLine()):
+            string = process.readLine()
+            line = str(string, "utf-8").rstrip()
+            if line == '':
+                continue
+            job.last_line = line
+            try:
+                # try to infer the number of points processed from the output of the dvc executable
+                job.num_processed_points = int(line.split('/')[0])
+            except ValueError:
+                pass
+
+            if line[:11] == "Input Error":
+                job.error = line
+                process.kill()
+                break
+        self.update_progress_window(job)
+
+    def update_progress_window(self, job=None):
+        '''Shows the aggregated progress of all the jobs in the progress window'''
+        total = len(self.processes)
+        if total == 0:
+            return
+        prog = sum([j.progress() for j in self.processes]) / total
+        completed = len([j for j in self.processes if j.is_done()])
+        running = len(self.running_jobs())
+
+        etc_line = ''
+        if prog > 0:
+            elapsed = time.time() - self.start_time
+            etcs = elapsed * 100 / prog - elapsed
+            try:
+                etc = time.strftime("%H:%M:%S s", time.gmtime(etcs))
+            except:
+                etc = 'Error estimating time to completion'
+            etc_line = "\nEstimated time to completion {} ".format(etc)
+
+        label_text = "Running DVC code {}/{} completed, {} running".format(
+            completed, total, running)
+        cached = len([j for j in self.processes if j.cached])
+        if cached > 0:
+            label_text += ", {} from cache".format(cached)
+        if job is not None and job.last_line != '':
+            label_text += "\n{}: {}".format(job.name(), job.last_line)
+        label_text += etc_line
+        # keep the progress bar below 100 until the very end, as it would close the window
+        self.set_progress(min(99, int(prog)), label_text)
+
+    def create_progress_window(self, title, text, max=100, cancel=None):
+        if self.main_window is not None:
+            self.main_window.create_progress_window(title, text, max, cancel)
         else:
-            main_window.progress_window.setLabelText(
-                "Running DVC code {}/{}".format(self.process_num +1, len(self.processes))
-            )
-            main_window.progress_window.canceled.connect(lambda: self.onCancel(process))
-        process.readyRead.connect(
-            lambda: update_progress(main_window, process, total_points, required_runs,\
-                                    run_succeeded, start_time, num_points_to_process))
-        # process.finished.connect(self.run_dvc())
-        process.start( exe_file , param_file )
+            print (text)
+
+    def set_progress(self, value, text):
+        main_window = self.main_window
+        if main_window is None:
+            # only print when the percentage changes, not at every line of output
+            if value != self.last_printed_progress:
+                self.last_printed_progress = value
+                print ("{}% {}".format(value, text.replace("\n", " - ")))
+        elif hasattr(main_window, 'progress_window'):
+            main_window.progress_window.setValue(value)
+            main_window.progress_window.setLabelText(text)
 
     def onStarted(self):
         pass
 
-    def onCancel(self, process):
+    def onProcessError(self, job, error):
+        '''If a process fails to start the finished signal is not emitted'''
+        if error == QtCore.QProcess.FailedToStart:
+            job.error = "Failed to start {}".format(job.exe_file)
+            self.finished_run(job, -1, QtCore.QProcess.CrashExit)
+
+    def onCancel(self):
+        '''Kills all the running dvc processes and drops the queued ones'''
         main_window = self.main_window
-        run_succeeded = self.run_succeeded
-        state = process.state()
-        # print ("Process state", state)
-        if state in [2,1]:
-            # print ("Cancelling run")
-            process.kill()
+        # closing the progress window at the end of the run also emits canceled
+        if self.cancelled or self.finished:
+            return
+        self.cancelled = True
+        self.run_succeeded = False
+        for job in self.queue:
+            job.status = 'cancelled'
+        self.queue = []
+        running = self.running_jobs()
+        for job in running:
+            job.status = 'cancelled'
+            job.process.kill()
+        for job in self.processes:
+            self.update_manifest(job)
+        if main_window is not None:
             main_window.alert = QMessageBox(QMessageBox.NoIcon,"Cancelled","The run was cancelled.", QMessageBox.Ok)  
             main_window.alert.show()
-            self.run_succeeded = False
-        elif state == 0:
-            print ("all OK, all processes ended")
+        if len(running) == 0:
+            self.finish_run()
 
-    def finished_run(self, exitCode, exitStatus):
-        main_window = self.main_window
-        input_file = self.input_file
-        finish_fn = self.finish_fn
-        run_succeeded = self.run_succeeded
-        required_runs = self.processes[self.process_num][2]
-
-        print("finished {}/{} (or {}) with {} {}"
-              .format(self.process_num + 1, required_runs,
-                len(self.processes), exitCode, exitStatus))
-        
-        if exitStatus == 0:
-            self.run_succeeded = self.run_succeeded and True
-        else:
-            self.run_succeeded = self.run_succeeded and False
-            
-        if self.process_num == required_runs-1:
-            main_window.progress_window.close()
-            if self.run_succeeded:
-                main_window.alert = QMessageBox(QMessageBox.NoIcon,
-                    "Success","The DVC code ran successfully.", QMessageBox.Ok)
+    def finished_run(self, job, exitCode, exitStatus):
+        if job.is_done() and job.status != 'cancelled':
+            # already handled, e.g. failed to start
+            return
+        print("finished {} with {} {}".format(job.name(), exitCode, exitStatus))
+
+        if job.status != 'cancelled':
+            if exitStatus == 0 and exitCode == 0 and job.error is None:
+                job.status = 'succeeded'
             else:
-                main_window.alert = QMessageBox(QMessageBox.NoIcon,
-                    "Fail","The DVC code had some troubles.", QMessageBox.Ok) 
-            main_window.alert.show()
-            if finish_fn is not None:
-                finish_fn() 
+                job.status = 'failed'
+                if job.error is None:
+                    job.error = "Exit code {}".format(exitCode)
+        if job.result is not None and job.result.is_done() and job.result.succeeded():
+            try:
+                job.result.merge()
+                self.restore_crop(job.result.output_filename)
+                self.store_in_cache(job.result.cache_key, job.result.output_filename)
+            except Exception as err:
+                job.status = 'failed'
+                job.error = "Error merging the shards of {}: {}".format(
+                    os.path.basename(job.result.run_folder), err)
+        elif job.result is None and job.status == 'succeeded':
+            output_filename = os.path.join(job.run_folder, os.path.basename(os.path.normpath(job.run_folder)))
+            try:
+                self.restore_crop(output_filename)
+                self.store_in_cache(job.cache_key, output_filename)
+            except Exception as err:
+                job.status = 'failed'
+                job.error = "Error shifting the outputs of {} to the full volume: {}".format(job.name(), err)
+        self.run_succeeded = self.run_succeeded and job.status == 'succeeded'
+        self.update_manifest(job)
+
+        self.start_next_job()
+        if self.cancelled:
+            # each killed process emits finished, the run ends when the last one exits
+            if len(self.killed_jobs()) == 0:
+                self.finish_run()
+        elif len(self.running_jobs()) == 0 and len(self.queue) == 0:
+            self.finish_run()
+        else:
+            self.update_progress_window()
+
+    def update_manifest(self, job):
+        '''Records the status of the dvc_result folder of a job in the run manifest'''
+        if job.resumed:
+            return
+        if job.result is None:
+            jobs = [job]
+        else:
+            jobs = job.result.jobs
+        statuses = [j.status for j in jobs]
+        if 'failed' in statuses:
+            status = 'failed'
+        elif 'cancelled' in statuses:
+            status = 'cancelled'
+        elif all([st == 'succeeded' for st in statuses]):
+            status = 'succeeded'
+        elif 'running' in statuses or 'succeeded' in statuses:
+            status = 'running'
         else:
-            self.process_num += 1
-            self.run_dvc()
+            status = 'queued'
+        errors = [j.error for j in jobs if j.error is not None]
+        self.manifest.set_status(job.run_name(), status, 
+            error="; ".join(errors) if len(errors) > 0 else None, cached=job.cached)
+
+    def store_in_cache(self, key, output_filename):
+        if self.cache is None or key is None:
+            return
+        try:
+            self.cache.store(key, output_filename)
+        except Exception as err:
+            print ("Could not store the result in the cache", err)
 
-            
\ No newline at end of file
+    def finish_run(self):
+        '''Closes the progress window, reports a summary of the run and calls finish_fn'''
+        main_window = self.main_window
+        if self.finished:
+            return
+        self.finished = True
+        # the cropped volumes are needed only while dvc runs, they are kept if the run can be resumed
+        if self.crop_offset is not None and all([job.status == 'succeeded' for job in self.processes]):
+            for name in ["reference", "correlate"]:
+                try:
+                    os.remove(os.path.join(self.session_folder, self.run_folder, "{}_crop.raw".format(name)))
+                except OSError:
+                    pass
+        failed = [job for job in self.processes if job.status == 'failed']
+        succeeded = [job for job in self.processes if job.status == 'succeeded']
+        summary = "{} of {} DVC runs succeeded.".format(len(succeeded), len(self.processes))
+        cached = len([job for job in self.processes if job.cached])
+        if cached > 0:
+            summary += "\n{} of them were found in the result cache.".format(cached)
+        resumed = len([job for job in self.processes if job.resumed])
+        if resumed > 0:
+            summary += "\n{} of them were completed in a previous execution.".format(resumed)
+        detailed_text = "\n".join(["{}: {}".format(job.name(), job.error) for job in failed])
+
+        if main_window is not None:
+            if hasattr(main_window, 'progress_window'):
+                main_window.progress_window.setValue(100)
+                main_window.progress_window.close()
+            if not self.cancelled:
+                if len(failed) == 0:
+                    main_window.alert = QMessageBox(QMessageBox.NoIcon,
+                        "Success","The DVC code ran successfully.\n" + summary, QMessageBox.Ok)
+                else:
+                    main_window.alert = QMessageBox(QMessageBox.NoIcon,
+                        "Fail","The DVC code had some troubles.\n" + summary, QMessageBox.Ok)
+                    main_window.alert.setDetailedText(detailed_text)
+                main_window.alert.show()
+        else:
+            print (summary)
+            if detailed_text != '':
+                print (detailed_text)
+        if self.finish_fn is not None:
+            self.finish_fn()
@@ -0,0 +1,97 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from PySide2 import QtCore
+import os, sys
+import logging
+import argparse
+import multiprocessing
+
+
+class ConsoleCallback(object):
+    '''Prints the messages and progress emitted while setting up the run'''
+    def __init__(self, fmt="{}"):
+        self.fmt = fmt
+
+    def emit(self, value):
+        print (self.fmt.format(value))
+
+
+def main():
+    '''Runs the DVC analysis described in a run config file created by iDVC, without the GUI.
+
+    The run config file is the _run_config.json which iDVC saves in
+    Results/<run name> in the session folder. The dvc_result_N folders are
+    created next to it, as when running from the GUI.'''
+    parser = argparse.ArgumentParser(description='iDVC - run a DVC analysis from a run config file, without the GUI')
+
+    parser.add_argument('run_config', type=str,
+        help='the _run_config.json file created by iDVC')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+        help='number of DVC runs to execute at the same time')
+    parser.add_argument('--omp-threads', type=int, default=None,
+        help='total number of OpenMP threads, shared between the concurrent runs. Defaults to the number of cores')
+    parser.add_argument('--shards', type=int, default=None,
+        help='number of shards each point cloud is split into. Defaults to the value in the run config')
+    parser.add_argument('--no-cache', action='store_true',
+        help='do not reuse the results of runs with the same inputs from the result cache of the session')
+    parser.add_argument('--resume', action='store_true',
+        help='do not run again the dvc_result folders which already have complete outputs, e.g. after an interruption')
+    parser.add_argument('--no-crop', action='store_true',
+        help='give dvc the whole volumes, rather than the part around the point cloud')
+    parser.add_argument('--session-folder', type=str, default=None,
+        help='folder the paths in the run config are relative to. Defaults to the folder containing Results')
+    parser.add_argument('--debug', type=str)
+    args = parser.parse_args()
+
+    if args.debug in ['debug', 'info', 'warning', 'error', 'critical']:
+        level = getattr(logging, args.debug.upper())
+        logging.basicConfig(level=level)
+        logging.info(f"iDVC: Setting debugging level to {args.debug.upper()}")
+
+    run_config = os.path.abspath(args.run_config)
+    if not os.path.isfile(run_config):
+        print ("Run config file {} does not exist".format(run_config))
+        sys.exit(1)
+
+    if args.session_folder is None:
+        # run config is saved in <session folder>/Results/<run name>/
+        session_folder = os.path.dirname(os.path.dirname(os.path.dirname(run_config)))
+    else:
+        session_folder = os.path.abspath(args.session_folder)
+
+    omp_threads = args.omp_threads
+    if omp_threads is None:
+        omp_threads = multiprocessing.cpu_count()
+
+    app = QtCore.QCoreApplication([])
+
+    from idvc.dvc_runner import DVC_runner
+    # the paths of the roi and image files may be relative to the session folder
+    os.chdir(session_folder)
+    runner = DVC_runner(None, run_config, app.quit, True, session_folder,
+        omp_threads=omp_threads, max_concurrent_runs=args.jobs, shards=args.shards,
+        use_cache=not args.no_cache, resume=args.resume, crop=not args.no_crop)
+    try:
+        runner.set_up(message_callback=ConsoleCallback(),
+            progress_callback=ConsoleCallback("Setting up: {}%"))
+    except FileExistsError as err:
+        print ("{}\nThe run has already been started, use --resume to complete it".format(err))
+        sys.exit(1)
+
+    QtCore.QTimer.singleShot(0, runner.run_dvc)
+    app.exec_()
+
+    sys.exit(0 if runner.run_succeeded else 1)
+
+if __name__ == "__main__":
+    main()
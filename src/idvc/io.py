@@ -17,11 +17,14 @@ import imghdr
 import os
 import shutil
 import sys
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from functools import partial
 
 import numpy
 import vtk
+from vtk.util import numpy_support
 from ccpi.viewer.utils import Converter
 from ccpi.viewer.utils.conversion import (cilRawCroppedReader,
                                           cilRawResampleReader,
@@ -70,7 +73,7 @@ class ImageDataCreator(object):
 
         '''
 
-    def createImageData(main_window, image_files, output_image, *finish_fn_args, info_var=None, convert_numpy=False, convert_raw=True,  resample=False, target_size=0.125, crop_image=False, origin=(0, 0, 0), target_z_extent=(0, 0), output_dir=None, finish_fn=None,  **finish_fn_kwargs):
+    def createImageData(main_window, image_files, output_image, *finish_fn_args, info_var=None, convert_numpy=False, convert_raw=True,  resample=False, target_size=0.125, crop_image=False, origin=(0, 0, 0), target_z_extent=(0, 0), output_dir=None, raw_header_length=None, finish_fn=None,  **finish_fn_kwargs):
         # print("Create image data")
         if len(image_files) == 1:
             image = image_files[0]
@@ -91,7 +94,8 @@ class ImageDataCreator(object):
             createProgressWindow(main_window, "Converting", "Converting Image")
             image_worker = Worker(loadMetaImage, main_window=main_window, image=image, output_image=output_image,
                                   image_info=info_var, resample=resample, target_size=target_size, crop_image=crop_image, origin=origin,
-                                  target_z_extent=target_z_extent, convert_numpy=convert_numpy, convert_raw=convert_raw, output_dir=output_dir)
+                                  target_z_extent=target_z_extent, convert_numpy=convert_numpy, convert_raw=convert_raw, output_dir=output_dir,
+                                  raw_header_length=raw_header_length)
 
         elif file_extension in ['.npy']:
             createProgressWindow(main_window, "Converting", "Converting Image")
@@ -258,6 +262,8 @@ def loadMetaImage(**kwargs):
     convert_numpy = kwargs.get('convert_numpy', False)
     convert_raw = kwargs.get('convert_raw', True)
     output_dir = kwargs.get('output_dir', None)
+    # header length the raw file must have, e.g. to match the reference image
+    raw_header_length = kwargs.get('raw_header_length', None)
     progress_callback = kwargs.get('progress_callback', None)
 
     if resample:
@@ -316,6 +322,7 @@ def loadMetaImage(**kwargs):
 
     if convert_raw:
         filename = reader.GetFileName()
+        new_header_length = 0
         if '.mha' in filename:
             headerlength = reader.GetFileHeaderLength()
             if output_dir is None:
@@ -324,13 +331,22 @@ def loadMetaImage(**kwargs):
                 new_filename = os.path.relpath(os.path.join(
                     output_dir, os.path.basename(image)[:-4] + ".raw"))
 
-            with open(image, "rb") as image_file_object:
-                end_slice = loaded_shape[2]
-                image_location = headerlength
-                with open(new_filename, "wb") as raw_file_object:
-                    image_file_object.seek(image_location)
-                    chunk = image_file_object.read()
-                    raw_file_object.write(chunk)
+            # the voxels of an uncompressed image in the output folder are used 
+            # in place, skipping the header, if the header length is the one required
+            data_size = reader.GetBytesPerElement()
+            for dim in loaded_shape:
+                data_size *= dim
+            uncompressed = os.path.getsize(image) - headerlength == data_size
+            in_output_dir = output_dir is not None and \
+                os.path.dirname(os.path.abspath(image)) == os.path.abspath(output_dir)
+            if uncompressed and in_output_dir and raw_header_length in [None, headerlength]:
+                new_filename = os.path.relpath(image)
+                new_header_length = headerlength
+            else:
+                if raw_header_length is not None:
+                    new_header_length = raw_header_length
+                copy_file_chunks(image, new_filename, headerlength, new_header_length,
+                                 progress_callback, 90, 99)
         else:
             # TODO: fix this?
             file_ext = os.path.splitext(filename)[1]
@@ -342,7 +358,7 @@ def loadMetaImage(**kwargs):
                 new_filename = filename
 
         image_info['raw_file'] = new_filename
-        image_info['header_length'] = 0
+        image_info['header_length'] = new_header_length
 
     if convert_numpy:
         # this is for using in the dvc code
@@ -367,6 +383,56 @@ def loadMetaImage(**kwargs):
     return 0
 
 
+def copy_file_chunks(src_fname, dst_fname, src_offset=0, dst_offset=0, progress_callback=None, 
+                     start_progress=0, end_progress=100, chunk_size=64*1024*1024):
+    '''Copies the content of src_fname after src_offset to dst_fname at dst_offset, in chunks.
+
+    The first dst_offset bytes of dst_fname are zeros. Uses os.copy_file_range or os.sendfile
+    where the kernel supports them, so the data does not go through user space, otherwise
+    a buffer of chunk_size.'''
+    length = os.path.getsize(src_fname) - src_offset
+    if hasattr(os, 'copy_file_range'):
+        method = 'copy_file_range'
+    elif hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+        method = 'sendfile'
+    else:
+        method = 'buffer'
+    with open(src_fname, 'rb') as src, open(dst_fname, 'wb') as dst:
+        in_fd = src.fileno()
+        out_fd = dst.fileno()
+        os.ftruncate(out_fd, dst_offset)
+        copied = 0
+        while copied < length:
+            count = min(chunk_size, length - copied)
+            if method == 'copy_file_range':
+                try:
+                    written = os.copy_file_range(in_fd, out_fd, count, 
+                        src_offset + copied, dst_offset + copied)
+                except OSError:
+                    # e.g. not supported between these file systems
+                    method = 'sendfile' if hasattr(os, 'sendfile') and sys.platform.startswith('linux') else 'buffer'
+                    continue
+            elif method == 'sendfile':
+                try:
+                    os.lseek(out_fd, dst_offset + copied, os.SEEK_SET)
+                    written = os.sendfile(out_fd, in_fd, src_offset + copied, count)
+                except OSError:
+                    method = 'buffer'
+                    continue
+            else:
+                os.lseek(in_fd, src_offset + copied, os.SEEK_SET)
+                os.lseek(out_fd, dst_offset + copied, os.SEEK_SET)
+                data = os.read(in_fd, count)
+                view = memoryview(data)
+                while len(view) > 0:
+                    view = view[os.write(out_fd, view):]
+                written = len(data)
+            if written == 0:
+                raise IOError('Unexpected end of file {}'.format(src_fname))
+            copied += written
+            if progress_callback is not None:
+                progress_callback.emit(int(start_progress + (end_progress - start_progress) * copied / length))
+
 # def loadNpyImage(image_file, output_image, image_info = None, resample = False, target_size = 0.125, crop_image = False, origin = (0,0,0), target_z_extent = (0,0), progress_callback=None):
 def loadNpyImage(**kwargs):
     image_file = kwargs.get('image_file')
@@ -432,17 +498,16 @@ def loadNpyImage(**kwargs):
         time.sleep(0.1)
         progress_callback.emit(5)
 
-        with open(image_file, 'rb') as f:
-            header = f.readline()
-        header_length = len(header)
-        print("Length of header: ", len(header))
-
-        numpy_array = numpy.load(image_file)
+        # map the file in memory rather than reading it, pages are read when accessed.
+        # copy-on-write, so the array given to VTK is writable but the file is never modified
+        numpy_array = numpy.load(image_file, mmap_mode='c')
+        header_length = numpy_array.offset
+        print("Length of header: ", header_length)
         shape = numpy.shape(numpy_array)
 
-        if (isinstance(numpy_array[0][0][0], numpy.uint8)):
+        if numpy_array.dtype.type == numpy.uint8:
             vol_bit_depth = '8'
-        elif(isinstance(numpy_array[0][0][0], numpy.uint16)):
+        elif numpy_array.dtype.type == numpy.uint16:
             vol_bit_depth = '16'
         else:
             vol_bit_depth = None  # in this case we can't run the DVC code
@@ -461,8 +526,7 @@ def loadNpyImage(**kwargs):
 
                 print(image_info['isBigEndian'])
 
-        Converter.numpy2vtkImage(
-            numpy_array, output=output_image)  # (3.2,3.2,1.5)
+        numpy2vtkImageNoCopy(numpy_array, output_image)
         progress_callback.emit(80)
 
     progress_callback.emit(100)
@@ -930,6 +994,17 @@ def saveRawImageData(**kwargs):
 
         progress_callback.emit(50)
 
+        dtype = numpy.dtype(raw_typecodes[typecode]).newbyteorder('>' if isBigEndian else '<')
+        if dimensionality == 3 and dtype.isnative:
+            # map the file in memory and hand it to VTK without reading it
+            numpy_array = numpy.memmap(fname, dtype=dtype, mode='c', 
+                offset=info_var.get('header_length', 0), shape=shape, 
+                order='F' if isFortran else 'C')
+            numpy2vtkImageNoCopy(numpy_array, output_image)
+            progress_callback.emit(80)
+            print("Finished saving")
+            return(None)
+
         # main_window.raw_import_dialog['dialog'].reject()
         # expects to read a MetaImage File
         reader = vtk.vtkMetaImageReader()
@@ -955,6 +1030,55 @@ def saveRawImageData(**kwargs):
     # main_window.setStatusTip('Ready')
 
 
+# numpy types of the typecodes of the raw import dialog, see generateMetaImageHeader
+raw_typecodes = [numpy.int8, numpy.uint8, numpy.int16, numpy.uint16, 
+                 numpy.int32, numpy.uint32, numpy.float32, numpy.float64]
+
+def numpy2vtkImageNoCopy(numpy_array, output_image):
+    '''Sets a 3D numpy array, e.g. a memory map, as the scalars of output_image without copying it
+
+    The array is kept alive by the vtk array. If the array is not contiguous or not in the 
+    native byte order it is copied by Converter.numpy2vtkImage'''
+    if not numpy_array.dtype.isnative or numpy_array.ndim != 3:
+        return Converter.numpy2vtkImage(numpy_array, output=output_image)
+    if numpy_array.flags['F_CONTIGUOUS']:
+        dims = numpy_array.shape
+        flat = numpy_array.ravel(order='F')
+    elif numpy_array.flags['C_CONTIGUOUS']:
+        dims = numpy_array.shape[::-1]
+        flat = numpy_array.ravel(order='C')
+    else:
+        return Converter.numpy2vtkImage(numpy_array, output=output_image)
+
+    vtk_array = numpy_support.numpy_to_vtk(flat, deep=0)
+    output_image.SetDimensions(dims[0], dims[1], dims[2])
+    output_image.SetSpacing(1., 1., 1.)
+    output_image.SetOrigin(0, 0, 0)
+    output_image.GetPointData().SetScalars(vtk_array)
+    return output_image
+
+def open_raw_volume(filename, dims, bit_depth, header_length=0, endian='little'):
+    '''Maps in memory, read only, a raw volume as read by dvc
+
+    dims are the number of voxels along x, y and z, with x varying fastest in the file.
+    Returns a (z, y, x) array.'''
+    dtype = numpy.dtype(numpy.uint8 if int(bit_depth) == 8 else numpy.uint16)
+    dtype = dtype.newbyteorder('>' if endian == 'big' else '<')
+    return numpy.memmap(filename, dtype=dtype, mode='r', offset=int(header_length),
+        shape=(int(dims[2]), int(dims[1]), int(dims[0])))
+
+def crop_raw_volume(filename, output_filename, dims, bit_depth, header_length, endian, extent):
+    '''Writes the voxels of a raw volume within extent (xmin, xmax, ymin, ymax, zmin, zmax), 
+    max excluded, to a raw file without header, in the same byte order
+
+    The volume is mapped in memory and copied one slice at a time.'''
+    volume = open_raw_volume(filename, dims, bit_depth, header_length, endian)
+    part_file = output_filename + ".part"
+    with open(part_file, "wb") as f:
+        for z in range(extent[4], extent[5]):
+            numpy.ascontiguousarray(volume[z, extent[2]:extent[3], extent[0]:extent[1]]).tofile(f)
+    os.replace(part_file, output_filename)
+
 def generateMetaImageHeader(datafname, typecode, shape, isFortran, isBigEndian, header_size=0, spacing=(1, 1, 1), origin=(0, 0, 0)):
     '''create MetaImageHeader for datafname based on the specifications in parameters'''
     # __typeDict = {'0':'MET_CHAR',    # VTK_SIGNED_CHAR,     # int8
@@ -1009,17 +1133,68 @@ def generateMetaImageHeader(datafname, typecode, shape, isFortran, isBigEndian,
     header += 'ElementDataFile = {}'.format(os.path.basename(datafname))
     return header
 
-def save_tiff_stack_as_raw(filenames: list, output_fname: str, progress_callback, start_progress, end_progress) ->None :
-    '''Converts a TIFF stack to a raw file'''
-    reader = vtk.vtkTIFFReader()
-    reader.SetOrientationType(1) # TopLeft
-    with open(os.path.abspath(output_fname), 'wb') as f:
-        steps = len(filenames)
-        for el in filenames:
-            reader.SetFileName(el)
-            reader.Update()
-            slice_data = Converter.vtk2numpy(reader.GetOutput())
-            f.write(slice_data.tobytes())
-            progress_callback.emit(int(start_progress + (end_progress - start_progress) * (filenames.index(el) / steps)))
-            
-
+def save_tiff_stack_as_raw(filenames: list, output_fname: str, progress_callback, start_progress, end_progress, num_workers=None) ->None :
+    '''Converts a TIFF stack to a raw file
+
+    The slices are decoded concurrently by a pool of threads, each with its own reader,
+    and written at their offset in the preallocated output file. At most 2*num_workers 
+    decoded slices are held in memory at the same time.'''
+    steps = len(filenames)
+    if steps == 0:
+        return
+    if num_workers is None:
+        num_workers = min(8, os.cpu_count() or 1)
+    local = threading.local()
+
+    def read_slice(fname):
+        if not hasattr(local, 'reader'):
+            local.reader = vtk.vtkTIFFReader()
+            local.reader.SetOrientationType(1) # TopLeft
+        local.reader.SetFileName(fname)
+        local.reader.Update()
+        return Converter.vtk2numpy(local.reader.GetOutput()).tobytes()
+
+    first_slice = read_slice(filenames[0])
+    slice_size = len(first_slice)
+    write_lock = threading.Lock()
+    fd = os.open(os.path.abspath(output_fname), os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0))
+
+    def write_slice(index, data):
+        if len(data) != slice_size:
+            raise ValueError('Slice {} has a different size from the first slice'.format(filenames[index]))
+        offset = index * slice_size
+        view = memoryview(data)
+        if hasattr(os, 'pwrite'):
+            while len(view) > 0:
+                written = os.pwrite(fd, view, offset)
+                view = view[written:]
+                offset += written
+        else:
+            with write_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                while len(view) > 0:
+                    view = view[os.write(fd, view):]
+
+    def convert_slice(index):
+        write_slice(index, read_slice(filenames[index]))
+
+    try:
+        os.ftruncate(fd, slice_size * steps)
+        write_slice(0, first_slice)
+        completed = 1
+        progress_callback.emit(int(start_progress + (end_progress - start_progress) * (completed / steps)))
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            pending = set()
+            next_index = 1
+            while next_index < steps or len(pending) > 0:
+                while next_index < steps and len(pending) < 2 * num_workers:
+                    pending.add(executor.submit(convert_slice, next_index))
+                    next_index += 1
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    # raises the exceptions of the workers
+                    future.result()
+                    completed += 1
+                    progress_callback.emit(int(start_progress + (end_progress - start_progress) * (completed / steps)))
+    finally:
+        os.close(fd)
@@ -0,0 +1,630 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import hashlib
+import json
+import os
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+
+def image_to_array(image):
+    '''Returns a (z, y, x) view of the first component of the scalars of a vtkImageData'''
+    dimensions = image.GetDimensions()
+    values = numpy_support.vtk_to_numpy(image.GetPointData().GetScalars())
+    return values.reshape(dimensions[2], dimensions[1], dimensions[0], -1)[..., 0]
+
+def array_to_image(array, reference):
+    '''Creates a vtkImageData with the geometry of reference, whose scalars are the (z, y, x) array
+
+    The array is not copied, the vtkImageData keeps a reference to it'''
+    array = numpy.ascontiguousarray(array)
+    image = vtk.vtkImageData()
+    image.SetOrigin(reference.GetOrigin())
+    image.SetSpacing(reference.GetSpacing())
+    image.SetExtent(reference.GetExtent())
+    image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(array.ravel(), deep=0))
+    return image
+
+def lasso_slice(points, sliceno, orientation, reference):
+    '''Rasterizes the polygon through points on slice sliceno of the reference vtkImageData
+
+    Only the traced slice is rasterized. Returns a uint8 array with value 1 inside the
+    polygon, which is the slice of the (z, y, x) array of the reference with the axis
+    of the orientation removed.'''
+    extent = list(reference.GetExtent())
+    extent[2 * orientation] = extent[2 * orientation + 1] = sliceno
+    information = vtk.vtkImageData()
+    information.SetOrigin(reference.GetOrigin())
+    information.SetSpacing(reference.GetSpacing())
+    information.SetExtent(extent)
+
+    lasso = vtk.vtkLassoStencilSource()
+    lasso.SetShapeToPolygon()
+    lasso.SetSlicePoints(sliceno, points)
+    lasso.SetSliceOrientation(orientation)
+    lasso.SetInformationInput(information)
+
+    to_image = vtk.vtkImageStencilToImage()
+    to_image.SetInputConnection(lasso.GetOutputPort())
+    to_image.SetInsideValue(1)
+    to_image.SetOutsideValue(0)
+    to_image.SetOutputScalarTypeToUnsignedChar()
+    to_image.Update()
+    # x, y and z are axes 2, 1 and 0 of the array
+    return numpy.take(image_to_array(to_image.GetOutput()), 0, axis=2 - orientation).copy()
+
+def extend_mask_slab(mask, traced, orientation, start, stop):
+    '''Adds the traced slice to the slices start to stop of the (z, y, x) mask, in place
+
+    The voxels of the slab already in the mask keep their value, e.g. their label,
+    the others traced are set to 1.'''
+    axis = 2 - orientation
+    index = [slice(None)] * 3
+    index[axis] = slice(start, stop)
+    slab = mask[tuple(index)]
+    traced = numpy.expand_dims(traced != 0, axis)
+    numpy.copyto(slab, 1, where=numpy.logical_and(traced, slab == 0))
+
+
+META_ELEMENT_TYPES = {'uint8': 'MET_UCHAR', 'int8': 'MET_CHAR', 'uint16': 'MET_USHORT',
+    'int16': 'MET_SHORT', 'uint32': 'MET_UINT', 'int32': 'MET_INT', 'float32': 'MET_FLOAT',
+    'float64': 'MET_DOUBLE'}
+
+def write_meta_image(filename, array, origin, spacing, lock=None, chunk_voxels=1 << 24):
+    '''Writes the (z, y, x) array to a compressed MetaImage file, which vtkMetaImageReader can read
+
+    The array is read in chunks of slices, holding lock if given, so that it can be
+    edited while it is being written. The file is written next to filename and
+    moved there once complete.'''
+    element_type = META_ELEMENT_TYPES[numpy.dtype(array.dtype).name]
+    compressor = zlib.compressobj(1)
+    data = []
+    step = max(1, chunk_voxels // max(1, array.shape[1] * array.shape[2]))
+    for z in range(0, array.shape[0], step):
+        if lock is None:
+            chunk = numpy.ascontiguousarray(array[z:z+step], dtype=array.dtype.newbyteorder('<'))
+        else:
+            with lock:
+                chunk = numpy.array(array[z:z+step], dtype=array.dtype.newbyteorder('<'))
+        data.append(compressor.compress(chunk.tobytes()))
+    data.append(compressor.flush())
+    header = ['ObjectType = Image', 'NDims = 3', 'BinaryData = True', 'BinaryDataByteOrderMSB = False',
+        'CompressedData = True', 'CompressedDataSize = {}'.format(sum(len(d) for d in data)),
+        'TransformMatrix = 1 0 0 0 1 0 0 0 1', 'Offset = {} {} {}'.format(*origin),
+        'CenterOfRotation = 0 0 0', 'AnatomicalOrientation = RAI',
+        'ElementSpacing = {} {} {}'.format(*spacing),
+        'DimSize = {} {} {}'.format(array.shape[2], array.shape[1], array.shape[0]),
+        'ElementType = {}'.format(element_type), 'ElementDataFile = LOCAL']
+    with open(filename + '.part', 'wb') as f:
+        f.write(('\n'.join(header) + '\n').encode())
+        for d in data:
+            f.write(d)
+    os.replace(filename + '.part', filename)
+
+MASK_EXTENSION = '.msk'
+MASK_MAGIC = b'IDVCMASK'
+LATEST_MASK = 'latest_selection' + MASK_EXTENSION
+
+def _mask_bounding_box(array):
+    '''Voxel bounding box [xmin, xmax, ymin, ymax, zmin, zmax] of the (z, y, x) mask, the max excluded'''
+    slices = numpy.flatnonzero(array.reshape(array.shape[0], -1).any(axis=1))
+    if len(slices) == 0:
+        return None
+    z0, z1 = int(slices[0]), int(slices[-1]) + 1
+    projection = array[z0:z1].max(axis=0) != 0
+    rows = numpy.flatnonzero(projection.any(axis=1))
+    columns = numpy.flatnonzero(projection.any(axis=0))
+    return [int(columns[0]), int(columns[-1]) + 1, int(rows[0]), int(rows[-1]) + 1, z0, z1]
+
+def _compress_chunk(array, index, packed, lock):
+    if lock is None:
+        chunk = numpy.ascontiguousarray(array[index])
+    else:
+        with lock:
+            chunk = numpy.array(array[index])
+    if packed:
+        # 8 voxels per byte along x, the fastest axis
+        chunk = numpy.packbits(chunk, axis=2)
+    return zlib.compress(chunk.tobytes(), 1)
+
+def write_mask(filename, array, origin, spacing, num_workers=None, chunk_voxels=1 << 24, lock=None):
+    '''Writes the (z, y, x) mask array to a compact mask file
+
+    Only the bounding box of the mask is saved, bit-packed along x if the mask
+    only has values 0 and 1, otherwise with a byte per voxel, e.g. for labelled masks.
+    It is compressed in chunks of slices on num_workers threads. The header has
+    the geometry, the bounding box and the number of voxels in the mask, see
+    read_mask_header.
+    The array is read holding lock if given, so that it can be edited while it is
+    being written. The file is written next to filename and moved there once complete.'''
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    dtype = numpy.dtype(array.dtype).newbyteorder('<')
+    bounding_box = _mask_bounding_box(array)
+    header = {'version': 1, 'dimensions': [array.shape[2], array.shape[1], array.shape[0]],
+        'origin': [float(o) for o in origin], 'spacing': [float(s) for s in spacing],
+        'dtype': dtype.str, 'bounding_box': bounding_box, 'count': 0, 'packed': False,
+        'chunk_slices': 0, 'chunks': []}
+    data = []
+    if bounding_box is not None:
+        x0, x1, y0, y1, z0, z1 = bounding_box
+        box = array[z0:z1, y0:y1, x0:x1]
+        header['count'] = int(numpy.count_nonzero(box))
+        header['packed'] = bool(dtype == numpy.uint8 and not numpy.any(box > 1))
+        step = max(1, chunk_voxels // ((y1 - y0) * (x1 - x0)))
+        header['chunk_slices'] = step
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            data = list(executor.map(lambda z: _compress_chunk(box, slice(z, z + step), header['packed'], lock),
+                range(0, z1 - z0, step)))
+        header['chunks'] = [len(d) for d in data]
+    header = json.dumps(header).encode()
+    with open(filename + '.part', 'wb') as f:
+        f.write(MASK_MAGIC + struct.pack('<Q', len(header)) + header)
+        for d in data:
+            f.write(d)
+    os.replace(filename + '.part', filename)
+
+def read_mask_header(filename):
+    '''Returns the header of a mask file written by write_mask, and its length in bytes
+
+    The header is a dict with the dimensions, origin and spacing of the mask,
+    the dtype of its values, its bounding_box in voxels [xmin, xmax, ymin, ymax, zmin, zmax]
+    (max excluded, None if the mask is empty), the count of voxels in the mask and
+    the compressed length of the chunks of chunk_slices slices of the bounding box.'''
+    with open(filename, 'rb') as f:
+        if f.read(len(MASK_MAGIC)) != MASK_MAGIC:
+            raise ValueError('{} is not a mask file'.format(filename))
+        length = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(length).decode())
+    return header, len(MASK_MAGIC) + 8 + length
+
+def read_mask(filename, num_workers=None):
+    '''Reads a mask file written by write_mask
+
+    The chunks are decompressed on num_workers threads.
+    Returns the (z, y, x) mask array and the header.'''
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    header, offset = read_mask_header(filename)
+    nx, ny, nz = header['dimensions']
+    dtype = numpy.dtype(header['dtype'])
+    mask = numpy.zeros((nz, ny, nx), dtype=dtype.newbyteorder('='))
+    if header['bounding_box'] is None:
+        return mask, header
+    x0, x1, y0, y1, z0, z1 = header['bounding_box']
+    step = header['chunk_slices']
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        chunks = [f.read(length) for length in header['chunks']]
+
+    def decompress(i):
+        values = numpy.frombuffer(zlib.decompress(chunks[i]), dtype=numpy.uint8 if header['packed'] else dtype)
+        start = z0 + i * step
+        end = min(start + step, z1)
+        if header['packed']:
+            values = numpy.unpackbits(values.reshape(end - start, y1 - y0, -1), axis=2, count=x1 - x0)
+        mask[start:end, y0:y1, x0:x1] = values.reshape(end - start, y1 - y0, x1 - x0)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        list(executor.map(decompress, range(len(chunks))))
+    return mask, header
+
+def read_mask_image(filename):
+    '''Reads a mask file, or a MetaImage file, to a vtkImageData'''
+    if os.path.splitext(filename)[1] == MASK_EXTENSION:
+        mask, header = read_mask(filename)
+        image = vtk.vtkImageData()
+        image.SetOrigin(header['origin'])
+        image.SetSpacing(header['spacing'])
+        image.SetDimensions(header['dimensions'])
+        image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(mask.ravel(), deep=0))
+        return image
+    reader = vtk.vtkMetaImageReader()
+    reader.SetFileName(filename)
+    reader.Update()
+    return reader.GetOutput()
+
+def mha_to_mask(mha_filename, mask_filename):
+    '''Converts a MetaImage mask to a mask file'''
+    image = read_mask_image(mha_filename)
+    write_mask(mask_filename, image_to_array(image), image.GetOrigin(), image.GetSpacing())
+
+def mask_to_mha(mask_filename, mha_filename):
+    '''Converts a mask file to a compressed MetaImage file'''
+    mask, header = read_mask(mask_filename)
+    write_meta_image(mha_filename, mask, header['origin'], header['spacing'])
+
+class BackgroundMaskWriter(object):
+    '''Saves a mask array to a mask file on a background thread
+
+    A save requested while another is running is done once it completes, and
+    only the last of the requests made meanwhile is kept. The edits to the array
+    should hold lock, so that the saves read consistent slices.'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+        self._running = False
+        self._future = None
+
+    def save(self, filename, array, origin, spacing):
+        with self._state_lock:
+            self._pending = (filename, array, origin, spacing)
+            if not self._running:
+                self._running = True
+                self._future = self._executor.submit(self._run)
+
+    def _run(self):
+        while True:
+            with self._state_lock:
+                if self._pending is None:
+                    self._running = False
+                    return
+                filename, array, origin, spacing = self._pending
+                self._pending = None
+            try:
+                write_mask(filename, array, origin, spacing, lock=self.lock)
+            except OSError as err:
+                print ("Could not save the mask {}: {}".format(filename, err))
+
+    def wait(self):
+        '''Blocks until the requested saves are complete'''
+        while True:
+            with self._state_lock:
+                future = self._future
+                if not self._running:
+                    return
+            future.result()
+
+
+def mask_hash(array, chunk_size=1 << 26):
+    '''sha256 of the shape and values of a mask array'''
+    sha = hashlib.sha256()
+    sha.update(str(array.shape).encode())
+    sha.update(str(array.dtype).encode())
+    flat = numpy.ascontiguousarray(array).reshape(-1).view(numpy.uint8)
+    for start in range(0, len(flat), chunk_size):
+        sha.update(flat[start:start+chunk_size])
+    return sha.hexdigest()
+
+
+def mask_occupancy(mask):
+    '''Number of voxels in the (z, y, x) mask on each slice along x, y and z'''
+    mask = mask != 0
+    return [numpy.count_nonzero(mask, axis=(0, 1)), numpy.count_nonzero(mask, axis=(0, 2)),
+        numpy.count_nonzero(mask, axis=(1, 2))]
+
+def mask_bounds(mask_image, occupancy=None):
+    '''World bounds (xmin, xmax, ymin, ymax, zmin, zmax) of the voxels in the mask vtkImageData
+
+    As in points_in_mask, the points in a voxel are those whose coordinates in
+    voxels truncate to its index. Returns None if the mask is empty.'''
+    if occupancy is None:
+        occupancy = mask_occupancy(image_to_array(mask_image))
+    origin = mask_image.GetOrigin()
+    spacing = mask_image.GetSpacing()
+    extent = mask_image.GetExtent()
+    bounds = []
+    for axis in range(3):
+        indices = numpy.flatnonzero(occupancy[axis])
+        if len(indices) == 0:
+            return None
+        first = indices[0] + extent[2 * axis]
+        last = indices[-1] + extent[2 * axis] + 1
+        bounds += [origin[axis] + first * spacing[axis], origin[axis] + last * spacing[axis]]
+    return bounds
+
+
+def kernel_offsets(size):
+    '''Offsets from the middle of the elements of a structuring element of size voxels, as in vtkImageDilateErode3D'''
+    size = max(1, int(size))
+    return range(-(size // 2), size - size // 2)
+
+def _erosion_pass(values, axis, size, shape):
+    '''One separable pass of the distance transform along axis
+
+    For the sphere the values are the squared distance, normalised by the radius
+    of the structuring element on each axis, to the nearest background voxel.
+    Only the background within the structuring element is considered, as we are
+    only interested in whether the distance is below 1. For the cube they are
+    whether there is no background within the structuring element.'''
+    out = values.copy()
+    n = values.shape[axis]
+    radius = max(1, int(size)) / 2
+    for d in kernel_offsets(size):
+        if d == 0 or abs(d) >= n:
+            continue
+        dst = [slice(None)] * values.ndim
+        src = [slice(None)] * values.ndim
+        if d > 0:
+            dst[axis], src[axis] = slice(0, n - d), slice(d, n)
+        else:
+            dst[axis], src[axis] = slice(-d, n), slice(0, n + d)
+        dst = out[tuple(dst)]
+        if shape == 'cube':
+            numpy.logical_and(dst, values[tuple(src)], out=dst)
+        else:
+            numpy.minimum(dst, values[tuple(src)] + numpy.float32((d / radius) ** 2), out=dst)
+    return out
+
+def _erode_slab(mask, z_start, z_end, kernel_size, shape):
+    offsets = kernel_offsets(kernel_size[2])
+    # the pass along z needs the neighbouring slices
+    start = max(0, z_start + offsets[0])
+    end = min(mask.shape[0], z_end + offsets[-1])
+    slab = mask[start:end] != 0
+    if shape == 'cube':
+        values = slab
+    else:
+        values = numpy.where(slab, numpy.float32(numpy.inf), numpy.float32(0))
+    # x, y and z are axes 2, 1 and 0 of the array
+    for axis, size in ((2, kernel_size[0]), (1, kernel_size[1]), (0, kernel_size[2])):
+        values = _erosion_pass(values, axis, size, shape)
+    values = values[z_start - start:z_end - start]
+    if shape == 'cube':
+        return values.astype(numpy.uint8)
+    return (values > 1).astype(numpy.uint8)
+
+def erode_mask(mask, kernel_size, shape='sphere', num_workers=None, progress_callback=None, slab_thickness=16):
+    '''Erodes a (z, y, x) mask array with a cube or sphere structuring element
+
+    kernel_size is the size of the structuring element in voxels along x, y and z,
+    for the sphere it is the diameter of the ellipsoid. The voxels outside the
+    mask array are considered inside the mask, as in vtkImageDilateErode3D.
+
+    The erosion thresholds a separable distance transform, so it costs a few
+    operations per voxel for each voxel of the size of the kernel, rather than
+    for each voxel of its volume. It is computed in slabs along z on num_workers threads.
+    Returns a uint8 array with value 1 in the eroded mask.'''
+    if shape not in ['cube', 'sphere']:
+        raise ValueError('Expected shape cube or sphere, got {}'.format(shape))
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    # limit the share of slices read again as neighbours of the slabs
+    slab_thickness = max(slab_thickness, 2 * len(kernel_offsets(kernel_size[2])))
+    eroded = numpy.empty(mask.shape, dtype=numpy.uint8)
+    slabs = [(z, min(z + slab_thickness, mask.shape[0])) for z in range(0, mask.shape[0], slab_thickness)]
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(_erode_slab, mask, z_start, z_end, kernel_size, shape): (z_start, z_end)
+            for z_start, z_end in slabs}
+        for i, future in enumerate(as_completed(futures)):
+            z_start, z_end = futures[future]
+            eroded[z_start:z_end] = future.result()
+            if progress_callback is not None:
+                progress_callback.emit(int(100 * (i + 1) / len(slabs)))
+    return eroded
+
+def _morphology(mask, size, operation):
+    '''Erodes or dilates the boolean (z, y, x) mask with a cube of side size voxels'''
+    if operation == 'dilate':
+        mask = ~mask
+    for axis in (2, 1, 0):
+        mask = _erosion_pass(mask, axis, size, 'cube')
+    if operation == 'dilate':
+        mask = ~mask
+    return mask
+
+SMOOTHING_OPERATIONS = {None: [], 'open': ['erode', 'dilate'], 'close': ['dilate', 'erode'],
+    'open and close': ['erode', 'dilate', 'dilate', 'erode']}
+
+def _grid_groups(length, origin, spacing, start, grid_length):
+    '''Index on the grid of the reference nearest to each voxel of the volume along one axis
+
+    Returns the indices, the grid indices reached and where each of their groups of voxels starts'''
+    indices = numpy.clip(numpy.rint((numpy.arange(length) - origin) / spacing).astype(int) - start, 0, grid_length - 1)
+    starts = numpy.flatnonzero(numpy.diff(indices, prepend=-1))
+    return indices, indices[starts], starts
+
+def _intensity_slab(volume, z_start, z_end, gray_range, smoothing, radius, x_starts, y_starts):
+    # each erosion or dilation needs radius more slices
+    halo = radius * len(SMOOTHING_OPERATIONS[smoothing])
+    start = max(0, z_start - halo)
+    end = min(volume.shape[0], z_end + halo)
+    slab = volume[start:end]
+    mask = numpy.logical_and(slab >= gray_range[0], slab <= gray_range[1])
+    for operation in SMOOTHING_OPERATIONS[smoothing]:
+        mask = _morphology(mask, 2 * radius + 1, operation)
+    mask = mask[z_start - start:z_end - start]
+    # number of voxels in the mask nearest to each voxel of the reference
+    counts = numpy.add.reduceat(mask, x_starts, axis=2, dtype=numpy.uint32)
+    return numpy.add.reduceat(counts, y_starts, axis=1)
+
+def _connected_regions(mask, reference):
+    '''Labels of the face connected regions of the (z, y, x) mask, by decreasing size, 0 outside the mask'''
+    connectivity = vtk.vtkImageConnectivityFilter()
+    connectivity.SetInputData(array_to_image(mask.astype(numpy.uint8), reference))
+    connectivity.SetScalarRange(1, 1)
+    connectivity.SetExtractionModeToAllRegions()
+    connectivity.SetLabelModeToSizeRank()
+    connectivity.SetLabelScalarTypeToInt()
+    connectivity.Update()
+    return image_to_array(connectivity.GetOutput())
+
+def fill_holes(mask, reference):
+    '''Adds to the (z, y, x) mask the regions outside it which do not reach the border of the image'''
+    regions = _connected_regions(mask == 0, reference)
+    border = numpy.unique(numpy.concatenate([regions[0].ravel(), regions[-1].ravel(), regions[:, 0].ravel(),
+        regions[:, -1].ravel(), regions[:, :, 0].ravel(), regions[:, :, -1].ravel()]))
+    holes = numpy.logical_and(regions != 0, ~numpy.isin(regions, border))
+    return numpy.logical_or(mask != 0, holes).astype(numpy.uint8)
+
+def largest_region(mask, reference):
+    '''Keeps the largest face connected region of the (z, y, x) mask'''
+    return (_connected_regions(mask != 0, reference) == 1).astype(numpy.uint8)
+
+def mask_from_intensity(volume, gray_range, reference, holes=True, largest=True, smoothing=None, radius=1,
+        num_workers=None, chunk_voxels=1 << 24, progress_callback=None):
+    '''Creates a mask of the voxels of the volume in the gray range, on the grid of the reference vtkImageData
+
+    volume is the (z, y, x) image at full resolution, e.g. mapped in memory by
+    open_raw_volume, whose voxel (i, j, k) is at (i, j, k) in the coordinates of the
+    reference, which may be downsampled.
+    The volume is thresholded between the gray levels in gray_range, included, and
+    smoothed by smoothing, 'open', 'close' or 'open and close', with a cube of side
+    2 * radius + 1 voxels. This is done in chunks of slices on num_workers threads,
+    each reduced to the grid of the reference, where a voxel is in the mask if at least
+    half of the voxels of the volume nearest to it are.
+    Then, on the grid of the reference, the holes of the mask are filled if holes is
+    True and only its largest region is kept if largest is True.
+    Returns a uint8 array with value 1 in the mask.'''
+    if smoothing not in SMOOTHING_OPERATIONS:
+        raise ValueError('Expected smoothing open, close or open and close, got {}'.format(smoothing))
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    origin = reference.GetOrigin()
+    spacing = reference.GetSpacing()
+    extent = reference.GetExtent()
+    dimensions = reference.GetDimensions()
+    # x, y and z are axes 2, 1 and 0 of the array
+    groups = [_grid_groups(volume.shape[2 - axis], origin[axis], spacing[axis], extent[2 * axis], dimensions[axis])
+        for axis in range(3)]
+    (_, x_grid, x_starts), (_, y_grid, y_starts), (z_indices, z_grid, z_starts) = groups
+
+    counts = numpy.zeros((dimensions[2], len(y_grid), len(x_grid)), dtype=numpy.uint32)
+    step = max(1, chunk_voxels // (volume.shape[1] * volume.shape[2]))
+    slabs = [(z, min(z + step, volume.shape[0])) for z in range(0, volume.shape[0], step)]
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(_intensity_slab, volume, z_start, z_end, gray_range, smoothing, int(radius),
+            x_starts, y_starts): (z_start, z_end) for z_start, z_end in slabs}
+        for i, future in enumerate(as_completed(futures)):
+            z_start, z_end = futures[future]
+            numpy.add.at(counts, z_indices[z_start:z_end], future.result())
+            if progress_callback is not None:
+                progress_callback.emit(int(80 * (i + 1) / len(slabs)))
+
+    # the number of voxels of the volume nearest to each voxel of the reference
+    totals = [numpy.diff(numpy.append(starts, length)) for starts, length in
+        ((z_starts, volume.shape[0]), (y_starts, volume.shape[1]), (x_starts, volume.shape[2]))]
+    totals = totals[0][:, None, None] * totals[1][None, :, None] * totals[2][None, None, :]
+    mask = numpy.zeros((dimensions[2], dimensions[1], dimensions[0]), dtype=numpy.uint8)
+    mask[numpy.ix_(z_grid, y_grid, x_grid)] = 2 * counts[z_grid] >= totals
+    if holes:
+        mask = fill_holes(mask, reference)
+    if progress_callback is not None:
+        progress_callback.emit(90)
+    if largest:
+        mask = largest_region(mask, reference)
+    return mask
+
+def load_or_erode_mask(mask_image, kernel_size, shape, cache_folder, mask_key=None, progress_callback=None):
+    '''Returns the eroded mask_image as a vtkImageData
+
+    The eroded mask is saved in cache_folder with a name made of the hash of the
+    mask, the shape and size of the structuring element, and is loaded from
+    there the next time the same erosion is requested. mask_key is the hash of the mask,
+    if it is known already.
+    Returns the eroded image and the mask_key.'''
+    mask = image_to_array(mask_image)
+    if mask_key is None:
+        mask_key = mask_hash(mask)
+    cached = os.path.join(cache_folder, "{}_{}_{}.npy".format(mask_key, shape,
+        "_".join(str(int(k)) for k in kernel_size)))
+    eroded = None
+    if os.path.exists(cached):
+        try:
+            eroded = numpy.load(cached, mmap_mode='c')
+        except ValueError:
+            eroded = None
+        if eroded is not None and eroded.shape != mask.shape:
+            eroded = None
+    if eroded is None:
+        eroded = erode_mask(mask, kernel_size, shape, progress_callback=progress_callback)
+        try:
+            os.makedirs(cache_folder, exist_ok=True)
+            numpy.save(cached + '.part.npy', eroded)
+            os.replace(cached + '.part.npy', cached)
+        except OSError as err:
+            print ("Could not save the eroded mask {}: {}".format(cached, err))
+    return array_to_image(eroded, mask_image), mask_key
+
+
+class MaskCache(object):
+    '''The current mask and its eroded variants, held in memory
+
+    generation is bumped whenever the mask is edited, loaded or cleared. The
+    entries made for an older generation are discarded, so the mask file is
+    only read when the mask has changed and is not in memory already.
+    writer is the BackgroundMaskWriter saving the mask file, whose saves are
+    completed before reading it.'''
+    def __init__(self, writer=None, max_eroded=4):
+        self.writer = writer
+        self.max_eroded = max_eroded
+        self.generation = 0
+        self._lock = threading.Lock()
+        self._image = None
+        self._key = None
+        self._eroded = {}
+
+    def bump(self, image=None):
+        '''Records that the mask has changed, image is the new mask if it is in memory already'''
+        with self._lock:
+            self.generation += 1
+            self._image = (self.generation, image) if image is not None else None
+            self._key = None
+            self._eroded = {}
+
+    def _store(self, generation, name, value):
+        with self._lock:
+            if generation == self.generation:
+                setattr(self, name, (generation, value))
+
+    def image(self, filename):
+        '''Returns the current mask as a vtkImageData, reading it from filename if it is not in memory'''
+        generation = self.generation
+        cached = self._image
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        if self.writer is not None:
+            self.writer.wait()
+        image = read_mask_image(filename)
+        self._store(generation, '_image', image)
+        return image
+
+    def key(self, filename):
+        '''Returns the hash of the current mask, see mask_hash'''
+        generation = self.generation
+        cached = self._key
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        key = mask_hash(image_to_array(self.image(filename)))
+        self._store(generation, '_key', key)
+        return key
+
+    def eroded(self, filename, kernel_size, shape, cache_folder, label=None, progress_callback=None):
+        '''Returns the current mask, or its region with label, eroded as in load_or_erode_mask'''
+        generation = self.generation
+        entry = (tuple(int(k) for k in kernel_size), shape, label)
+        with self._lock:
+            if generation == self.generation and entry in self._eroded:
+                return self._eroded[entry]
+        image = self.image(filename)
+        mask_key = self.key(filename)
+        if label is not None:
+            image = array_to_image((image_to_array(image) == label).astype(numpy.uint8), image)
+            mask_key = "{}_label{}".format(mask_key, label)
+        eroded, _ = load_or_erode_mask(image, kernel_size, shape, cache_folder, mask_key=mask_key,
+            progress_callback=progress_callback)
+        with self._lock:
+            if generation == self.generation:
+                # the eroded masks are volumes as large as the mask, keep the most recent
+                while len(self._eroded) >= self.max_eroded:
+                    del self._eroded[next(iter(self._eroded))]
+                self._eroded[entry] = eroded
+        return eroded
@@ -14,32 +14,569 @@
 #   Author: Edoardo Pasca (UKRI-STFC)
 
 import numpy
-import csv
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from numbers import Integral, Number
 
 import vtk
+from vtk.util import numpy_support
 from vtk.util.vtkAlgorithm import VTKPythonAlgorithmBase
 
+# binary copy of a parsed text file, saved next to it
+SIDECAR_SUFFIX = '.cache.npy'
+SIDECAR_INFO_SUFFIX = '.cache.json'
+
 class PointCloudConverter():
     @staticmethod
-    def loadPointCloudFromCSV(filename, delimiter=','):
+    def loadPointCloudFromCSV(filename, delimiter=',', sidecar=True):
+        '''Reads the numerical rows of a .roi or .disp file into a (N, M) array
+
+        Rows which are not numerical, like the header of the .disp files, are skipped.
+        If sidecar is True the array is saved in a .npy file next to the text file,
+        which is memory-mapped by the next loads of the same file.'''
         # print ("loadPointCloudFromCSV")
-        pointcloud = []
-        with open(filename, 'r') as csvfile:
-            read = csv.reader(csvfile, delimiter=delimiter)
-            for row in read:
-                #read in only numerical values
-                #print (row)
-                try:
-                    row = list(map(lambda x: float(x),row))
-                #print ("reduce " , reduce( lambda x,y: isinstance(x,Number) and \
-                #          isinstance(y,Number) , row))
-                #if reduce( lambda x,y: isinstance(x,Number) and \
-                #          isinstance(y,Number) , row):
-                    pointcloud.append(row)
-                except ValueError as ve:
-                    print ('ValueError {}... skipping line {}'.format(ve, row))
-        return pointcloud
+        return read_numeric_table(filename, delimiter=delimiter, sidecar=sidecar)
+
+
+def is_sidecar_file(filename):
+    '''Whether the file is a binary copy of a text file, created by read_numeric_table'''
+    return filename.endswith(SIDECAR_SUFFIX) or filename.endswith(SIDECAR_INFO_SUFFIX)
+
+def _text_fingerprint(filename):
+    stat = os.stat(filename)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def load_sidecar(filename):
+    '''Memory-maps the sidecar of a text file, returns None if it is missing or
+    the text file changed since it was written'''
+    try:
+        with open(filename + SIDECAR_INFO_SUFFIX, 'r') as f:
+            info = json.load(f)
+        if info != _text_fingerprint(filename):
+            return None
+        # copy on write, the users of the array can modify it
+        return numpy.load(filename + SIDECAR_SUFFIX, mmap_mode='c')
+    except (OSError, ValueError):
+        return None
+
+def save_sidecar(filename, chunks, number_of_columns, fingerprint):
+    '''Writes the rows parsed from a text file to its sidecar and memory-maps it
+
+    Returns None if the sidecar cannot be written'''
+    number_of_rows = sum(len(chunk) for chunk in chunks)
+    if number_of_rows == 0:
+        return None
+    sidecar = filename + SIDECAR_SUFFIX
+    try:
+        if os.path.exists(filename + SIDECAR_INFO_SUFFIX):
+            os.remove(filename + SIDECAR_INFO_SUFFIX)
+        out = numpy.lib.format.open_memmap(sidecar + '.part', mode='w+',
+            dtype=numpy.float64, shape=(number_of_rows, number_of_columns))
+        row = 0
+        for chunk in chunks:
+            out[row:row+len(chunk)] = chunk
+            row += len(chunk)
+        out.flush()
+        del out
+        os.replace(sidecar + '.part', sidecar)
+        with open(filename + SIDECAR_INFO_SUFFIX, 'w') as f:
+            json.dump(fingerprint, f)
+    except OSError as err:
+        print ("Could not save {}: {}".format(sidecar, err))
+        return None
+    return numpy.load(sidecar, mmap_mode='c')
+
+def _parse_line(line, delimiter):
+    '''Returns the values in a row or None if the row is not numerical'''
+    if delimiter not in (None, ','):
+        line = line.replace(delimiter, ' ')
+    try:
+        return [float(x) for x in line.replace(',', ' ').split()]
+    except ValueError:
+        return None
+
+def _parse_rows(text, number_of_columns, delimiter):
+    '''Parses complete lines of text with number_of_columns values per line'''
+    if delimiter not in (None, ','):
+        text = text.replace(delimiter, ' ')
+    tokens = text.replace(',', ' ').split()
+    try:
+        values = numpy.array(tokens, dtype=numpy.float64)
+    except ValueError:
+        values = None
+    if values is not None and values.size % number_of_columns == 0:
+        return values.reshape(-1, number_of_columns)
+    # some lines are not numerical or have a different number of values
+    rows = []
+    for line in text.splitlines():
+        row = _parse_line(line, None)
+        if row is None:
+            print ('ValueError... skipping line {}'.format(line))
+        elif len(row) == number_of_columns:
+            rows.append(row)
+        elif len(row) > 0:
+            print ('Expected {} values... skipping line {}'.format(number_of_columns, line))
+    return numpy.asarray(rows, dtype=numpy.float64).reshape(-1, number_of_columns)
+
+def read_numeric_table(filename, delimiter=None, sidecar=True, chunk_size=1 << 24):
+    '''Reads a text file of numerical rows, separated by tabs, commas or spaces, 
+    into a (N, M) float64 array
+
+    The leading rows which are not numerical, e.g. a header, are skipped. The
+    file is parsed in chunks of chunk_size characters.
+    If sidecar is True the array is saved to filename + SIDECAR_SUFFIX and
+    later calls memory-map it, as long as the size and modification time of the
+    text file have not changed.'''
+    if sidecar:
+        data = load_sidecar(filename)
+        if data is not None:
+            return data
+    fingerprint = _text_fingerprint(filename)
+
+    chunks = []
+    number_of_columns = None
+    remainder = ''
+    with open(filename, 'r') as f:
+        while True:
+            block = f.read(chunk_size)
+            text = remainder + block
+            if block:
+                # parse only complete lines
+                end = text.rfind('\n') + 1
+                text, remainder = text[:end], text[end:]
+            if number_of_columns is None:
+                # skip the header
+                lines = text.splitlines(keepends=True)
+                for i, line in enumerate(lines):
+                    row = _parse_line(line, delimiter)
+                    if row:
+                        number_of_columns = len(row)
+                        text = ''.join(lines[i:])
+                        break
+                else:
+                    text = ''
+            if number_of_columns is not None and text:
+                chunks.append(_parse_rows(text, number_of_columns, delimiter))
+            if not block:
+                break
+
+    if number_of_columns is None:
+        return numpy.zeros((0, 0))
+    if sidecar:
+        data = save_sidecar(filename, chunks, number_of_columns, fingerprint)
+        if data is not None:
+            return data
+    if not chunks:
+        return numpy.zeros((0, number_of_columns))
+    return numpy.concatenate(chunks)
+
+
+def write_numeric_table(filename, array, fmt, chunk_rows=1 << 16):
+    '''Writes the rows of a 2D array to a text file with the format fmt, e.g. '%d\t%.3f\t%.3f\t%.3f'
+
+    Each chunk of chunk_rows rows is formatted with a single operation and the
+    file is written through one buffer.'''
+    array = numpy.asarray(array)
+    row_fmt = fmt + '\n'
+    with open(filename, 'w', buffering=1 << 20) as f:
+        for start in range(0, len(array), chunk_rows):
+            chunk = array[start:start+chunk_rows]
+            f.write((row_fmt * len(chunk)) % tuple(chunk.ravel().tolist()))
+
+
+def points_to_array(polydata):
+    '''Returns the points of a vtkPolyData as a (N, 3) array, without copying them'''
+    if polydata.GetPoints() is None or polydata.GetNumberOfPoints() == 0:
+        return numpy.zeros((0, 3))
+    return numpy_support.vtk_to_numpy(polydata.GetPoints().GetData()).reshape(-1, 3)
+
+def sample_mask(points, mask):
+    '''Returns the value of the voxel of the mask vtkImageData containing each of the (N, 3) points,
+    and whether each point is within the extent of the mask
+
+    The voxel of a point is found as in cilMaskPolyData, by truncating its
+    coordinates in voxels. The value of the points outside the extent is 0.'''
+    points = numpy.asarray(points).reshape(-1, 3)
+    dimensions = mask.GetDimensions()
+    extent = mask.GetExtent()
+    indices = numpy.trunc((points - numpy.asarray(mask.GetOrigin())) / numpy.asarray(mask.GetSpacing()))
+    indices -= numpy.asarray(extent[::2])
+    inside = numpy.all((indices >= 0) & (indices < numpy.asarray(dimensions)), axis=1)
+    # the scalars of the image are stored with x varying fastest
+    values = numpy_support.vtk_to_numpy(mask.GetPointData().GetScalars())
+    values = values.reshape(dimensions[2], dimensions[1], dimensions[0], -1)[..., 0]
+    indices = indices[inside].astype(numpy.intp)
+    sampled = numpy.zeros(len(points), dtype=values.dtype)
+    sampled[inside] = values[indices[:,2], indices[:,1], indices[:,0]]
+    return sampled, inside
+
+def points_in_mask(points, mask, mask_value=1):
+    '''Returns whether each of the (N, 3) points is in a voxel of the mask vtkImageData with value mask_value'''
+    sampled, inside = sample_mask(points, mask)
+    return inside & (sampled == mask_value)
+
+def parse_region_settings(text):
+    '''Parses the point cloud settings of the regions of a labelled mask
+
+    The settings of each region are separated by ; and are the label, a colon,
+    the subvolume size and the overlap, either one value for all axes or one
+    for each of x, y and z, e.g. "1: 30 0.5; 2: 60 0.2 0.2 0.1".
+    Returns a list of (label, subvolume size, [overlap x, y, z]) sorted by label.'''
+    regions = {}
+    for item in text.split(';'):
+        if item.strip() == '':
+            continue
+        try:
+            label, values = item.split(':')
+            label = int(label)
+            values = values.split()
+            subvol_size = int(values[0])
+            overlap = [float(v) for v in values[1:]]
+        except (ValueError, IndexError):
+            raise ValueError('Expected the region settings as "label: size overlap", got "{}"'.format(item.strip()))
+        if len(overlap) == 1:
+            overlap = overlap * 3
+        if len(overlap) != 3:
+            raise ValueError('Expected 1 or 3 overlap values for region {}, got {}'.format(label, len(overlap)))
+        if label <= 0 or subvol_size <= 0:
+            raise ValueError('Region labels and subvolume sizes must be positive, got "{}"'.format(item.strip()))
+        if not all(0 <= o < 1 for o in overlap):
+            raise ValueError('Region overlaps must be between 0 and 1, got "{}"'.format(item.strip()))
+        if label in regions:
+            raise ValueError('Region {} is set more than once'.format(label))
+        regions[label] = (label, subvol_size, overlap)
+    if len(regions) == 0:
+        raise ValueError('No region settings')
+    return [regions[label] for label in sorted(regions)]
+
+
+def lattice_indices(max_n, length, offset=0, bounds=None):
+    '''Indices n of the points of a lattice on one axis, whose coordinates are n / max_n * length + offset for 0 <= n < max_n
+
+    If bounds (min, max) are passed only the indices of the points within them are returned'''
+    if max_n <= 0:
+        return numpy.zeros((0,), dtype=numpy.int32)
+    start, stop = 0, int(numpy.ceil(max_n))
+    if bounds is not None and length > 0:
+        start = max(start, int(numpy.ceil((bounds[0] - offset) * max_n / length)))
+        stop = min(stop, int(numpy.floor((bounds[1] - offset) * max_n / length)) + 1)
+    return numpy.arange(start, max(start, stop), dtype=numpy.int32)
+
+def lattice_coordinates(max_n, length, offset=0, bounds=None):
+    '''Coordinates of the points of a lattice on one axis: n / max_n * length + offset for 0 <= n < max_n
+
+    If bounds (min, max) are passed only the coordinates within them are returned'''
+    if max_n <= 0:
+        return numpy.zeros((0,))
+    return lattice_indices(max_n, length, offset, bounds) / max_n * length + offset
+
+def lattice_levels(indices, max_level=8):
+    '''Level of the points of a lattice from their (N, 3) indices: the points of level k or higher 
+    form the lattice with 2**k times the spacing'''
+    levels = numpy.zeros(len(indices), dtype=numpy.int32)
+    for k in range(1, max_level + 1):
+        levels[numpy.all(indices % (1 << k) == 0, axis=1)] = k
+    return levels
+
+def lattice_cell(lattice):
+    '''Size of the cell and positions of the points in the cell of a lattice, in units of the 
+    spacing of the cubic lattice with the same coverage
+
+    The spacing s of the cubic lattice is obtained from the overlap of the subvolumes.
+    Any location is at most sqrt(3) / 2 s from a point of the cubic lattice, the
+    other lattices are scaled to have the same largest distance, i.e. covering
+    radius, so the subvolumes cover the region as well with fewer points. For them
+    the overlap sets the covering radius: their nearest neighbours are further than
+    s apart, so neighbouring subvolumes overlap less than set. This gives:
+
+    - bcc, body centred cubic: covering radius sqrt(5) / 4 a for cell size a, a = 2 sqrt(3 / 5) s, 
+      0.54 points for each point of the cubic lattice, neighbours at sqrt(3) / 2 a = 1.34 s
+    - fcc, face centred cubic: covering radius a / 2, a = sqrt(3) s, 0.77 points for each point of 
+      the cubic lattice, neighbours at a / sqrt(2) = 1.22 s
+    - hcp, hexagonal close packed: covering radius c / sqrt(2) for distance between neighbours c, 
+      c = sqrt(6) / 2 s, with the layers at a distance of s. Same number of points as fcc.
+
+    Returns the size of the cell along x, y and z and the (M, 3) array of positions of the points in the cell'''
+    if lattice == 'cubic':
+        return numpy.ones(3), numpy.zeros((1, 3))
+    elif lattice == 'bcc':
+        a = 2 * numpy.sqrt(3 / 5)
+        return numpy.full(3, a), a * numpy.array([[0, 0, 0], [0.5, 0.5, 0.5]])
+    elif lattice == 'fcc':
+        a = numpy.sqrt(3)
+        return numpy.full(3, a), a * numpy.array([[0, 0, 0], [0.5, 0.5, 0], [0.5, 0, 0.5], [0, 0.5, 0.5]])
+    elif lattice == 'hcp':
+        # hexagonal layers on the xy plane, stacked ABAB along z
+        c = numpy.sqrt(6) / 2
+        h = c * numpy.sqrt(2 / 3)
+        row = c * numpy.sqrt(3) / 2
+        return numpy.array([c, 2 * row, 2 * h]), numpy.array([[0, 0, 0], [c / 2, row, 0], 
+            [c / 2, row / 3, h], [0, 4 * row / 3, h]])
+    raise ValueError('unsupported lattice', lattice)
+
+def transformed_bounds(bounds, matrix):
+    '''Axis aligned bounds (xmin, xmax, ymin, ymax, zmin, zmax) of the box bounds transformed by the 4x4 matrix'''
+    corners = numpy.array([[x, y, z] for x in bounds[0:2] for y in bounds[2:4] for z in bounds[4:6]])
+    matrix = numpy.asarray(matrix)
+    corners = corners @ matrix[:3,:3].T + matrix[:3,3]
+    return [v for axis in range(3) for v in (corners[:,axis].min(), corners[:,axis].max())]
+
+def points_from_array(points):
+    '''Creates vtkPoints from a (N, 3) array
+
+    The array is not copied if it is contiguous and of floating point type, the
+    vtk array keeps a reference to it'''
+    points = numpy.asarray(points)
+    dtype = points.dtype if points.dtype in [numpy.float32, numpy.float64] else numpy.float64
+    points = numpy.ascontiguousarray(points, dtype=dtype).reshape(-1, 3)
+    vtk_points = vtk.vtkPoints()
+    vtk_points.SetData(numpy_support.numpy_to_vtk(points, deep=0))
+    return vtk_points
+
+def vertices_for_points(number_of_points):
+    '''Creates a vtkCellArray with one vertex cell for each point'''
+    vertices = vtk.vtkCellArray()
+    if number_of_points == 0:
+        return vertices
+    ids = numpy.arange(number_of_points, dtype=numpy_support.ID_TYPE_CODE)
+    if hasattr(vertices, 'SetData'):
+        # VTK >= 9: offsets and connectivity
+        offsets = numpy.arange(number_of_points + 1, dtype=numpy_support.ID_TYPE_CODE)
+        vertices.SetData(numpy_support.numpy_to_vtkIdTypeArray(offsets, deep=1),
+                         numpy_support.numpy_to_vtkIdTypeArray(ids, deep=1))
+    else:
+        # legacy format: number of points in the cell followed by the point ids
+        cells = numpy.stack((numpy.ones_like(ids), ids), axis=1).ravel()
+        vertices.SetCells(number_of_points, numpy_support.numpy_to_vtkIdTypeArray(cells, deep=1))
+    return vertices
+
+@lru_cache(maxsize=256)
+def distance_from_overlap(radius, req, interp=False, N=1000, mode='sphere'):
+    '''Distance between the centres of 2 shapes of radius with the required overlap
+
+    Squares, cubes and spheres are inverted in closed form, with the overlap clipped 
+    to the range of the shape. For circles the overlap is sampled on N points in [0, 2 radius].'''
+    if mode in ['square', 'cube']:
+        # overlap = 1 - d / r, for 0 <= d <= 2r
+        return radius * (1 - min(max(req, -1.), 1.))
+    elif mode == 'sphere':
+        # overlap = (2 - u)^2 (u + 4) / 16 with u = d / r, i.e. u^3 - 12 u + 16 (1 - overlap) = 0
+        # the root in [0, 2] from the trigonometric solution of the cubic
+        req = min(max(req, 0.), 1.)
+        theta = numpy.arccos(req - 1)
+        return float(radius * 4 * numpy.cos(theta / 3 - 2 * numpy.pi / 3))
+    elif mode == 'circle':
+        x = 2. * numpy.arange(N + 1) / N * radius
+        u = x / radius
+        y = (2 * numpy.arccos(u / 2.) - u * numpy.sqrt(1 - (u / 2.) * (u / 2.))) / 3.1415 - req
+        # find the value closer to 0 for required overlap
+        idx = int(numpy.argmin(numpy.abs(y)))
+        if interp:
+            if idx < N and y[idx] * y[idx+1] < 0:
+                m = (y[idx] -y[idx+1]) / (x[idx] -x[idx+1])
+            else:
+                m = (y[idx] -y[idx-1]) / (x[idx] -x[idx-1])
+            q = y[idx] - m * x[idx]
+            return float(-q / m)
+        return float(x[idx])
+    raise ValueError('unsupported mode', mode)
+
+def _block_sums(values, block_size):
+    '''Sums of a (z, y, x) array over blocks of block_size (bz, by, bx) voxels'''
+    for axis, size in enumerate(block_size):
+        values = numpy.add.reduceat(values, numpy.arange(0, values.shape[axis], size), axis=axis)
+    return values
+
+def _texture_slab(image, z_start, z_end, block_size, measure, step):
+    # the slab of blocks is read step slices at a time, its sums are additive along z
+    z_end = min(z_end, image.shape[0])
+    sums = None
+    for start in range(z_start, z_end, step):
+        end = min(start + step, z_end)
+        slab = numpy.asarray(image[start:end], dtype=numpy.float32)
+        chunk_size = [end - start] + list(block_size[1:])
+        if measure == 'variance':
+            chunk_sums = [_block_sums(slab, chunk_size), _block_sums(slab * slab, chunk_size)]
+        else:
+            # gradient energy, the difference along z with the next slice is included 
+            # if it is in the image
+            following = numpy.asarray(image[end:end+1], dtype=numpy.float32)
+            energy = numpy.zeros(slab.shape, dtype=numpy.float32)
+            energy[:, :, :-1] += numpy.diff(slab, axis=2) ** 2
+            energy[:, :-1, :] += numpy.diff(slab, axis=1) ** 2
+            energy[:-1] += numpy.diff(slab, axis=0) ** 2
+            if len(following):
+                energy[-1] += (following[0] - slab[-1]) ** 2
+            chunk_sums = [_block_sums(energy, chunk_size)]
+        sums = chunk_sums if sums is None else [total + chunk for total, chunk in zip(sums, chunk_sums)]
+    count = _block_sums(numpy.ones((1,) + image.shape[1:], dtype=numpy.float32), [1] + list(block_size[1:])) * (z_end - z_start)
+    if measure == 'variance':
+        mean = sums[0] / count
+        return numpy.maximum(sums[1] / count - mean * mean, 0)
+    return sums[0] / count
+
+def block_texture(image, block_size, measure='variance', num_workers=None, chunk_voxels=1 << 24):
+    '''Texture of a (z, y, x) image in blocks of block_size (bx, by, bz) voxels
+
+    measure is 'variance', the variance of the gray levels in the block, or 
+    'gradient', the mean of the squared gradient in the block.
+    The image, e.g. mapped in memory, is processed in slabs of blocks along z on 
+    num_workers threads, each reading about chunk_voxels voxels at a time.
+    Returns an array with the texture of each block, indexed by block (z, y, x)'''
+    if measure not in ['variance', 'gradient']:
+        raise ValueError('Expected texture measure variance or gradient, got {}'.format(measure))
+    block_size = [max(1, int(b)) for b in block_size[::-1]]
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    step = max(1, chunk_voxels // (image.shape[1] * image.shape[2]))
+    slabs = list(range(0, image.shape[0], block_size[0]))
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        textures = list(executor.map(lambda z: _texture_slab(image, z, z + block_size[0], block_size, measure, step), slabs))
+    return numpy.concatenate(textures, axis=0)
+
+def select_adaptive_points(texture, levels, budget, dimensionality=3, flat_fraction=0.1):
+    '''Selects at most budget points of a lattice, more densely where the texture is higher
+
+    texture is the texture around each point and levels their level in the lattice
+    (see lattice_levels). The points where the texture is lower than flat_fraction
+    times the median texture are discarded. The others are ranked by texture times
+    the number of points of the lattice per point of their level, so where the texture
+    is richer the finer levels of the lattice are kept.
+    Returns the sorted indices of the selected points.'''
+    texture = numpy.asarray(texture, dtype=numpy.float64)
+    candidates = numpy.flatnonzero(texture > flat_fraction * numpy.median(texture)) if len(texture) else numpy.zeros((0,), dtype=numpy.intp)
+    if len(candidates) <= budget:
+        return candidates
+    score = texture[candidates] * (2.0 ** dimensionality) ** levels[candidates]
+    selected = candidates[numpy.argpartition(-score, budget - 1)[:budget]]
+    return numpy.sort(selected)
+
+
+def _sphere_rows(radius):
+    '''Offsets (dz, dy) of the rows of voxels of a sphere and the half width of each row along x'''
+    r = int(numpy.floor(radius))
+    dz, dy = numpy.meshgrid(numpy.arange(-r, r + 1), numpy.arange(-r, r + 1), indexing='ij')
+    inside = dz**2 + dy**2 <= radius**2
+    dz, dy = dz[inside], dy[inside]
+    return dz, dy, numpy.floor(numpy.sqrt(radius**2 - dz**2 - dy**2)).astype(numpy.intp)
+
+def _subvolume_extents(centres, sizes, geometry):
+    '''The voxel nearest to each point and the extent of its subvolume, low included and high excluded
+
+    The cube of side size spans size // 2 voxels before the voxel nearest to the
+    point, as in dvc, the sphere its radius on each side of it.'''
+    voxels = numpy.rint(centres).astype(numpy.intp)
+    if geometry == 'cube':
+        sides = numpy.rint(sizes).astype(numpy.intp)[:, numpy.newaxis]
+        low = voxels - sides // 2
+        return voxels, low, low + sides
+    radii = numpy.floor(sizes / 2).astype(numpy.intp)[:, numpy.newaxis]
+    return voxels, voxels - radii, voxels + radii + 1
+
+def _fractions_band(volume, gray_range, centres, sizes, geometry):
+    '''Fraction of the subvolumes in gray_range, reading once, one slice at a time, the slices they span'''
+    nz, ny, nx = volume.shape
+    voxels, low, high = _subvolume_extents(centres, sizes, geometry)
+    z_low = numpy.clip(low[:, 2], 0, nz)
+    z_high = numpy.clip(high[:, 2], 0, nz)
+    z_start, z_end = z_low.min(), z_high.max()
+    # the sums are computed modulo 2**32, which is exact as long as the subvolumes 
+    # have less voxels than that
+    total = numpy.zeros(len(centres), dtype=numpy.uint32)
+    if geometry == 'cube':
+        # the 2D summed-area tables of the slices, summed along z from z_start, so that
+        # the sum over a cube is the difference of this table at its top and bottom
+        table = numpy.zeros((ny + 1, nx + 1), dtype=numpy.uint32)
+        x_low, x_high = numpy.clip(low[:, 0], 0, nx), numpy.clip(high[:, 0], 0, nx)
+        y_low, y_high = numpy.clip(low[:, 1], 0, ny), numpy.clip(high[:, 1], 0, ny)
+        bottoms, tops = numpy.argsort(z_low, kind='stable'), numpy.argsort(z_high, kind='stable')
+        sorted_low, sorted_high = z_low[bottoms], z_high[tops]
+        for z in range(z_start, z_end + 1):
+            for points, sorted_z, sign in ((bottoms, sorted_low, -1), (tops, sorted_high, 1)):
+                group = points[numpy.searchsorted(sorted_z, z):numpy.searchsorted(sorted_z, z, side='right')]
+                if len(group) == 0:
+                    continue
+                value = table[y_high[group], x_high[group]] - table[y_low[group], x_high[group]] \
+                    - table[y_high[group], x_low[group]] + table[y_low[group], x_low[group]]
+                total[group] = total[group] + value if sign > 0 else total[group] - value
+            if z < z_end:
+                in_range = (volume[z] >= gray_range[0]) & (volume[z] <= gray_range[1])
+                table[1:, 1:] += in_range.cumsum(axis=0, dtype=numpy.uint32).cumsum(axis=1, dtype=numpy.uint32)
+        count = numpy.prod(high - low, axis=1)
+    else:
+        # sums along x of the rows of each slice, the spheres are summed row by row
+        rows = numpy.zeros((ny, nx + 1), dtype=numpy.uint32)
+        count = numpy.zeros(len(centres))
+        spheres = []
+        for size in numpy.unique(sizes):
+            group = numpy.flatnonzero(sizes == size)
+            group = group[numpy.argsort(voxels[group, 2], kind='stable')]
+            dz, dy, width = _sphere_rows(size / 2)
+            count[group] = numpy.sum(2 * width + 1)
+            spheres.append((group, voxels[group, 2], dz, dy, width))
+        for z in range(z_start, z_end):
+            in_range = (volume[z] >= gray_range[0]) & (volume[z] <= gray_range[1])
+            rows[:, 1:] = in_range.cumsum(axis=1, dtype=numpy.uint32)
+            for group, cz, dz, dy, width in spheres:
+                for offset in numpy.unique(dz):
+                    # the points whose sphere has the rows at offset along z in this slice
+                    points = group[numpy.searchsorted(cz, z - offset):numpy.searchsorted(cz, z - offset, side='right')]
+                    if len(points) == 0:
+                        continue
+                    row_y, row_width = dy[dz == offset], width[dz == offset]
+                    yy = voxels[points, 1][:, numpy.newaxis] + row_y
+                    x0 = numpy.clip(voxels[points, 0][:, numpy.newaxis] - row_width, 0, nx)
+                    x1 = numpy.clip(voxels[points, 0][:, numpy.newaxis] + row_width + 1, 0, nx)
+                    valid = (yy >= 0) & (yy < ny)
+                    yy = numpy.clip(yy, 0, ny - 1)
+                    sums = numpy.where(valid, rows[yy, x1] - rows[yy, x0], 0).astype(numpy.uint32)
+                    total[points] += sums.sum(axis=1, dtype=numpy.uint32)
+    return total / count
+
+def subvolume_fractions(volume, points, subvol_size, geometry='cube', gray_range=(0, 255), 
+                        num_workers=None):
+    '''Fraction of the voxels of the subvolume of each point whose gray level is within gray_range
+
+    volume is a (z, y, x) array, e.g. a raw file mapped in memory, points are
+    the (N, 3) x, y, z coordinates in voxels and subvol_size is the side of the
+    cube or the diameter of the sphere, for all points or for each of them.
+    The cube spans subvol_size voxels on each axis, starting subvol_size // 2 voxels
+    before the voxel nearest to the point as in dvc, the sphere contains the voxels
+    within its radius of that voxel. The voxels outside the volume count as outside gray_range.
+
+    The points are split along z into bands, which are processed on num_workers
+    threads. Each band reads once, one slice at a time, the slices its subvolumes
+    span: the cubes are summed with the summed-area tables of the slices added up
+    along z, the spheres row by row with the sums of the rows of each slice, so
+    each thread holds a few tables of the size of a slice.'''
+    if geometry not in ['cube', 'sphere']:
+        raise ValueError('Expected subvolume geometry cube or sphere, got {}'.format(geometry))
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+    sizes = numpy.broadcast_to(numpy.asarray(subvol_size, dtype=numpy.float64), (len(points),))
+    fractions = numpy.zeros(len(points))
+    if len(points) == 0:
+        return fractions
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    # the bands read the margin around the slices of their points twice, 
+    # they are made thick enough for this to be at most as much as their core
+    margin = int(numpy.ceil(sizes.max() / 2)) + 1
+    nearest = numpy.clip(numpy.rint(points[:, 2]).astype(numpy.intp), 0, volume.shape[0] - 1)
+    span = int(nearest.max() - nearest.min()) + 1
+    core = max(2 * margin, -(-span // num_workers))
+    jobs = []
+    for start in range(nearest.min(), nearest.max() + 1, core):
+        selected = numpy.flatnonzero((nearest >= start) & (nearest < start + core))
+        if len(selected) > 0:
+            jobs.append(selected)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        results = executor.map(lambda selected: _fractions_band(volume, gray_range, 
+            points[selected], sizes[selected], geometry), jobs)
+        for selected, result in zip(jobs, results):
+            fractions[selected] = result
+    return fractions
 
 
 class cilRegularPointCloudToPolyData(VTKPythonAlgorithmBase):
@@ -73,6 +610,10 @@ class cilRegularPointCloudToPolyData(VTKPythonAlgorithmBase):
     SQUARE = 'square'
     CUBE   = 'cube'
     SPHERE = 'sphere'
+    CUBIC = 'cubic'
+    BCC = 'bcc'
+    FCC = 'fcc'
+    HCP = 'hcp'
     def __init__(self):
         VTKPythonAlgorithmBase.__init__(self, nInputPorts=1, nOutputPorts=1)
         self._Points = vtk.vtkPoints()
@@ -84,6 +625,9 @@ class cilRegularPointCloudToPolyData(VTKPythonAlgorithmBase):
         self._Mode = self.CUBE
         self._SubVolumeRadius = 1 #: Radius of the subvolume in voxels
         self._Point0 = None
+        self._Bounds = None #: only the points within the bounds are created
+        self._Lattice = self.CUBIC #: lattice of the points in 3D for spheres
+        self._LatticeIndices = numpy.zeros((0, 3), dtype=numpy.int32)
 
     def GetPoints(self):
         '''Returns the Points'''
@@ -110,6 +654,20 @@ class cilRegularPointCloudToPolyData(VTKPythonAlgorithmBase):
     def GetMode(self):
         return self._Mode
 
+    def SetLattice(self, value):
+        '''Sets the lattice of the points of 3D point clouds of spheres: cubic, bcc, fcc or hcp
+
+        The lattices other than the cubic need fewer points for the same coverage, 
+        for which the overlap is set, see lattice_cell'''
+        if not value in [self.CUBIC, self.BCC, self.FCC, self.HCP]:
+            raise ValueError('Lattice must be in [cubic, bcc, fcc, hcp]. Got', value)
+        if value != self._Lattice:
+            self._Lattice = value
+            self.Modified()
+
+    def GetLattice(self):
+        return self._Lattice
+
     def SetDimensionality(self, value):
         '''Whether the overlap is measured on 2D or 3D'''
         if not value in [2, 3]:
@@ -172,6 +730,44 @@ class cilRegularPointCloudToPolyData(VTKPythonAlgorithmBase):
     def GetSubVolumeRadiusInVoxel(self):
         return self._SubVolumeRadius
 
+    def SetBounds(self, value):
+        '''Creates only the points of the lattice within the bounds (xmin, xmax, ymin, ymax, zmin, zmax), 
+        e.g. those which may be in a mask. None to create the points on the whole image'''
+        if value is not None:
+            if len(value) != 6:
+                raise ValueError('Bounds must be a list of 6 elements. Got', value)
+            value = [float(v) for v in value]
+        if self._Bounds != value:
+            self._Bounds = value
+            self.Modified()
+
+    def GetBounds(self):
+        return self._Bounds
+
+    def _GetAxisBounds(self, axis):
+        if self._Bounds is None:
+            return None
+        return self._Bounds[2*axis:2*axis+2]
+
+    def EstimateNumberOfPoints(self, number_of_voxels, image_spacing):
+        '''Estimates the number of points of the lattice within a region of number_of_voxels voxels, 
+        without creating them.
+
+        For 2D point clouds number_of_voxels are the voxels of the region on the slice'''
+        point_spacing = self.CalculatePointSpacing(self.GetOverlap(), mode=self.GetMode())
+        axes = [0, 1, 2]
+        if self.GetDimensionality() == 2:
+            axes.remove(self.GetOrientation())
+        cell = numpy.prod([point_spacing[i] for i in axes])
+        voxel = numpy.prod([image_spacing[i] for i in axes])
+        if cell <= 0:
+            return 0
+        points_per_cell = 1
+        if self.GetDimensionality() == 3 and self.GetMode() == self.SPHERE:
+            lattice_size, basis = lattice_cell(self.GetLattice())
+            points_per_cell = len(basis) / numpy.prod(lattice_size)
+        return int(round(number_of_voxels * voxel / cell * points_per_cell))
+
     def FillInputPortInformation(self, port, info):
         if port == 0:
             info.Set(vtk.vtkAlgorithm.INPUT_REQUIRED_DATA_TYPE(), "vtkImageData")
@@ -227,18 +823,10 @@ class cilRegularPointCloudToPolyData(VTKPythonAlgorithmBase):
         returns:
             vtkPoints
         '''
-
-        vtkPointCloud = self._Points
         image_spacing = list ( image_data.GetSpacing() )
         image_origin  = list ( image_data.GetOrigin() )
         image_dimensions = list ( image_data.GetDimensions() )
-        # print ("spacing    : ", image_spacing)
-        # print ("origin     : ", image_origin)
-        # print ("dimensions : ", image_dimensions)
-        # print ("point spacing ", point_spacing)
 
-        if self._Point0 is not None:
-            vtkPointCloud.InsertNextPoint(*self._Point0)
         #label orientation axis as a, with plane being viewed labelled as bc
         
         # reduce to 2D on the proper orientation
@@ -251,40 +839,37 @@ class cilRegularPointCloudToPolyData(VTKPythonAlgorithmBase):
         max_c = image_dimensions[1] * image_spacing [1]/ point_spacing[1]
 
         a = sliceno * spacing_a #- origin_a
-
-        # skip the offset in voxels
-        offset = [0, 0]
-
-        # Loop through points in plane bc
-        n_b = offset[0]
-
-        # total number of steps
-        tot = max_b * max_c
-        while n_b < max_b:
-            n_c = offset[1]
-
-            while n_c < max_c:
-
-                b = (n_b / max_b) * image_spacing[0] * image_dimensions[0] #- image_origin[0] #+ int(image_dimensions[0] * density[0] * .7)
-                c = (n_c / max_c) * image_spacing[1] * image_dimensions[1]# - image_origin[1] #+ int(image_dimensions[1] * density[1] * .7)
-
-                if self.GetOrientation() == 0: #YZ
-                    vtkPointCloud.InsertNextPoint( a, b, c)
-                    # print(c)
-                    
-                elif self.GetOrientation() == 1: #XZ
-                    vtkPointCloud.InsertNextPoint( b, a, c)
-                    # print(c)
-
-                elif self.GetOrientation() == 2: #XY
-                    vtkPointCloud.InsertNextPoint( b, c, a)
-                    # print(a)
-
-                n_c += 1
-
-            n_b += 1
-            self.UpdateProgress((n_c + max_b * n_b ) / tot)
-
+        bounds_a = self._GetAxisBounds(orientation)
+        if bounds_a is not None and not bounds_a[0] <= a <= bounds_a[1]:
+            # the slice is out of the bounds
+            max_b = max_c = 0
+        axes = [i for i in range(3) if i != orientation]
+
+        # coordinates of the points on the axes of the plane
+        ib = lattice_indices(max_b, image_spacing[0] * image_dimensions[0], bounds=self._GetAxisBounds(axes[0]))
+        ic = lattice_indices(max_c, image_spacing[1] * image_dimensions[1], bounds=self._GetAxisBounds(axes[1]))
+        b = ib / max_b * image_spacing[0] * image_dimensions[0] if len(ib) else numpy.zeros((0,))
+        c = ic / max_c * image_spacing[1] * image_dimensions[1] if len(ic) else numpy.zeros((0,))
+        self.UpdateProgress(0.5)
+
+        # c varies fastest
+        bb, cc = numpy.meshgrid(b, c, indexing='ij')
+        aa = numpy.full(bb.shape, a)
+        ibb, icc = numpy.meshgrid(ib, ic, indexing='ij')
+        iaa = numpy.zeros(ibb.shape, dtype=numpy.int32)
+        if orientation == 0: #YZ
+            points = (aa, bb, cc)
+            indices = (iaa, ibb, icc)
+        elif orientation == 1: #XZ
+            points = (bb, aa, cc)
+            indices = (ibb, iaa, icc)
+        else: #XY
+            points = (bb, cc, aa)
+            indices = (ibb, icc, iaa)
+
+        self.SetPointsFromArray(numpy.stack([p.ravel() for p in points], axis=1),
+            numpy.stack([i.ravel() for i in indices], axis=1))
+        self.UpdateProgress(1.0)
         return 1
 
     def CreatePoints3D(self, point_spacing , image_data, orientation, sliceno):
@@ -300,67 +885,70 @@ class cilRegularPointCloudToPolyData(VTKPythonAlgorithmBase):
         returns:
             vtkPoints
         '''
-        vtkPointCloud = self._Points
         image_spacing = list ( image_data.GetSpacing() )
         image_origin  = list ( image_data.GetOrigin() )
         image_dimensions = list ( image_data.GetDimensions() )
 
-        if self._Point0 is not None:
-            vtkPointCloud.InsertNextPoint(*self._Point0)
-
-        # the total number of points on X and Y axis
-        max_x = image_dimensions[0] * image_spacing[0] / point_spacing[0]
-        max_y = image_dimensions[1] * image_spacing[1] / point_spacing[1]
-        max_z = image_dimensions[2] * image_spacing [2] / point_spacing[2]
-
-        # print ("max: {} {} {}".format((max_x, max_y, max_z), image_dimensions, point_spacing))
-        # print ("max_y: {} {} {}".format(max_y, image_dimensions, density))
+        # the lattice is made of a point for each element of the basis in each cell
+        cell, basis = lattice_cell(self.GetLattice() if self.GetMode() == self.SPHERE else self.CUBIC)
+        cell_size = [cell[i] * point_spacing[i] for i in range(3)]
 
-        # print ("Sliceno {} Z {}".format(sliceno, z))
-
-        # skip the offset in voxels
-        # radius = self.GetSubVolumeRadiusInVoxel()
+        # the total number of cells on X, Y and Z axis
+        max_x = image_dimensions[0] * image_spacing[0] / cell_size[0]
+        max_y = image_dimensions[1] * image_spacing[1] / cell_size[1]
+        max_z = image_dimensions[2] * image_spacing [2] / cell_size[2]
 
         #Offset according to the orientation and slice no.
         offset = [0, 0, 0]
 
-        if sliceno < point_spacing[orientation]:
+        if sliceno < cell_size[orientation]:
             offset[orientation] = sliceno
         else:
-            offset[orientation] = sliceno % point_spacing[orientation]
-        
-        n_x=0
-        tot = max_x * max_y * max_z
-
-        while n_x < max_x:
-            # x axis
-            n_y = 0
-            while n_y < max_y:
-                # y axis
-                n_z = 0
-                while n_z < max_z:
-                    x = (n_x / max_x) * image_spacing[0] * image_dimensions[0] + offset[0] * image_spacing[0] #- image_origin[0] #+ int(image_dimensions[0] * density[0] * .7)
-                    y = (n_y / max_y) * image_spacing[1] * image_dimensions[1] + offset[1] * image_spacing[1] # - image_origin[1] #+ int(image_dimensions[1] * density[1] * .7)
-                    z = (n_z / max_z) * image_spacing[2] * image_dimensions[2] + offset[2] * image_spacing[2] # - image_origin[2] #+ int(image_dimensions[1] * density[1] * .7)
-
-                    vtkPointCloud.InsertNextPoint( x, y, z )
-                    n_z += 1
+            offset[orientation] = sliceno % cell_size[orientation]
+
+        points = []
+        indices = []
+        for element in basis:
+            axis_indices = []
+            coordinates = []
+            for axis, max_n in enumerate([max_x, max_y, max_z]):
+                length = image_spacing[axis] * image_dimensions[axis]
+                axis_offset = offset[axis] * image_spacing[axis] + element[axis] * point_spacing[axis]
+                n = lattice_indices(max_n, length, axis_offset, bounds=self._GetAxisBounds(axis))
+                axis_indices.append(n)
+                coordinates.append(n / max_n * length + axis_offset if len(n) else numpy.zeros((0,)))
+
+            # z varies fastest, then y, then x
+            xx, yy, zz = numpy.meshgrid(*coordinates, indexing='ij')
+            ixx, iyy, izz = numpy.meshgrid(*axis_indices, indexing='ij')
+            points.append(numpy.stack((xx.ravel(), yy.ravel(), zz.ravel()), axis=1))
+            indices.append(numpy.stack((ixx.ravel(), iyy.ravel(), izz.ravel()), axis=1))
+        self.UpdateProgress(0.5)
+
+        self.SetPointsFromArray(numpy.concatenate(points), numpy.concatenate(indices))
+        self.UpdateProgress(1.0)
+        return 1
 
-                n_y += 1
-                self.UpdateProgress((n_z + max_z * n_y + max_y * max_z * n_x ) / tot)
+    def SetPointsFromArray(self, points, indices=None):
+        '''Sets the points from a (N, 3) array, preceded by point 0 if it is set
 
-            n_x += 1
+        indices are the (N, 3) indices of the points in the lattice'''
+        if indices is None:
+            indices = numpy.zeros(points.shape, dtype=numpy.int32)
+        if self._Point0 is not None:
+            points = numpy.concatenate((numpy.asarray([self._Point0], dtype=points.dtype), points))
+            # point 0 is not on the lattice
+            indices = numpy.concatenate((numpy.full((1, 3), -1, dtype=indices.dtype), indices))
+        self._Points = points_from_array(points)
+        self._LatticeIndices = indices
 
-        return 1
+    def GetLatticeIndices(self):
+        '''Returns the (N, 3) indices in the lattice of the points of the output, -1 for point 0'''
+        return self._LatticeIndices
 
     def FillCells(self):
         '''Fills the Vertices'''
-        vertices = self._Vertices
-        number_of_cells = vertices.GetNumberOfCells()
-        for i in range(self.GetNumberOfPoints()):
-            if i >= number_of_cells:
-                vertices.InsertNextCell(1)
-                vertices.InsertCellPoint(i)
+        self._Vertices = vertices_for_points(self.GetNumberOfPoints())
 
     def CalculatePointSpacing(self, overlap, mode=SPHERE):
         '''returns the ratio between the figure size (radius) and the distance between 2 figures centers in 3D'''
@@ -379,7 +967,7 @@ class cilRegularPointCloudToPolyData(VTKPythonAlgorithmBase):
         '''Calculates the volume overlap for 2 shapes of radius and center distance'''
         if center_distance <= 2*radius:
             if mode == 'circle':
-                overlap = (2 * numpy.acos(center_distance/radius/2.) - \
+                overlap = (2 * numpy.arccos(center_distance/radius/2.) - \
                            (center_distance/radius) *  numpy.sqrt(1 - \
                            (center_distance/radius/2.)*(center_distance/radius/2.)) \
                           ) / 3.1415
@@ -398,32 +986,28 @@ class cilRegularPointCloudToPolyData(VTKPythonAlgorithmBase):
         return overlap
 
     def distance_from_overlap(self, req, interp=False, N=1000, mode='sphere'):
-        '''hard inversion of distance and overlap'''
-        radius = self.GetSubVolumeRadiusInVoxel()
-        x = [2.* i/N * radius for i in range(N+1)]
-        y = [self.overlap(radius, x[i], mode=mode) - req for i in range(N+1)]
-        # find the value closer to 0 for required overlap
-        idx = (y.index(min (y, key=abs)))
-        if interp:
-            if y[idx] * y[idx+1] < 0:
-                m = (y[idx] -y[idx+1]) / (x[idx] -x[idx+1])
-            else:
-                m = (y[idx] -y[idx-1]) / (x[idx] -x[idx-1])
-            q = y[idx] - m * x[idx]
-            x0 = -q / m
-        else:
-            x0 = x[idx]
-        return x0
+        '''inversion of distance and overlap
+
+        closed form for squares, cubes and spheres, sampled on N points for circles'''
+        return distance_from_overlap(self.GetSubVolumeRadiusInVoxel(), req, interp=interp, N=N, mode=mode)
 
 
 class cilNumpyPointCloudToPolyData(VTKPythonAlgorithmBase):
     '''vtkAlgorithm to read a point cloud from a NumPy array
+
+    Each row of the array is a point: id, x, y, z and optionally the
+    subvolume size of the point, which is set as the point scalars.
     '''
     def __init__(self):
         VTKPythonAlgorithmBase.__init__(self, nInputPorts=0, nOutputPorts=1)
         self._Points = vtk.vtkPoints()
         self._Vertices = vtk.vtkCellArray()
         self._Data = None
+        # incremented when the data changes, the points are rebuilt only if 
+        # they were created from a previous version
+        self._DataVersion = 0
+        self._PointsVersion = -1
+        self._Sizes = None
 
 
     def GetPoints(self):
@@ -434,13 +1018,22 @@ class cilNumpyPointCloudToPolyData(VTKPythonAlgorithmBase):
         if not isinstance (value, numpy.ndarray) :
             raise ValueError('Data must be a numpy array. Got', value)
 
-        if not numpy.array_equal(value,self._Data):
+        if value is not self._Data:
             self._Data = value
-            self.Modified()
+            self.DataModified()
+
+    def DataModified(self):
+        '''To be called if the array passed to SetData is modified in place'''
+        self._DataVersion += 1
+        self.Modified()
 
     def GetData(self):
         return self._Data
 
+    def HasSubVolumeSizes(self):
+        '''Whether the data has the subvolume size of each point'''
+        return self._Data is not None and numpy.ndim(self._Data) == 2 and numpy.shape(self._Data)[1] > 4
+
 
     def GetNumberOfPoints(self):
         '''returns the number of points in the point cloud'''
@@ -461,23 +1054,28 @@ class cilNumpyPointCloudToPolyData(VTKPythonAlgorithmBase):
         # print ("Request Data")
         # output_image = vtk.vtkDataSet.GetData(inInfo[0])
         pointPolyData = vtk.vtkPolyData.GetData(outInfo)
-        vtkPointCloud = self._Points
-        for point in self.GetData():
-            # point = id, x, y, z
-            vtkPointCloud.InsertNextPoint( point[1] , point[2] , point[3])
-
-        self.FillCells()
+        if self._PointsVersion != self._DataVersion:
+            data = self.GetData()
+            self._Sizes = None
+            if data is None or numpy.size(data) == 0:
+                points = numpy.zeros((0, 3))
+            else:
+                # point = id, x, y, z[, subvolume size]
+                data = numpy.atleast_2d(data)
+                points = data[:, 1:4]
+                if data.shape[1] > 4:
+                    self._Sizes = numpy_support.numpy_to_vtk(numpy.ascontiguousarray(data[:, 4], dtype=numpy.float32), deep=1)
+                    self._Sizes.SetName('subvol_size')
+            self._Points = points_from_array(points)
+            self.FillCells()
+            self._PointsVersion = self._DataVersion
 
         pointPolyData.SetPoints(self._Points)
         pointPolyData.SetVerts(self._Vertices)
+        pointPolyData.GetPointData().SetScalars(self._Sizes)
         return 1
 
 
     def FillCells(self):
         '''Fills the Vertices'''
-        vertices = self._Vertices
-        number_of_cells = vertices.GetNumberOfCells()
-        for i in range(self.GetNumberOfPoints()):
-            if i >= number_of_cells:
-                vertices.InsertNextCell(1)
-                vertices.InsertCellPoint(i)
+        self._Vertices = vertices_for_points(self.GetNumberOfPoints())
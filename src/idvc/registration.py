@@ -0,0 +1,106 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import numpy
+
+
+def _window(shape):
+    '''Hann window over a (z, y, x) array, so that its borders don't correlate'''
+    window = numpy.ones(shape, dtype=numpy.float32)
+    for axis, n in enumerate(shape):
+        profile = numpy.hanning(n) if n > 2 else numpy.ones(n)
+        window *= profile.astype(numpy.float32).reshape([-1 if a == axis else 1 for a in range(len(shape))])
+    return window
+
+def _peak_offset(minus, centre, plus):
+    '''Offset from the centre of the peak of the gaussian through three samples, within half a voxel
+
+    If the samples are not all positive, the vertex of the parabola through them.'''
+    if min(minus, centre, plus) > 0:
+        minus, centre, plus = numpy.log([minus, centre, plus])
+    curvature = minus - 2 * centre + plus
+    if curvature >= 0:
+        return 0.
+    return float(numpy.clip(0.5 * (minus - plus) / curvature, -0.5, 0.5))
+
+def _correlation_peak(reference, correlate, limits, sigma):
+    '''Peak of the phase correlation of the (z, y, x) arrays, searched within limits voxels on each axis
+
+    Returns the (z, y, x) shift of the peak, refined to sub-voxel precision, and its height.'''
+    shape = reference.shape
+    window = _window(shape)
+    spectra = []
+    for image in (reference, correlate):
+        image = image.astype(numpy.float32)
+        spectra.append(numpy.fft.rfftn((image - image.mean()) * window))
+    cross = spectra[1] * numpy.conj(spectra[0])
+    del spectra
+    cross /= numpy.maximum(numpy.abs(cross), numpy.finfo(numpy.float32).tiny)
+    # weigh down the high frequencies, where the noise is, which makes the peak a gaussian of sigma voxels
+    frequencies = numpy.meshgrid(*[numpy.fft.fftfreq(n) for n in shape[:-1]], numpy.fft.rfftfreq(shape[-1]),
+        indexing='ij', sparse=True)
+    cross *= numpy.exp(-2 * (numpy.pi * sigma) ** 2 * sum(f ** 2 for f in frequencies))
+    surface = numpy.fft.irfftn(cross, s=shape, axes=tuple(range(len(shape))))
+    # the height of the peak of identical arrays
+    surface /= numpy.prod([numpy.mean(numpy.exp(-2 * (numpy.pi * sigma * numpy.fft.fftfreq(n)) ** 2)) for n in shape])
+
+    # the shift of each index of the surface along each axis
+    shifts = [numpy.rint(numpy.fft.fftfreq(n, 1 / n)).astype(int) for n in shape]
+    search = surface.copy()
+    for axis, shift in enumerate(shifts):
+        index = [slice(None)] * len(shape)
+        index[axis] = numpy.abs(shift) > min(limits[axis], shape[axis] // 2)
+        search[tuple(index)] = -numpy.inf
+    peak = numpy.unravel_index(numpy.argmax(search), shape)
+
+    translation = []
+    for axis, n in enumerate(shape):
+        neighbours = []
+        for step in (-1, 1):
+            index = list(peak)
+            index[axis] = (index[axis] + step) % n
+            neighbours.append(surface[tuple(index)])
+        offset = _peak_offset(neighbours[0], surface[peak], neighbours[1]) if n > 2 else 0.
+        translation.append(shifts[axis][peak[axis]] + offset)
+    return translation, float(surface[peak])
+
+def phase_correlation(reference, correlate, max_shift=None, sigma=1.):
+    '''Estimates the translation of correlate with respect to reference by phase correlation
+
+    reference and correlate are (z, y, x) arrays of the same shape. The translation
+    t is such that what is at x in reference is at x + t in correlate, as the rigid
+    body offset given to dvc. Only the translations of at most max_shift voxels
+    on each axis are searched, and at most half the size of the arrays.
+    The cross power spectrum is weighed by a gaussian, so that the peak of the
+    correlation is a gaussian of sigma voxels, which is fitted through the peak
+    and its neighbours along each axis for the sub-voxel translation. This is
+    then refined on the overlap of the arrays at the integer translation.
+    Returns the (x, y, z) translation and the height of the peak, which is 1 if
+    correlate is exactly reference translated and near 0 if they are unrelated.'''
+    if reference.shape != correlate.shape:
+        raise ValueError('Expected arrays of the same shape, got {} and {}'.format(reference.shape, correlate.shape))
+    shape = reference.shape
+    if max_shift is None:
+        max_shift = max(shape)
+    translation, height = _correlation_peak(reference, correlate, [max_shift] * 3, sigma)
+
+    # the window of the arrays biases the peak towards no translation,
+    # which is removed by correlating again the parts which overlap
+    shift = [int(round(t)) for t in translation]
+    overlap = [n - abs(t) for n, t in zip(shape, shift)]
+    if any(shift) and min(overlap) >= 8:
+        reference = reference[tuple(slice(max(0, -t), max(0, -t) + m) for t, m in zip(shift, overlap))]
+        correlate = correlate[tuple(slice(max(0, t), max(0, t) + m) for t, m in zip(shift, overlap))]
+        residual, height = _correlation_peak(reference, correlate, [1] * 3, sigma)
+        translation = [t + r for t, r in zip(shift, residual)]
+    # x, y and z are axes 2, 1 and 0 of the array
+    return translation[::-1], height
@@ -86,6 +86,17 @@ class SettingsWindow(QDialog):
         self.omp_threads_entry.setSingleStep(1)
         self.omp_threads_label = QLabel("OMP Threads: ")
 
+        # number of DVC runs which can be executed at the same time,
+        # the OMP threads are shared between them
+        self.concurrent_runs_entry = QSpinBox(self)
+        self.concurrent_runs_entry.setRange(1, n_cores)
+        self.concurrent_runs_entry.setSingleStep(1)
+        if self.parent.settings.value("dvc_concurrent_runs") is not None:
+            self.concurrent_runs_entry.setValue(int(self.parent.settings.value("dvc_concurrent_runs")))
+        else:
+            self.concurrent_runs_entry.setValue(1)
+        self.concurrent_runs_label = QLabel("Concurrent DVC runs: ")
+
 
         self.layout = QVBoxLayout(self)
         self.layout.addWidget(self.dark_checkbox)
@@ -101,6 +112,8 @@ class SettingsWindow(QDialog):
 
         self.layout.addWidget(self.omp_threads_label)
         self.layout.addWidget(self.omp_threads_entry)
+        self.layout.addWidget(self.concurrent_runs_label)
+        self.layout.addWidget(self.concurrent_runs_entry)
 
 
         self.buttons = QDialogButtonBox(
@@ -139,6 +152,7 @@ class SettingsWindow(QDialog):
             self.parent.settings.setValue("first_app_load", "False")
             
         self.parent.settings.setValue("omp_threads", str(self.omp_threads_entry.value()))
+        self.parent.settings.setValue("dvc_concurrent_runs", str(self.concurrent_runs_entry.value()))
         self.close()
 
 
@@ -8,6 +8,7 @@ import matplotlib.pyplot as plt
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
 from idvc.pointcloud_conversion import PointCloudConverter
+from idvc.masks import MASK_EXTENSION
 from functools import partial
 import shutil
 import os
@@ -38,13 +39,10 @@ class SingleRunResultsWidget(QtWidgets.QWidget):
 
     def CreateHistogram(self, result, displ_wrt_point0):
         displ = np.asarray(
-        PointCloudConverter.loadPointCloudFromCSV(result.disp_file,'\t')[:]
+        PointCloudConverter.loadPointCloudFromCSV(result.disp_file,'\t')
         )
         if displ_wrt_point0:
-            point0_disp = [displ[0][6],displ[0][7], displ[0][8]]
-            for count in range(len(displ)):
-                for i in range(3):
-                    displ[count][i+6] = displ[count][i+6] - point0_disp[i]
+            displ[:,6:9] -= displ[0,6:9].copy()
 
         plot_data = [displ[:,i] for i in range(5, displ.shape[1])]
 
@@ -195,13 +193,10 @@ Rigid Body Offset: {rigid_trans}".format(subvol_geom=result.subvol_geom, \
 
         for result in result_list:
             displ = np.asarray(
-            PointCloudConverter.loadPointCloudFromCSV(result.disp_file,'\t')[:]
+            PointCloudConverter.loadPointCloudFromCSV(result.disp_file,'\t')
             )
             if displ_wrt_point0:
-                point0_disp = [displ[0][6],displ[0][7], displ[0][8]]
-                for count in range(len(displ)):
-                    for i in range(3):
-                        displ[count][i+6] = displ[count][i+6] - point0_disp[i]
+                displ[:,6:9] -= displ[0,6:9].copy()
 
             no_points = np.shape(displ[0])
 
@@ -316,7 +311,8 @@ class SaveObjectWindow(QtWidgets.QWidget):
         if self.object == "mask":
             #Load Saved Session
             #print("Write mask to file, then carry on")
-            filename = self.textbox.text() + ".mha"
+            filename = self.textbox.text() + MASK_EXTENSION
+            self.parent.mask_writer.wait()
             shutil.copyfile(os.path.join(tempfile.tempdir, self.parent.mask_file), os.path.join(tempfile.tempdir, "Masks", filename))
             self.parent.mask_parameters['masksList'].addItem(filename)
             self.parent.mask_details[filename] = self.parent.mask_details['current']
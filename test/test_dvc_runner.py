@@ -0,0 +1,345 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+import numpy
+
+try:
+    from idvc.dvc_runner import split_point_cloud, ShardedResult, DVC_runner, crop_extent, shift_roi_file, \
+        RunManifest, is_complete_result
+    from idvc.io import crop_raw_volume, open_raw_volume
+    has_dependencies = True
+except ImportError:
+    has_dependencies = False
+
+
+@unittest.skipUnless(has_dependencies, "The dependencies of idvc are not installed")
+class TestSplitPointCloud(unittest.TestCase):
+    def setUp(self):
+        self.coords = numpy.random.default_rng(0).uniform(0, 100, (1001, 3)) * [1, 2, 0.5]
+
+    def test_partition(self):
+        for n_shards in [1, 2, 3, 7]:
+            shards = split_point_cloud(self.coords, n_shards)
+            self.assertEqual(len(shards), n_shards)
+            # each point is in one shard, the shards are sorted and of similar size
+            numpy.testing.assert_array_equal(numpy.sort(numpy.concatenate(shards)), numpy.arange(len(self.coords)))
+            for shard in shards:
+                numpy.testing.assert_array_equal(shard, numpy.sort(shard))
+                self.assertLessEqual(abs(len(shard) - len(self.coords) / n_shards), 1)
+
+    def test_spatially_coherent(self):
+        # the first cut is across the longest side of the bounding box, y
+        left, right = split_point_cloud(self.coords, 2)
+        self.assertLessEqual(self.coords[left, 1].max(), self.coords[right, 1].min())
+
+    def test_more_shards_than_points(self):
+        self.assertEqual(len(split_point_cloud(self.coords[:3], 5)), 3)
+
+
+@unittest.skipUnless(has_dependencies, "The dependencies of idvc are not installed")
+class TestShardedResult(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write_shard(self, k, rows, stat):
+        shard_folder = os.path.join(self.folder, "shard_{}".format(k))
+        os.mkdir(shard_folder)
+        output = os.path.join(shard_folder, "dvc_result_0_shard_{}".format(k))
+        with open(output + ".disp", "w") as f:
+            f.write("n\tx\ty\tz\tstatus\n")
+            f.writelines(["{}\t{}\n".format(number, rest) for number, rest in rows])
+        with open(output + ".stat", "w") as f:
+            f.writelines(["{}\t{}\n".format(key, value) for key, value in stat])
+        return output
+
+    def test_merge(self):
+        config_values = dict(output_filename=os.path.join(self.folder, "dvc_result_0"),
+            point_cloud_filename="grid_input.roi", num_points_to_process=5,
+            starting_point="1.0 1.0 1.0", subvol_size=30)
+        result = ShardedResult(self.folder, config_values)
+        # the points at lines 0 to 4 of the roi file, numbered 110 to 114, are split in two shards,
+        # where they are numbered from 1 in the order they are run, from the starting point of the shard
+        shards = [([3, 0, 1], [10, 11, 12]), ([4, 2], [14, 13])]
+        for k, (positions, point_numbers) in enumerate(shards):
+            rows = [(i + 1, "{}.0\t0.0\t0.0\t{}".format(number, k)) for i, number in enumerate(point_numbers)]
+            stat = [("point_cloud_filename", "shard.roi"), ("output_filename", "shard"),
+                ("num_points_to_process", len(positions)), ("starting_point", "9 9 9"), ("subvol_size", 30)]
+            output = self.write_shard(k, rows, stat)
+            result.add_shard(SimpleNamespace(), output, positions, [str(number + 100) for number in point_numbers])
+        result.merge()
+
+        with open(config_values['output_filename'] + ".disp") as f:
+            lines = f.readlines()
+        self.assertEqual(lines[0], "n\tx\ty\tz\tstatus\n")
+        # sorted as in the roi file and renumbered with the original point numbers
+        rows = [line.split() for line in lines[1:]]
+        self.assertEqual([row[0] for row in rows], ['111', '112', '113', '110', '114'])
+        self.assertEqual([row[1] for row in rows], ['11.0', '12.0', '13.0', '10.0', '14.0'])
+        self.assertEqual([row[4] for row in rows], ['0', '0', '1', '0', '1'])
+
+        # the stat file has the parameters of the whole run first, from the shard with point 0
+        with open(config_values['output_filename'] + ".stat") as f:
+            stat = f.read().split("\n### ")
+        self.assertEqual(len(stat), 2)
+        first = dict(line.split("\t") for line in stat[0].splitlines() if line)
+        self.assertEqual(first['point_cloud_filename'], "grid_input.roi")
+        self.assertEqual(first['num_points_to_process'], "5")
+        self.assertEqual(first['starting_point'], "1.0 1.0 1.0")
+        self.assertTrue(stat[1].startswith("dvc_result_0_shard_1\n"))
+        # the shard folders are removed
+        self.assertEqual(sorted(os.listdir(self.folder)), ["dvc_result_0.disp", "dvc_result_0.stat"])
+
+
+@unittest.skipUnless(has_dependencies, "The dependencies of idvc are not installed")
+class TestCrop(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_extent(self):
+        self.assertEqual(crop_extent([10, 20, 5], [15, 22, 30], [100, 100, 32], [3, 4, 5]), [7, 19, 16, 27, 0, 32])
+        # the voxels within margin of the box, which isn't on the voxels
+        low, high, margin = [10.4, 3.5, 7.], [12.6, 8.2, 7.], [2, 1.5, 0]
+        extent = crop_extent(low, high, [50, 50, 50], margin)
+        for axis in range(3):
+            inside = numpy.arange(50)[(numpy.arange(50) >= low[axis] - margin[axis]) & 
+                (numpy.arange(50) <= high[axis] + margin[axis])]
+            self.assertLessEqual(extent[2 * axis], inside.min())
+            self.assertGreater(extent[2 * axis + 1], inside.max())
+            self.assertLessEqual(extent[2 * axis + 1] - extent[2 * axis], len(inside) + 2)
+
+    def test_crop_raw_volume(self):
+        # 16 bit, big endian, with a header
+        dims = [13, 11, 9]
+        volume = numpy.random.default_rng(0).integers(0, 65536, dims[::-1]).astype('>u2')
+        filename = os.path.join(self.folder, "volume.raw")
+        with open(filename, "wb") as f:
+            f.write(b'header!')
+            volume.tofile(f)
+        extent = [2, 9, 0, 11, 3, 8]
+        crop_file = os.path.join(self.folder, "crop.raw")
+        crop_raw_volume(filename, crop_file, dims, 16, 7, 'big', extent)
+        self.assertEqual(os.path.getsize(crop_file), 7 * 11 * 5 * 2)
+        numpy.testing.assert_array_equal(open_raw_volume(crop_file, [7, 11, 5], 16, 0, 'big'), volume[3:8, 0:11, 2:9])
+
+    def test_restore_crop(self):
+        # the points are shifted into the cropped volumes, and the outputs of dvc back
+        points = numpy.array([[12.5, 20., 7.25], [30., 4.125, 9.]])
+        offset = [10, 3, 5]
+        roi_file = os.path.join(self.folder, "points.roi")
+        with open(roi_file, "w") as f:
+            f.writelines(["{}\t{}\t{}\t{}\n".format(i + 1, *point) for i, point in enumerate(points)])
+        grid_roi = os.path.join(self.folder, "grid_input.roi")
+        shift_roi_file(roi_file, grid_roi, [-o for o in offset])
+        with open(grid_roi) as f:
+            shifted = numpy.array([line.split()[1:4] for line in f], dtype=float)
+        numpy.testing.assert_allclose(shifted, points - offset)
+
+        output = os.path.join(self.folder, "dvc_result_0")
+        with open(output + ".disp", "w") as f:
+            f.write("n\tx\ty\tz\tstatus\tobjmin\n")
+            f.writelines(["{}\t{}\t{}\t{}\t0\t0.01\n".format(i + 1, *point) for i, point in enumerate(shifted)])
+        with open(output + ".stat", "w") as f:
+            f.write("vol_wide\t20\nstarting_point\t2.5 17.0 2.25\nsubvol_size\t30\n")
+        runner = DVC_runner(None, None, None, True, self.folder)
+        runner.crop_offset = offset
+        runner.starting_point = list(points[0])
+        runner.restore_crop(output)
+
+        with open(output + ".disp") as f:
+            lines = f.readlines()
+        self.assertEqual(lines[0], "n\tx\ty\tz\tstatus\tobjmin\n")
+        rows = [line.split() for line in lines[1:]]
+        numpy.testing.assert_allclose(numpy.array([row[1:4] for row in rows], dtype=float), points)
+        self.assertEqual([row[0] for row in rows], ['1', '2'])
+        self.assertEqual([row[4:] for row in rows], [['0', '0.01']] * 2)
+        with open(output + ".stat") as f:
+            self.assertEqual(f.read(), "vol_wide\t20\nstarting_point\t12.5 20.0 7.25\nsubvol_size\t30\n")
+
+
+class RunTestCase(unittest.TestCase):
+    '''Creates the runs of a session on small volumes'''
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.folder = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.folder, "Results"))
+        self.dims = [60, 50, 40]
+        volume = numpy.random.default_rng(0).integers(0, 256, self.dims[::-1]).astype(numpy.uint8)
+        for name in ["reference", "correlate"]:
+            volume.tofile(os.path.join(self.folder, name + ".raw"))
+        self.points = numpy.array([[10., 12., 11.], [14., 12., 11.], [12., 16., 13.]])
+        self.callbacks = dict(message_callback=SimpleNamespace(emit=lambda *args: None),
+            progress_callback=SimpleNamespace(emit=lambda *args: None))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.folder)
+
+    def set_up_run(self, name, points, **kwargs):
+        '''Writes the point cloud and the config of a run and creates its jobs'''
+        roi_file = os.path.join(self.folder, name + ".roi")
+        with open(roi_file, "w") as f:
+            f.writelines(["{}\t{}\t{}\t{}\n".format(i + 1, *point) for i, point in enumerate(points)])
+        os.makedirs(os.path.join(self.folder, "Results", name), exist_ok=True)
+        config = dict(subvolume_points=[100], subvolume_sizes=[6], points=len(points), roi_files=[roi_file],
+            reference_file=os.path.join(self.folder, "reference.raw"),
+            correlate_file=os.path.join(self.folder, "correlate.raw"),
+            vol_bit_depth='8', vol_hdr_lngth='0', vol_endian='little', dims=self.dims, subvol_geom='cube',
+            subvol_npts=100, disp_max=['2'], dof='6', obj='znssd', interp_type='tricubic',
+            rigid_trans='0.0 0.0 0.0', point0_world_coordinate=list(points[0]),
+            run_folder=os.path.join("Results", name))
+        input_file = os.path.join(self.folder, name + ".json")
+        with open(input_file, "w") as f:
+            json.dump(config, f)
+        runner = DVC_runner(None, input_file, None, True, self.folder, **kwargs)
+        runner.set_up(**self.callbacks)
+        self.assertEqual(len(runner.processes), 1)
+        return runner, runner.processes[0]
+
+    def complete_run(self, runner, job, name):
+        '''Writes the outputs of the job as dvc would and stores them in the cache'''
+        output = os.path.join(self.folder, "Results", name, "dvc_result_0", "dvc_result_0")
+        with open(os.path.join(job.run_folder, "grid_input.roi")) as f:
+            rows = f.readlines()
+        with open(output + ".disp", "w") as f:
+            f.write("n\tx\ty\tz\n")
+            f.writelines(rows)
+        with open(output + ".stat", "w") as f:
+            f.write("num_points_to_process\t{}\n".format(len(rows)))
+        runner.store_in_cache(job.cache_key, output)
+        return output
+
+
+@unittest.skipUnless(has_dependencies, "The dependencies of idvc are not installed")
+class TestCroppedRunCache(RunTestCase):
+    def test_translated_point_clouds(self):
+        # the two point clouds are in the same position in their cropped volumes
+        first, job = self.set_up_run("run_a", self.points)
+        self.assertIsNotNone(first.crop_offset)
+        self.assertEqual(job.status, 'queued')
+        self.complete_run(first, job, "run_a")
+
+        translated, translated_job = self.set_up_run("run_b", self.points + [20, 15, 10])
+        self.assertEqual(translated_job.status, 'queued')
+        self.assertNotEqual(translated_job.cache_key, job.cache_key)
+        # the same point cloud is found in the cache
+        same, same_job = self.set_up_run("run_c", self.points)
+        self.assertEqual(same_job.status, 'succeeded')
+        self.assertTrue(same_job.cached)
+
+    def test_crop_only_for_queued_runs(self):
+        first, job = self.set_up_run("run_a", self.points)
+        self.assertTrue(os.path.exists(os.path.join(self.folder, "Results", "run_a", "reference_crop.raw")))
+        with open(job.param_file[0]) as f:
+            self.assertIn("reference_crop.raw", f.read())
+        self.complete_run(first, job, "run_a")
+        # all the runs are in the cache, the volumes are not copied
+        same, same_job = self.set_up_run("run_c", self.points)
+        self.assertTrue(same_job.cached)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.folder, "Results", "run_c"))),
+            ["_run_manifest.json", "dvc_result_0"])
+
+
+@unittest.skipUnless(has_dependencies, "The dependencies of idvc are not installed")
+class TestRunManifest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_status(self):
+        manifest = RunManifest(self.folder)
+        self.assertIsNone(manifest.get_status("dvc_result_0"))
+        for status in ['queued', 'running', 'succeeded']:
+            manifest.set_status("dvc_result_0", status)
+            self.assertEqual(RunManifest(self.folder).get_status("dvc_result_0"), status)
+        manifest.set_status("dvc_result_1", 'failed', error="crashed", save=False)
+        self.assertIsNone(RunManifest(self.folder).get_status("dvc_result_1"))
+        manifest.save()
+        reloaded = RunManifest(self.folder)
+        self.assertEqual(reloaded.get_status("dvc_result_1"), 'failed')
+        self.assertEqual(reloaded.runs["dvc_result_1"]['error'], "crashed")
+        self.assertEqual(reloaded.get_status("dvc_result_0"), 'succeeded')
+
+    def test_unreadable(self):
+        with open(os.path.join(self.folder, "_run_manifest.json"), "w") as f:
+            f.write("{")
+        self.assertEqual(RunManifest(self.folder).runs, {})
+
+    def test_complete_result(self):
+        output = os.path.join(self.folder, "dvc_result_0")
+        self.assertFalse(is_complete_result(output, 2))
+        with open(output + ".disp", "w") as f:
+            f.write("n\tx\ty\tz\n1\t0\t0\t0\n")
+        with open(output + ".stat", "w") as f:
+            pass
+        self.assertFalse(is_complete_result(output, 1))
+        with open(output + ".stat", "w") as f:
+            f.write("num_points_to_process\t2\n")
+        self.assertTrue(is_complete_result(output, 1))
+        self.assertFalse(is_complete_result(output, 2))
+
+
+@unittest.skipUnless(has_dependencies, "The dependencies of idvc are not installed")
+class TestResume(RunTestCase):
+    def setUp(self):
+        super().setUp()
+        runner, job = self.set_up_run("run_a", self.points, use_cache=False)
+        self.assertEqual(RunManifest(runner.run_folder).get_status("dvc_result_0"), 'queued')
+        self.output = self.complete_run(runner, job, "run_a")
+        runner.manifest.set_status("dvc_result_0", 'succeeded')
+
+    def test_succeeded(self):
+        runner, job = self.set_up_run("run_a", self.points, use_cache=False, resume=True)
+        self.assertEqual(job.status, 'succeeded')
+        self.assertTrue(job.resumed)
+        self.assertTrue(is_complete_result(self.output, len(self.points)))
+
+    def test_not_succeeded(self):
+        # the outputs may have all their rows, but the run was not completed
+        for status in ['running', 'cancelled', 'failed', None]:
+            manifest = RunManifest(os.path.join(self.folder, "Results", "run_a"))
+            if status is None:
+                del manifest.runs["dvc_result_0"]
+                manifest.save()
+            else:
+                manifest.set_status("dvc_result_0", status)
+            runner, job = self.set_up_run("run_a", self.points, use_cache=False, resume=True)
+            self.assertEqual(job.status, 'queued', msg=status)
+            self.assertFalse(os.path.exists(self.output + ".disp"), msg=status)
+            self.assertEqual(RunManifest(runner.run_folder).get_status("dvc_result_0"), 'queued')
+            self.output = self.complete_run(runner, job, "run_a")
+
+    def test_incomplete(self):
+        with open(self.output + ".disp") as f:
+            lines = f.readlines()
+        with open(self.output + ".disp", "w") as f:
+            f.writelines(lines[:-1])
+        runner, job = self.set_up_run("run_a", self.points, use_cache=False, resume=True)
+        self.assertEqual(job.status, 'queued')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+try:
+    import vtk
+    from idvc.masks import write_mask, read_mask, read_mask_header, erode_mask, kernel_offsets, mask_from_intensity
+    has_vtk = True
+except ImportError:
+    has_vtk = False
+
+
+@unittest.skipUnless(has_vtk, "VTK is not installed")
+class TestMaskFile(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, "mask.msk")
+        self.rng = numpy.random.default_rng(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def round_trip(self, array, **kwargs):
+        origin, spacing = [1., 2., 3.], [0.5, 1., 2.]
+        write_mask(self.filename, array, origin, spacing, **kwargs)
+        mask, header = read_mask(self.filename)
+        numpy.testing.assert_array_equal(mask, array)
+        self.assertEqual(mask.dtype, array.dtype)
+        self.assertEqual(header['dimensions'], list(array.shape[::-1]))
+        self.assertEqual(header['origin'], origin)
+        self.assertEqual(header['spacing'], spacing)
+        self.assertEqual(header['count'], numpy.count_nonzero(array))
+        self.assertFalse(os.path.exists(self.filename + '.part'))
+        return header
+
+    def test_binary_mask(self):
+        # the width of the bounding box is not a multiple of 8, as the bits are packed along x
+        array = numpy.zeros((12, 17, 29), dtype=numpy.uint8)
+        array[2:9, 3:15, 4:25] = self.rng.random((7, 12, 21)) > 0.5
+        header = self.round_trip(array)
+        self.assertTrue(header['packed'])
+        nonzero = numpy.nonzero(array)
+        self.assertEqual(header['bounding_box'], [int(nonzero[2].min()), int(nonzero[2].max()) + 1,
+            int(nonzero[1].min()), int(nonzero[1].max()) + 1, int(nonzero[0].min()), int(nonzero[0].max()) + 1])
+
+    def test_labelled_mask(self):
+        array = self.rng.integers(0, 4, (9, 11, 13)).astype(numpy.uint8)
+        header = self.round_trip(array)
+        self.assertFalse(header['packed'])
+
+    def test_chunks(self):
+        # a chunk of slices holds a few slices of the bounding box, the last one is partial
+        array = (self.rng.random((23, 10, 10)) > 0.3).astype(numpy.uint8)
+        header = self.round_trip(array, chunk_voxels=250, num_workers=3)
+        self.assertEqual(header['chunk_slices'], 2)
+        self.assertEqual(len(header['chunks']), 12)
+
+    def test_empty_mask(self):
+        array = numpy.zeros((4, 5, 6), dtype=numpy.uint8)
+        header = self.round_trip(array)
+        self.assertIsNone(header['bounding_box'])
+        self.assertEqual(header['chunks'], [])
+
+    def test_not_a_mask_file(self):
+        with open(self.filename, "wb") as f:
+            f.write(b'ObjectType = Image\n')
+        with self.assertRaises(ValueError):
+            read_mask_header(self.filename)
+
+
+def brute_force_erosion(mask, kernel_size, shape):
+    '''Erodes the mask by checking each offset of the structuring element, the voxels outside the mask array are in the mask'''
+    radius = [max(1, size) / 2 for size in kernel_size]
+    padded = numpy.pad(mask != 0, [(max(kernel_size), max(kernel_size))] * 3, constant_values=True)
+    eroded = numpy.ones(mask.shape, dtype=bool)
+    nz, ny, nx = mask.shape
+    p = max(kernel_size)
+    for dx in kernel_offsets(kernel_size[0]):
+        for dy in kernel_offsets(kernel_size[1]):
+            for dz in kernel_offsets(kernel_size[2]):
+                if shape == 'sphere' and (dx / radius[0])**2 + (dy / radius[1])**2 + (dz / radius[2])**2 > 1:
+                    continue
+                eroded &= padded[p + dz:p + dz + nz, p + dy:p + dy + ny, p + dx:p + dx + nx]
+    return eroded.astype(numpy.uint8)
+
+
+@unittest.skipUnless(has_vtk, "VTK is not installed")
+class TestErodeMask(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.default_rng(1)
+        # blobs, so that the erosion keeps part of the mask
+        zz, yy, xx = numpy.mgrid[0:37, 0:23, 0:29]
+        self.mask = numpy.zeros((37, 23, 29), dtype=numpy.uint8)
+        for centre, radius in zip(rng.uniform(0, 37, (8, 3)), rng.uniform(4, 10, 8)):
+            self.mask[(xx - centre[0] * 29 / 37)**2 + (yy - centre[1] * 23 / 37)**2 + (zz - centre[2])**2 < radius**2] = 1
+        self.mask[rng.random(self.mask.shape) > 0.97] = 0
+
+    def test_sphere(self):
+        for kernel_size in ([5, 5, 5], [3, 6, 4], [1, 2, 7]):
+            numpy.testing.assert_array_equal(erode_mask(self.mask, kernel_size, 'sphere', slab_thickness=4),
+                brute_force_erosion(self.mask, kernel_size, 'sphere'), err_msg=str(kernel_size))
+
+    def test_cube(self):
+        for kernel_size in ([5, 5, 5], [3, 6, 4], [1, 2, 7]):
+            numpy.testing.assert_array_equal(erode_mask(self.mask, kernel_size, 'cube', slab_thickness=4),
+                brute_force_erosion(self.mask, kernel_size, 'cube'), err_msg=str(kernel_size))
+
+    def test_slabs(self):
+        # the slabs read the slices of their neighbours within the kernel
+        numpy.testing.assert_array_equal(erode_mask(self.mask, [3, 3, 9], 'sphere', num_workers=4, slab_thickness=1),
+            erode_mask(self.mask, [3, 3, 9], 'sphere', num_workers=1, slab_thickness=self.mask.shape[0]))
+
+
+@unittest.skipUnless(has_vtk, "VTK is not installed")
+class TestMaskFromIntensity(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.default_rng(2)
+        # blobs with noisy borders, for the smoothing of the mask to remove
+        zz, yy, xx = numpy.mgrid[0:21, 0:19, 0:17]
+        volume = 128 + 100 * numpy.sin(xx / 3) * numpy.cos(yy / 4) * numpy.sin(zz / 3 + 1) + rng.normal(0, 20, xx.shape)
+        self.volume = numpy.clip(volume, 0, 255).astype(numpy.uint8)
+
+    def reference(self, spacing):
+        image = vtk.vtkImageData()
+        image.SetOrigin(0, 0, 0)
+        image.SetSpacing(spacing, spacing, spacing)
+        image.SetDimensions(*[-(-n // spacing) for n in self.volume.shape[::-1]])
+        return image
+
+    def test_threshold(self):
+        mask = mask_from_intensity(self.volume, (100, 160), self.reference(1), holes=False, largest=False)
+        numpy.testing.assert_array_equal(mask, (self.volume >= 100) & (self.volume <= 160))
+
+    def test_slab_halos(self):
+        # each slab reads the slices the smoothing needs around it, so one slice
+        # at a time gives the same mask as the whole volume at once
+        slice_voxels = self.volume.shape[1] * self.volume.shape[2]
+        for smoothing in ['open', 'close', 'open and close']:
+            for spacing in [1, 2]:
+                kwargs = dict(holes=False, largest=False, smoothing=smoothing, radius=2)
+                whole = mask_from_intensity(self.volume, (140, 255), self.reference(spacing),
+                    chunk_voxels=self.volume.size, num_workers=1, **kwargs)
+                slabs = mask_from_intensity(self.volume, (140, 255), self.reference(spacing),
+                    chunk_voxels=slice_voxels, num_workers=4, **kwargs)
+                self.assertTrue(numpy.any(whole) and not numpy.all(whole))
+                numpy.testing.assert_array_equal(slabs, whole, err_msg="{} {}".format(smoothing, spacing))
+
+
+if __name__ == '__main__':
+    unittest.main()
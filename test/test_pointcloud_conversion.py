@@ -0,0 +1,241 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+try:
+    from idvc.pointcloud_conversion import subvolume_fractions, distance_from_overlap, lattice_cell, \
+        block_texture, read_numeric_table, write_numeric_table, SIDECAR_SUFFIX, SIDECAR_INFO_SUFFIX
+    has_vtk = True
+except ImportError:
+    has_vtk = False
+
+
+def brute_force_fraction(volume, point, size, geometry, gray_range):
+    '''Fraction of the voxels of the subvolume of the point in gray_range, by testing each voxel of the volume'''
+    zz, yy, xx = numpy.mgrid[0:volume.shape[0], 0:volume.shape[1], 0:volume.shape[2]]
+    centre = numpy.rint(point).astype(int)
+    in_range = (volume >= gray_range[0]) & (volume <= gray_range[1])
+    if geometry == 'cube':
+        # as dvc, size voxels starting size // 2 before the centre
+        low = centre - size // 2
+        inside = (xx >= low[0]) & (xx < low[0] + size) & (yy >= low[1]) & (yy < low[1] + size) \
+            & (zz >= low[2]) & (zz < low[2] + size)
+        return numpy.count_nonzero(in_range & inside) / size**3
+    radius = size / 2
+    inside = (xx - centre[0])**2 + (yy - centre[1])**2 + (zz - centre[2])**2 <= radius**2
+    offsets = numpy.arange(-int(radius), int(radius) + 1)
+    dz, dy, dx = numpy.meshgrid(offsets, offsets, offsets, indexing='ij')
+    return numpy.count_nonzero(in_range & inside) / numpy.count_nonzero(dx**2 + dy**2 + dz**2 <= radius**2)
+
+
+@unittest.skipUnless(has_vtk, "VTK is not installed")
+class TestSubvolumeFractions(unittest.TestCase):
+    def setUp(self):
+        self.rng = numpy.random.default_rng(0)
+        self.volume = self.rng.integers(0, 256, (23, 17, 19)).astype(numpy.uint8)
+        # some points near or beyond the borders, whose subvolumes are partly outside the volume
+        self.points = self.rng.uniform(-4, 26, (200, 3))
+        self.sizes = self.rng.choice([3, 4, 5, 8, 11], len(self.points))
+
+    def check(self, geometry, sizes, num_workers):
+        fractions = subvolume_fractions(self.volume, self.points, sizes, geometry, (50, 180), num_workers=num_workers)
+        expected = [brute_force_fraction(self.volume, point, size, geometry, (50, 180))
+            for point, size in zip(self.points, numpy.broadcast_to(sizes, len(self.points)))]
+        numpy.testing.assert_allclose(fractions, expected, rtol=0, atol=1e-12)
+
+    def test_cube(self):
+        for num_workers in [1, 3, 8]:
+            self.check('cube', self.sizes, num_workers)
+        self.check('cube', 6, 2)
+
+    def test_sphere(self):
+        for num_workers in [1, 3, 8]:
+            self.check('sphere', self.sizes, num_workers)
+        self.check('sphere', 7, 2)
+
+    def test_no_points(self):
+        self.assertEqual(len(subvolume_fractions(self.volume, numpy.zeros((0, 3)), 5)), 0)
+
+    def test_geometry(self):
+        with self.assertRaises(ValueError):
+            subvolume_fractions(self.volume, self.points, 5, 'cylinder')
+
+
+@unittest.skipUnless(has_vtk, "VTK is not installed")
+class TestDistanceFromOverlap(unittest.TestCase):
+    def sampled_overlap(self, distance, radius, dimensions):
+        '''Fraction of a sphere or circle of radius overlapped by the same shape at distance, on a fine grid'''
+        axis = numpy.linspace(-radius, radius, 101)
+        grid = numpy.stack(numpy.meshgrid(*[axis] * dimensions, indexing='ij'), axis=-1).reshape(-1, dimensions)
+        grid = grid[numpy.sum(grid**2, axis=1) <= radius**2]
+        shifted = grid.copy()
+        shifted[:, 0] -= distance
+        return numpy.count_nonzero(numpy.sum(shifted**2, axis=1) <= radius**2) / len(grid)
+
+    def test_sphere(self):
+        for overlap in [0.1, 0.25, 0.5, 0.8]:
+            distance = distance_from_overlap(10, overlap, mode='sphere')
+            self.assertAlmostEqual(self.sampled_overlap(distance, 10, 3), overlap, delta=0.01)
+        self.assertAlmostEqual(distance_from_overlap(10, 0, mode='sphere'), 20)
+        self.assertAlmostEqual(distance_from_overlap(10, 1, mode='sphere'), 0)
+        # clipped to the range of the overlap
+        self.assertAlmostEqual(distance_from_overlap(10, 1.5, mode='sphere'), 0)
+
+    def test_circle(self):
+        for overlap in [0.1, 0.25, 0.5, 0.8]:
+            distance = distance_from_overlap(10, overlap, interp=True, mode='circle')
+            self.assertAlmostEqual(self.sampled_overlap(distance, 10, 2), overlap, delta=0.01)
+
+    def test_cube(self):
+        # the radius of cubes and squares is their side
+        for mode in ['cube', 'square']:
+            self.assertAlmostEqual(distance_from_overlap(10, 0.3, mode=mode), 7)
+            self.assertAlmostEqual(distance_from_overlap(10, 0, mode=mode), 10)
+            self.assertAlmostEqual(distance_from_overlap(10, -0.5, mode=mode), 15)
+            self.assertAlmostEqual(distance_from_overlap(10, 2, mode=mode), 0)
+
+    def test_mode(self):
+        with self.assertRaises(ValueError):
+            distance_from_overlap(10, 0.5, mode='cylinder')
+
+
+@unittest.skipUnless(has_vtk, "VTK is not installed")
+class TestLatticeCell(unittest.TestCase):
+    def lattice(self, name):
+        '''The points of 7 x 7 x 7 cells of the lattice'''
+        cell, basis = lattice_cell(name)
+        offsets = numpy.arange(-3, 4)
+        cells = numpy.stack(numpy.meshgrid(offsets, offsets, offsets, indexing='ij'), axis=-1).reshape(-1, 3) * cell
+        return cell, basis, (cells[:, numpy.newaxis, :] + basis[numpy.newaxis]).reshape(-1, 3)
+
+    def test_nearest_neighbours(self):
+        # further apart than in the cubic lattice, so the subvolumes overlap less than set
+        expected = {'cubic': 1, 'bcc': 3 / numpy.sqrt(5), 'fcc': numpy.sqrt(3 / 2), 'hcp': numpy.sqrt(3 / 2)}
+        for name, spacing in expected.items():
+            cell, basis, points = self.lattice(name)
+            for point in basis:
+                distance = numpy.sqrt(numpy.sum((points - point)**2, axis=1))
+                self.assertAlmostEqual(distance[distance > 1e-9].min(), spacing, msg=name)
+
+    def test_covering_radius(self):
+        # the largest distance of any location from the nearest point is that of the cubic lattice
+        probes = numpy.random.default_rng(0).random((2000, 3))
+        for name in ['cubic', 'bcc', 'fcc', 'hcp']:
+            cell, basis, points = self.lattice(name)
+            distance = numpy.sqrt(numpy.min(numpy.sum((probes[:, numpy.newaxis] * cell - points)**2, axis=2), axis=1))
+            self.assertLessEqual(distance.max(), numpy.sqrt(3) / 2 + 1e-9, msg=name)
+            self.assertGreater(distance.max(), 0.9 * numpy.sqrt(3) / 2, msg=name)
+
+    def test_points_per_cell(self):
+        # fewer points than the cubic lattice
+        expected = {'cubic': 1, 'bcc': 0.538, 'fcc': 0.770, 'hcp': 0.770}
+        for name, density in expected.items():
+            cell, basis = lattice_cell(name)
+            self.assertAlmostEqual(len(basis) / numpy.prod(cell), density, places=3, msg=name)
+
+    def test_unsupported(self):
+        with self.assertRaises(ValueError):
+            lattice_cell('diamond')
+
+
+def brute_force_texture(image, block_size, measure):
+    '''Texture of each block of block_size (bx, by, bz) voxels of the image, one block at a time'''
+    bx, by, bz = block_size
+    image = image.astype(numpy.float64)
+    energy = numpy.zeros(image.shape)
+    for axis in range(3):
+        difference = numpy.diff(image, axis=axis) ** 2
+        energy[tuple(slice(0, n - 1) if a == axis else slice(None) for a, n in enumerate(image.shape))] += difference
+    texture = numpy.zeros([-(-n // b) for n, b in zip(image.shape, [bz, by, bx])])
+    for z, y, x in numpy.ndindex(*texture.shape):
+        block = (slice(z * bz, (z + 1) * bz), slice(y * by, (y + 1) * by), slice(x * bx, (x + 1) * bx))
+        texture[z, y, x] = image[block].var() if measure == 'variance' else energy[block].mean()
+    return texture
+
+
+@unittest.skipUnless(has_vtk, "VTK is not installed")
+class TestBlockTexture(unittest.TestCase):
+    def setUp(self):
+        self.image = numpy.random.default_rng(0).integers(0, 256, (19, 13, 17)).astype(numpy.uint8)
+
+    def test_measures(self):
+        # the last blocks are partial, and the slabs are read a few slices at a time
+        for measure in ['variance', 'gradient']:
+            expected = brute_force_texture(self.image, [4, 5, 6], measure)
+            for chunk_voxels in [1, 3 * 13 * 17, self.image.size]:
+                texture = block_texture(self.image, [4, 5, 6], measure, num_workers=2, chunk_voxels=chunk_voxels)
+                numpy.testing.assert_allclose(texture, expected, rtol=1e-4, err_msg="{} {}".format(measure, chunk_voxels))
+
+    def test_measure(self):
+        with self.assertRaises(ValueError):
+            block_texture(self.image, [4, 4, 4], 'entropy')
+
+
+@unittest.skipUnless(has_vtk, "VTK is not installed")
+class TestNumericTable(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, "points.disp")
+        self.rows = numpy.random.default_rng(0).uniform(0, 100, (1000, 4)).round(3)
+        self.write(self.rows)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, rows):
+        with open(self.filename, "w") as f:
+            f.write("n\tx\ty\tz\n")
+        with open(self.filename, "a") as f:
+            f.writelines(["\t".join("{:.3f}".format(v) for v in row) + "\n" for row in rows])
+
+    def test_header_and_chunks(self):
+        # the chunks end in the middle of lines
+        numpy.testing.assert_array_equal(read_numeric_table(self.filename, sidecar=False, chunk_size=1000), self.rows)
+        self.assertFalse(os.path.exists(self.filename + SIDECAR_SUFFIX))
+
+    def test_sidecar(self):
+        numpy.testing.assert_array_equal(read_numeric_table(self.filename), self.rows)
+        self.assertTrue(os.path.exists(self.filename + SIDECAR_SUFFIX))
+        self.assertTrue(os.path.exists(self.filename + SIDECAR_INFO_SUFFIX))
+        # the second read maps the sidecar
+        data = read_numeric_table(self.filename)
+        self.assertIsInstance(data, numpy.memmap)
+        numpy.testing.assert_array_equal(data, self.rows)
+
+    def test_sidecar_invalidation(self):
+        read_numeric_table(self.filename)
+        mtime = os.stat(self.filename).st_mtime_ns
+        # same size, different values and modification time
+        rows = self.rows.copy()
+        rows[0, 1] = 99.999 if rows[0, 1] != 99.999 else 11.111
+        self.write(rows)
+        os.utime(self.filename, ns=(mtime + 10**9, mtime + 10**9))
+        numpy.testing.assert_array_equal(read_numeric_table(self.filename), rows)
+        # different size
+        self.write(self.rows[:10])
+        numpy.testing.assert_array_equal(read_numeric_table(self.filename), self.rows[:10])
+
+    def test_write(self):
+        write_numeric_table(self.filename, self.rows, '%d\t%.3f\t%.3f\t%.3f', chunk_rows=300)
+        expected = self.rows.copy()
+        expected[:, 0] = numpy.trunc(expected[:, 0])
+        numpy.testing.assert_array_equal(read_numeric_table(self.filename, sidecar=False), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+
+#   http://www.apache.org/licenses/LICENSE-2.0
+
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+
+import numpy
+
+from idvc.registration import phase_correlation
+
+
+def smooth_volume(shape, seed):
+    '''Random volume with features of a few voxels, as the speckle of a tomogram'''
+    noise = numpy.random.default_rng(seed).normal(size=shape)
+    frequencies = numpy.meshgrid(*[numpy.fft.fftfreq(n) for n in shape], indexing='ij', sparse=True)
+    spectrum = numpy.fft.fftn(noise) * numpy.exp(-2 * (numpy.pi * 1.5) ** 2 * sum(f ** 2 for f in frequencies))
+    return numpy.real(numpy.fft.ifftn(spectrum))
+
+def translated(volume, translation):
+    '''Volume translated by the (x, y, z) translation, in voxels, by shifting its phase'''
+    frequencies = numpy.meshgrid(*[numpy.fft.fftfreq(n) for n in volume.shape], indexing='ij', sparse=True)
+    # x, y and z are axes 2, 1 and 0 of the array
+    phase = sum(f * t for f, t in zip(frequencies, translation[::-1]))
+    return numpy.real(numpy.fft.ifftn(numpy.fft.fftn(volume) * numpy.exp(-2j * numpy.pi * phase)))
+
+
+class TestPhaseCorrelation(unittest.TestCase):
+    def setUp(self):
+        self.volume = smooth_volume((64, 60, 56), 0)
+
+    def test_sub_voxel_translation(self):
+        for translation in ([0.3, -1.6, 2.45], [-4.2, 0.5, 0.], [7.7, 3.1, -5.5]):
+            moved = translated(self.volume, translation)
+            # the part of the volumes in the middle, which doesn't wrap around
+            reference = self.volume[8:-8, 8:-8, 8:-8]
+            correlate = moved[8:-8, 8:-8, 8:-8]
+            estimate, height = phase_correlation(reference, correlate, max_shift=8)
+            numpy.testing.assert_allclose(estimate, translation, atol=0.1, err_msg=str(translation))
+            self.assertGreater(height, 0.5)
+
+    def test_noise(self):
+        moved = translated(self.volume, [2.3, -1.2, 0.7])
+        moved += numpy.random.default_rng(1).normal(scale=0.2 * self.volume.std(), size=moved.shape)
+        estimate, height = phase_correlation(self.volume[8:-8, 8:-8, 8:-8], moved[8:-8, 8:-8, 8:-8], max_shift=8)
+        numpy.testing.assert_allclose(estimate, [2.3, -1.2, 0.7], atol=0.2)
+
+    def test_unrelated(self):
+        estimate, height = phase_correlation(self.volume, smooth_volume(self.volume.shape, 1))
+        self.assertLess(height, 0.3)
+
+    def test_shape(self):
+        with self.assertRaises(ValueError):
+            phase_correlation(self.volume, self.volume[1:])
+
+
+if __name__ == '__main__':
+    unittest.main()